@@ -0,0 +1,199 @@
+"""
+This module contains the rolling pre-fire baselines used when calculating burn locations in Scotland (config.BASELINE = 'on').
+
+In pair mode each image is compared with the image before it, so cloud in either image blanks out detection and each image is
+read twice (as the post-fire image of one pair and the pre-fire image of the next). A baseline instead holds, for each land
+pixel of a granule, the NBR2 and SAVI of the latest image in which the pixel was clear, and the date of that image. Each new
+image is read once, compared with the baseline, and then used to update the baseline where it is clear. A pixel under cloud
+in the last image keeps the values of the last image in which it was clear, so burns under earlier cloud are still detected.
+
+Each baseline is a 3 band Int16 GeoTIFF on the land cropped grid of the granule (baseline folder of the output directory):
+
+    band 1  NBR2 x SCALE
+    band 2  SAVI x SCALE
+    band 3  acquisition date of the values (days since EPOCH)
+
+with NODATA where no clear image has been seen. A small JSON state file next to it records the images already applied, so
+they are not applied (or read) again. Both files are written to a temporary name and renamed, so a baseline is never left
+half written.
+
+"""
+
+# --- Imports ---
+import datetime
+import logging
+import os
+import socket
+
+import numpy as np
+import rasterio
+
+from workqueue import readjson, writejson
+
+
+# --- Constants ---
+BASELINE = 'baseline'
+
+# Scale of the stored index values (stored values are rounded to 1 / SCALE)
+SCALE = 10000
+
+# Stored value of pixels with no clear image
+NODATA = -32768
+
+# Date the stored acquisition dates count from
+EPOCH = datetime.date(2015, 1, 1)
+
+
+# --- Functions ---
+def baselinepath(od, granule):
+    '''
+    Builds the path of the baseline raster of a granule
+
+    Return:
+    Path to the baseline raster
+
+    Keyword arguments:
+    od -- output directory
+    granule -- granule name (e.g. T30VVJ)
+    '''
+    return os.path.join(od, BASELINE, granule + '_baseline.tif')
+
+
+def statepath(od, granule):
+    '''
+    Builds the path of the baseline state file of a granule
+
+    Return:
+    Path to the state file
+
+    Keyword arguments:
+    od -- output directory
+    granule -- granule name
+    '''
+    return os.path.join(od, BASELINE, granule + '_baseline.json')
+
+
+def datenumber(date):
+    '''
+    Converts an image date to the number stored in the baseline
+
+    Return:
+    Days since EPOCH
+
+    Keyword arguments:
+    date -- image date as YYYYMMDD
+    '''
+    return (datetime.datetime.strptime(date, '%Y%m%d').date() - EPOCH).days
+
+
+def newbaseline(shape):
+    '''
+    Creates an empty baseline (no clear image seen)
+
+    Return:
+    Dictionary of the nbr2, savi (float32, NaN where empty) and date (int16, NODATA where empty) arrays
+
+    Keyword arguments:
+    shape -- shape of the land cropped granule grid
+    '''
+    return {'nbr2': np.full(shape, np.nan, dtype=np.float32), 'savi': np.full(shape, np.nan, dtype=np.float32),
+            'date': np.full(shape, NODATA, dtype=np.int16)}
+
+
+def readstate(od, granule):
+    '''
+    Reads the baseline state of a granule (the images applied so far)
+
+    Return:
+    State dictionary, or None if the granule has no baseline
+
+    Keyword arguments:
+    od -- output directory
+    granule -- granule name
+    '''
+    if not os.path.isfile(baselinepath(od, granule)) or not os.path.isfile(statepath(od, granule)):
+        return None
+    return readjson(statepath(od, granule))
+
+
+def readbaseline(od, granule):
+    '''
+    Reads the baseline and state of a granule
+
+    Return:
+    Baseline dictionary (as newbaseline) and state dictionary, or None, None if the granule has no baseline
+
+    Keyword arguments:
+    od -- output directory
+    granule -- granule name
+    '''
+    state = readstate(od, granule)
+    if state is None:
+        return None, None
+
+    with rasterio.open(baselinepath(od, granule)) as dataset:
+        stored = dataset.read()
+    base = {'date': stored[2]}
+    for i, name in enumerate(['nbr2', 'savi']):
+        values = stored[i].astype(np.float32) / SCALE
+        values[stored[i] == NODATA] = np.nan
+        base[name] = values
+    return base, state
+
+
+def updatebaseline(base, nbr2, savi, clear, date):
+    '''
+    Updates the baseline with the clear pixels of an image, where the image is newer than the values held
+
+    Return:
+    Number of pixels updated
+
+    Keyword arguments:
+    base -- baseline dictionary (updated in place)
+    nbr2 -- NBR2 of the image
+    savi -- SAVI of the image
+    clear -- boolean array of the pixels of the image that are valid and clear of cloud
+    date -- image date as YYYYMMDD
+    '''
+    day = datenumber(date)
+    update = clear & (base['date'] < day)
+    base['nbr2'][update] = nbr2[update]
+    base['savi'][update] = savi[update]
+    base['date'][update] = day
+    return int(np.count_nonzero(update))
+
+
+def writebaseline(od, granule, base, profile, state):
+    '''
+    Writes the baseline raster and state of a granule. Each file is written to a temporary file and renamed.
+
+    Return:
+    NA
+
+    Keyword arguments:
+    od -- output directory
+    granule -- granule name
+    base -- baseline dictionary
+    profile -- profile of the land cropped granule grid (e.g. of the image read last)
+    state -- state dictionary
+    '''
+    os.makedirs(os.path.join(od, BASELINE), exist_ok=True)
+    stored = np.full((3,) + base['date'].shape, NODATA, dtype=np.int16)
+    for i, name in enumerate(['nbr2', 'savi']):
+        held = np.isfinite(base[name])
+        stored[i][held] = np.clip(np.round(base[name][held] * SCALE), -32767, 32767)
+    stored[2] = base['date']
+
+    profile = profile.copy()
+    profile.update({'driver': 'GTiff', 'count': 3, 'dtype': rasterio.int16, 'nodata': NODATA, 'compress': 'deflate',
+                    'predictor': 2, 'tiled': True, 'blockxsize': 256, 'blockysize': 256})
+    path = baselinepath(od, granule)
+    temppath = path + '.' + socket.gethostname() + '.' + str(os.getpid()) + '.tmp.tif'
+    with rasterio.open(temppath, 'w', **profile) as dest:
+        dest.write(stored)
+        dest.set_band_description(1, 'nbr2')
+        dest.set_band_description(2, 'savi')
+        dest.set_band_description(3, 'date')
+    os.replace(temppath, path)
+    writejson(statepath(od, granule), state)
+    logging.debug('Baseline written: ' + granule + ' (' + state['last'] + ')')
@@ -0,0 +1,232 @@
+"""
+Summary:
+Microbenchmarks for the burn detection kernels in operationalcode.py.
+
+Description:
+Synthetic band arrays, cloud masks and burn masks are generated in memory (and in a temporary directory for the kernels that
+read or write files) for each requested image size. Each kernel is run once under tracemalloc to record the peak of
+Python/NumPy allocations and then timed over a number of repeats. Results are printed as a table and can be appended to a
+JSON lines file so that optimisation work can be compared against a baseline.
+
+Kernels: nbr, nbr2, savi, threshold_imgs, grow_burn, getcloudmask, sieve (rasterio.features.sieve as used on the burn masks),
+fastsieve (the equivalent NumPy sieve, single threaded) and saveVector.
+
+Usage:
+python benchmarks/kernels.py                        (default sizes of 1000 and 2745 pixels square)
+python benchmarks/kernels.py --sizes 10980 --repeats 3 --output bench.jsonl
+python benchmarks/kernels.py --kernels sieve threshold_imgs
+
+A full 10980 x 10980 granule needs roughly 10 GB of memory, as the bands are float64 in the same way as those returned by pre/post.
+
+"""
+
+# --- Imports ---
+import argparse
+import datetime
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import config # config.py configuration parameters
+import fastsieve # fast equivalent of the GDAL sieve
+import operationalcode as oc
+
+
+# --- Constants ---
+PRENAME = 'S2A_20190401_lat57lon375_T30VVJ_ORB080_utm30n_osgb_vmsk_sharp_rad_srefdem_stdsref.tif'
+POSTNAME = 'S2B_20190404_lat57lon375_T30VVJ_ORB123_utm30n_osgb_vmsk_sharp_rad_srefdem_stdsref.tif'
+KERNELS = ['nbr', 'nbr2', 'savi', 'threshold_imgs', 'grow_burn', 'getcloudmask', 'sieve', 'fastsieve', 'saveVector']
+
+
+# --- Functions ---
+def burnpatches(size, patches, rng):
+    '''
+    Creates a burn mask with square burn patches plus single pixel noise, so that the sieve has clumps to remove
+
+    Return:
+    uint8 burn mask (0/1)
+
+    Keyword arguments:
+    size -- width and height of the mask in pixels
+    patches -- number of burn patches
+    rng -- numpy random generator
+    '''
+    burn = (rng.random((size, size)) > 0.995).astype(rasterio.uint8)
+    for i in range(patches):
+        side = int(rng.integers(3, 40))
+        row, col = rng.integers(0, size - side, 2)
+        burn[row:row + side, col:col + side] = 1
+    return burn
+
+
+def syntheticpair(size, rng):
+    '''
+    Creates synthetic pre and post band arrays (red, nir, swir1, swir2) in the same form as returned by pre/post, with burn patches in the post image
+
+    Return:
+    Dictionary of arrays
+
+    Keyword arguments:
+    size -- width and height of the bands in pixels
+    rng -- numpy random generator
+    '''
+    data = {}
+    for when in ('pre', 'post'):
+        data[when + 'red'] = rng.uniform(0.02, 0.08, (size, size))
+        data[when + 'nir'] = rng.uniform(0.2, 0.4, (size, size))
+        data[when + 'swir1'] = rng.uniform(0.1, 0.2, (size, size))
+        data[when + 'swir2'] = rng.uniform(0.05, 0.1, (size, size))
+
+    # burns lower the nir and raise the swir bands of the post image
+    burn = burnpatches(size, max(1, size // 50), rng).astype(bool)
+    data['postnir'][burn] *= 0.3
+    data['postswir1'][burn] *= 1.5
+    data['postswir2'][burn] *= 3.0
+    return data
+
+
+def writecloudmask(path, size, rng):
+    '''
+    Writes a synthetic cloud mask GeoTIFF (0 = clear, 1 = cloud) in the OSGB grid
+
+    Return:
+    NA
+
+    Keyword arguments:
+    path -- output path
+    size -- width and height in pixels
+    rng -- numpy random generator
+    '''
+    profile = {'driver': 'GTiff', 'width': size, 'height': size, 'count': 1, 'dtype': 'uint8', 'crs': 'EPSG:27700',
+               'transform': from_origin(200000, 800000, 10, 10), 'compress': 'lzw'}
+    with rasterio.open(path, 'w', **profile) as dst:
+        dst.write(burnpatches(size, max(1, size // 20), rng), 1)
+
+
+def timekernel(func, repeats):
+    '''
+    Runs a kernel once under tracemalloc to find its allocation peak and then times it over a number of repeats
+
+    Return:
+    Best time (s), mean time (s) and allocation peak (MB)
+
+    Keyword arguments:
+    func -- function taking no arguments that runs the kernel
+    repeats -- number of timed repeats
+    '''
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+    tracemalloc.stop()
+
+    times = []
+    for i in range(repeats):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times), sum(times) / len(times), peak
+
+
+def kernelfunctions(size, tempdir, rng):
+    '''
+    Builds the synthetic inputs for one image size and wraps each kernel as a function taking no arguments
+
+    Return:
+    Dictionary of kernel name to function
+
+    Keyword arguments:
+    size -- width and height of the synthetic granule in pixels
+    tempdir -- directory for the files read and written by the kernels
+    rng -- numpy random generator
+    '''
+    d = syntheticpair(size, rng)
+    postnbr = oc.nbr(d['postswir1'], d['postnir'])
+    dnbr2 = oc.nbr2(d['postswir2'], d['postswir1']) - oc.nbr2(d['preswir2'], d['preswir1'])
+    dsavi = oc.savi(d['postnir'], d['postred']) - oc.savi(d['prenir'], d['prered'])
+    burnseed = oc.threshold_imgs(dsavi, postnbr, dnbr2, config.THRESHOLD)
+    burnarea = oc.grow_burn(dsavi, postnbr, dnbr2, config.GROW)
+    sievein = burnpatches(size, max(1, size // 50), rng)
+
+    cloudname = os.path.join(tempdir, 'clouds_{0}.tif'.format(size))
+    writecloudmask(cloudname, size, rng)
+    transform = from_origin(200000, 800000, 10, 10)
+    profile = {'driver': 'GTiff', 'width': size, 'height': size, 'count': 1, 'dtype': 'float32', 'crs': 'EPSG:27700', 'transform': transform}
+
+    return {
+        'nbr': lambda: oc.nbr(d['postswir1'], d['postnir']),
+        'nbr2': lambda: oc.nbr2(d['postswir2'], d['postswir1']),
+        'savi': lambda: oc.savi(d['postnir'], d['postred']),
+        'threshold_imgs': lambda: oc.threshold_imgs(dsavi, postnbr, dnbr2, config.THRESHOLD),
+        'grow_burn': lambda: oc.grow_burn(dsavi, postnbr, dnbr2, config.GROW),
+        'getcloudmask': lambda: oc.getcloudmask(cloudname),
+        'sieve': lambda: rasterio.features.sieve(sievein, size=3, connectivity=8),
+        'fastsieve': lambda: fastsieve.fastsieve(sievein, size=3, connectivity=8),
+        'saveVector': lambda: oc.saveVector(tempdir, burnseed, burnarea, profile, transform, PRENAME, POSTNAME),
+    }
+
+
+def runbenchmarks(sizes, kernels, repeats, output=None, seed=0):
+    '''
+    Runs the selected kernels for each image size, prints a results table and optionally appends the results to a JSON lines file
+
+    Return:
+    List of result dictionaries
+
+    Keyword arguments:
+    sizes -- list of image sizes (pixels square)
+    kernels -- list of kernel names
+    repeats -- number of timed repeats per kernel
+    output -- path of a JSON lines file to append the results to
+    seed -- random seed for the synthetic data
+    '''
+    rng = np.random.default_rng(seed)
+    results = []
+    print('{0:<16}{1:>8}{2:>12}{3:>12}{4:>12}{5:>14}'.format('kernel', 'size', 'best (s)', 'mean (s)', 'MP/s', 'peak (MB)'))
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        for size in sizes:
+            functions = kernelfunctions(size, tempdir, rng)
+            megapixels = size * size / 1e6
+            for kernel in kernels:
+                result = {'time': datetime.datetime.now().isoformat(timespec='seconds'), 'kernel': kernel, 'size': size, 'repeats': repeats}
+                try:
+                    best, mean, peak = timekernel(functions[kernel], repeats)
+                except Exception as error:
+                    result['error'] = repr(error)
+                    print('{0:<16}{1:>8}  failed: {2}'.format(kernel, size, repr(error)))
+                else:
+                    result.update(best_s=round(best, 4), mean_s=round(mean, 4), mpix_per_s=round(megapixels / best, 2), peak_mb=round(peak, 1))
+                    print('{0:<16}{1:>8}{2:>12.3f}{3:>12.3f}{4:>12.1f}{5:>14.1f}'.format(kernel, size, best, mean, megapixels / best, peak))
+                results.append(result)
+            del functions
+
+    if output is not None:
+        with open(output, 'a') as outfile:
+            for result in results:
+                outfile.write(json.dumps(result) + '\n')
+    return results
+
+
+# ======================================================================    
+# ========================== MAIN CODE ======================================
+# ======================================================================
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Microbenchmarks for the burn detection kernels')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 2745], help='image sizes in pixels square (a full granule is 10980)')
+    parser.add_argument('--kernels', nargs='+', default=KERNELS, choices=KERNELS, help='kernels to run')
+    parser.add_argument('--repeats', type=int, default=3, help='number of timed repeats per kernel')
+    parser.add_argument('--output', default=None, help='JSON lines file to append the results to')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for the synthetic data')
+    args = parser.parse_args()
+
+    runbenchmarks(args.sizes, args.kernels, args.repeats, args.output, args.seed)
@@ -0,0 +1,124 @@
+"""
+Summary:
+Crawl and end-to-end throughput benchmarks run against a synthetic ARD archive (see synthard.py).
+
+Description:
+The crawl benchmark times getdatalist and countfiles over the archive. The end-to-end benchmark points the configuration at
+the archive, a fresh output folder and the synthetic land mask, runs operationalcode.py as a script and reports pairs and
+megapixels processed per second together with the stage timing summary from the run's metrics file.
+
+Usage:
+python benchmarks/pipeline.py /tmp/synthard                          (generates the archive if it does not exist)
+python benchmarks/pipeline.py /tmp/synthard --size 10980 --count 6 --granules T30VVJ T30VVK T30VVL
+
+"""
+
+# --- Imports ---
+import argparse
+import glob
+import os
+import runpy
+import shutil
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import config # config.py configuration parameters
+import operationalcode as oc
+import runmetrics # per stage timing instrumentation
+import synthard
+
+
+# --- Functions ---
+def crawlbenchmark(root, granules, repeats=3):
+    '''
+    Times the directory crawl functions over the archive
+
+    Return:
+    Number of images found and best times (s) for getdatalist and countfiles
+
+    Keyword arguments:
+    root -- archive root
+    granules -- granule IDs to select
+    repeats -- number of timed repeats
+    '''
+    listtimes, counttimes = [], []
+    for i in range(repeats):
+        start = time.perf_counter()
+        images = oc.getdatalist(root, [], granules, [])
+        listtimes.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        oc.countfiles(root)
+        counttimes.append(time.perf_counter() - start)
+    return len(images), min(listtimes), min(counttimes)
+
+
+def endtoendbenchmark(root, od, granules, size):
+    '''
+    Runs operationalcode.py against the synthetic archive with the configuration pointed at it
+
+    Return:
+    Elapsed time (s), number of pairs processed and the stage timing summary
+
+    Keyword arguments:
+    root -- archive root
+    od -- output folder (emptied before the run)
+    granules -- granule IDs to process
+    size -- granule size in pixels
+    '''
+    if os.path.isdir(od):
+        shutil.rmtree(od)
+    os.makedirs(od)
+
+    config.ARD_WRKDIR = root
+    config.GWS_DATA = od
+    config.LANDMASK = os.path.join(root, 'landmask', 'synth_landonly.shp')
+    config.PROC_GRANULES = granules
+    config.MONTHS_OUT = []
+    # synthetic granules are much smaller than the real ones
+    config.MIN_FILE_SIZE = 0
+
+    start = time.perf_counter()
+    runpy.run_path(os.path.join(os.path.dirname(oc.__file__), 'operationalcode.py'), run_name='__main__')
+    elapsed = time.perf_counter() - start
+
+    metricsfiles = glob.glob(os.path.join(od, '*-metrics.jsonl'))
+    pairs = [r for r in runmetrics.readmetrics(metricsfiles) if r['pair'] != 'run']
+    return elapsed, len(pairs), runmetrics.summarise(metricsfiles)
+
+
+# ======================================================================
+# ========================== MAIN CODE ======================================
+# ======================================================================
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Crawl and end-to-end benchmarks on a synthetic ARD archive')
+    parser.add_argument('root', help='archive root folder (generated if it does not exist)')
+    parser.add_argument('--output', default=None, help='output folder for the end-to-end run (default: <root>_output)')
+    parser.add_argument('--granules', nargs='+', default=['T30VVJ', 'T30VVK'], help='granule IDs')
+    parser.add_argument('--count', type=int, default=4, help='number of dates per granule when generating')
+    parser.add_argument('--size', type=int, default=1000, help='granule size in pixels when generating')
+    parser.add_argument('--skip-endtoend', action='store_true', help='only run the crawl benchmark')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.root):
+        print('Generating synthetic archive in', args.root)
+        synthard.makearchive(args.root, args.granules, synthard.datesequence('20190401', args.count), args.size)
+
+    found, listtime, counttime = crawlbenchmark(args.root, args.granules)
+    print('--CRAWL--')
+    print('Images found: ', found)
+    print('getdatalist:  {0:.4f} s ({1:.0f} images/s)'.format(listtime, found / listtime if listtime > 0 else 0))
+    print('countfiles:   {0:.4f} s'.format(counttime))
+
+    if not args.skip_endtoend:
+        od = args.output if args.output is not None else args.root.rstrip('/') + '_output'
+        elapsed, pairs, summary = endtoendbenchmark(args.root, od, args.granules, args.size)
+        print('--END TO END--')
+        print('Pairs processed: ', pairs)
+        print('Elapsed:         {0:.2f} s'.format(elapsed))
+        if pairs > 0:
+            print('Throughput:      {0:.2f} pairs/s, {1:.1f} MP/s'.format(pairs / elapsed, pairs * args.size * args.size / 1e6 / elapsed))
+        print(summary)
@@ -0,0 +1,259 @@
+"""
+Summary:
+Generates a synthetic Sentinel 2 ARD archive and land mask for running the crawl and end-to-end benchmarks away from JASMIN.
+
+Description:
+The archive mimics the CEDA layout (<root>/<yyyy>/<mm>/<dd>/) and file naming used by the JNCC ARD, e.g.
+
+    S2A_20190401_lat57lon375_T30VVJ_ORB080_utm30n_osgb_vmsk_sharp_rad_srefdem_stdsref.tif
+    S2A_20190401_lat57lon375_T30VVJ_ORB080_utm30n_osgb_clouds.tif
+
+Each image has 10 uint16 bands in the ARD band order (B2, B3, B4, B5, B6, B7, B8, B8A, B11, B12) holding reflectance scaled by
+1000, on a 10 m OSGB (EPSG:27700) grid. Granules are laid out side by side. Burn patches are injected into each granule at a
+given date and persist in all later images, so the pair that spans the burn date produces detections. Cloud masks hold
+randomly placed cloud blobs (1 = cloud, 0 = clear).
+
+The land mask is a single polygon covering the granules with a sea inlet cut out of the west side, so the land mask crop in
+pre/post has the same extent as the granules while still masking some pixels.
+
+Usage:
+python benchmarks/synthard.py /tmp/synthard --granules T30VVJ T30VVK --dates 20190401 20190404 20190410 --size 1000
+
+"""
+
+# --- Imports ---
+import argparse
+import datetime
+import os
+
+import fiona
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+
+
+# --- Constants ---
+# Pixel size (m) and top left corner of the first granule in OSGB
+PIXEL = 10
+ORIGIN = (200000, 900000)
+
+# Surface reflectance (scaled by 1000) for red, nir, swir1 and swir2, the bands used by the burn detection
+VEGETATION = {3: 50, 7: 300, 9: 150, 10: 80}
+BURNT = {3: 80, 7: 100, 9: 200, 10: 180}
+
+
+# --- Functions ---
+def ardname(sensor, date, granule, orbit, product):
+    '''
+    Builds an ARD file name in the CEDA naming convention
+
+    Return:
+    File name
+
+    Keyword arguments:
+    sensor -- S2A or S2B
+    date -- acquisition date as yyyymmdd
+    granule -- granule ID e.g. T30VVJ
+    orbit -- relative orbit e.g. ORB080
+    product -- 'vmsk_sharp_rad_srefdem_stdsref' for the image or 'clouds' for the cloud mask
+    '''
+    return '_'.join([sensor, date, 'lat57lon375', granule, orbit, 'utm30n', 'osgb', product]) + '.tif'
+
+
+def granuletransform(index, size):
+    '''
+    Returns the transform of a synthetic granule. Granules are placed side by side from west to east.
+
+    Return:
+    Affine transform
+
+    Keyword arguments:
+    index -- position of the granule in the list of granules
+    size -- granule width and height in pixels
+    '''
+    return from_origin(ORIGIN[0] + index * size * PIXEL, ORIGIN[1], PIXEL, PIXEL)
+
+
+def blobs(size, count, minradius, maxradius, rng):
+    '''
+    Creates a boolean mask of randomly placed discs
+
+    Return:
+    Boolean mask
+
+    Keyword arguments:
+    size -- mask width and height in pixels
+    count -- number of discs
+    minradius -- minimum disc radius in pixels
+    maxradius -- maximum disc radius in pixels
+    rng -- numpy random generator
+    '''
+    mask = np.zeros((size, size), dtype=bool)
+    for i in range(count):
+        radius = int(rng.integers(minradius, maxradius + 1))
+        row, col = rng.integers(0, size, 2)
+        r0, r1 = max(0, row - radius), min(size, row + radius + 1)
+        c0, c1 = max(0, col - radius), min(size, col + radius + 1)
+        rows, cols = np.ogrid[r0:r1, c0:c1]
+        mask[r0:r1, c0:c1] |= (rows - row) ** 2 + (cols - col) ** 2 <= radius ** 2
+    return mask
+
+
+def writeimage(path, transform, size, burnt, rng, compress=None):
+    '''
+    Writes a synthetic 10 band ARD image
+
+    Return:
+    NA
+
+    Keyword arguments:
+    path -- output path
+    transform -- granule transform
+    size -- width and height in pixels
+    burnt -- boolean mask of burnt pixels
+    rng -- numpy random generator
+    compress -- GDAL compression (None for uncompressed, as the ARD)
+    '''
+    profile = {'driver': 'GTiff', 'width': size, 'height': size, 'count': 10, 'dtype': 'uint16', 'crs': 'EPSG:27700',
+               'transform': transform, 'nodata': 0, 'tiled': True, 'blockxsize': 256, 'blockysize': 256}
+    if compress is not None:
+        profile['compress'] = compress
+
+    with rasterio.open(path, 'w', **profile) as dst:
+        for band in range(1, 11):
+            base = VEGETATION.get(band, 100)
+            data = rng.normal(base, base * 0.1, (size, size))
+            if band in BURNT:
+                data[burnt] = rng.normal(BURNT[band], BURNT[band] * 0.1, int(burnt.sum()))
+            dst.write(np.clip(data, 1, 10000).astype(rasterio.uint16), band)
+
+
+def writeclouds(path, transform, size, cloudfraction, rng):
+    '''
+    Writes a synthetic cloud mask (1 = cloud, 0 = clear)
+
+    Return:
+    NA
+
+    Keyword arguments:
+    path -- output path
+    transform -- granule transform
+    size -- width and height in pixels
+    cloudfraction -- approximate fraction of the image covered by cloud
+    rng -- numpy random generator
+    '''
+    radius = max(2, size // 20)
+    count = int(cloudfraction * size * size / (np.pi * radius * radius))
+    clouds = blobs(size, count, radius // 2, radius, rng)
+
+    profile = {'driver': 'GTiff', 'width': size, 'height': size, 'count': 1, 'dtype': 'uint8', 'crs': 'EPSG:27700',
+               'transform': transform, 'compress': 'lzw'}
+    with rasterio.open(path, 'w', **profile) as dst:
+        dst.write(clouds.astype(rasterio.uint8), 1)
+
+
+def writelandmask(path, granules, size):
+    '''
+    Writes a land mask shapefile covering the synthetic granules, with a sea inlet cut into the west side
+
+    Return:
+    NA
+
+    Keyword arguments:
+    path -- output path of the .shp file
+    granules -- list of granule IDs
+    size -- granule width and height in pixels
+    '''
+    west, north = ORIGIN
+    east = west + len(granules) * size * PIXEL
+    south = north - size * PIXEL
+    inlet = size * PIXEL / 4
+    middle = (north + south) / 2
+    ring = [(west, north), (east, north), (east, south), (west, south), (west, middle - inlet / 2),
+            (west + inlet, middle), (west, middle + inlet / 2), (west, north)]
+
+    schema = {'geometry': 'Polygon', 'properties': {'name': 'str'}}
+    with fiona.open(path, 'w', driver='ESRI Shapefile', crs='EPSG:27700', schema=schema) as dst:
+        dst.write({'geometry': {'type': 'Polygon', 'coordinates': [ring]}, 'properties': {'name': 'land'}})
+
+
+def makearchive(root, granules, dates, size, burns=5, cloudfraction=0.2, compress=None, seed=0):
+    '''
+    Builds the synthetic archive under root, plus a land mask at <root>/landmask/synth_landonly.shp
+
+    Return:
+    List of the image paths written
+
+    Keyword arguments:
+    root -- archive root (the equivalent of /neodc/sentinel_ard/data/sentinel_2)
+    granules -- list of granule IDs
+    dates -- list of acquisition dates as yyyymmdd
+    size -- granule width and height in pixels (10980 for a full granule)
+    burns -- number of burn patches injected per granule
+    cloudfraction -- approximate cloud cover of each image
+    compress -- GDAL compression for the images (None for uncompressed)
+    seed -- random seed
+    '''
+    rng = np.random.default_rng(seed)
+    dates = sorted(dates)
+    written = []
+
+    for g, granule in enumerate(granules):
+        transform = granuletransform(g, size)
+        orbit = 'ORB{0:03d}'.format(int(rng.integers(1, 143)))
+        burnt = blobs(size, burns, max(2, size // 200), max(3, size // 50), rng)
+        # burns happen part way through the date range
+        burndate = dates[len(dates) // 2]
+
+        for d, date in enumerate(dates):
+            sensor = 'S2A' if d % 2 == 0 else 'S2B'
+            folder = os.path.join(root, date[0:4], date[4:6], date[6:8])
+            os.makedirs(folder, exist_ok=True)
+
+            imagepath = os.path.join(folder, ardname(sensor, date, granule, orbit, 'vmsk_sharp_rad_srefdem_stdsref'))
+            writeimage(imagepath, transform, size, burnt if date >= burndate else np.zeros_like(burnt), rng, compress)
+            writeclouds(os.path.join(folder, ardname(sensor, date, granule, orbit, 'clouds')), transform, size, cloudfraction, rng)
+            written.append(imagepath)
+
+    os.makedirs(os.path.join(root, 'landmask'), exist_ok=True)
+    writelandmask(os.path.join(root, 'landmask', 'synth_landonly.shp'), granules, size)
+    return written
+
+
+def datesequence(start, count, step=3):
+    '''
+    Creates a list of acquisition dates
+
+    Return:
+    List of dates as yyyymmdd
+
+    Keyword arguments:
+    start -- first date as yyyymmdd
+    count -- number of dates
+    step -- days between acquisitions
+    '''
+    first = datetime.datetime.strptime(start, '%Y%m%d')
+    return [(first + datetime.timedelta(days=step * i)).strftime('%Y%m%d') for i in range(count)]
+
+
+# ======================================================================
+# ========================== MAIN CODE ======================================
+# ======================================================================
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Generate a synthetic Sentinel 2 ARD archive and land mask')
+    parser.add_argument('root', help='archive root folder')
+    parser.add_argument('--granules', nargs='+', default=['T30VVJ', 'T30VVK'], help='granule IDs')
+    parser.add_argument('--dates', nargs='+', default=None, help='acquisition dates as yyyymmdd (default: --count dates from 20190401)')
+    parser.add_argument('--count', type=int, default=4, help='number of dates when --dates is not given')
+    parser.add_argument('--size', type=int, default=1000, help='granule size in pixels (10980 for a full granule)')
+    parser.add_argument('--burns', type=int, default=5, help='burn patches per granule')
+    parser.add_argument('--clouds', type=float, default=0.2, help='approximate cloud fraction per image')
+    parser.add_argument('--compress', default=None, help='GDAL compression for the images')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    args = parser.parse_args()
+
+    dates = args.dates if args.dates is not None else datesequence('20190401', args.count)
+    images = makearchive(args.root, args.granules, dates, args.size, args.burns, args.clouds, args.compress, args.seed)
+    print('Written', len(images), 'images to', args.root)
@@ -0,0 +1,380 @@
+"""
+Summary:
+Indexed queries of the burn outputs of a run by area, date and granule.
+
+Description:
+Finding the burns for an estate or a date window means globbing the output directory for the pair outputs and opening each
+one. Instead the outputs are indexed in a SQLite database (burnindex.sqlite in the output directory) with R*Tree indexes in
+three dimensions (easting, northing and date):
+
+    pairs       one row per completed pair: granule, image dates and the burn raster and shapefile of the pair
+    pairindex   extent of the burn raster of each pair and the dates of its pre-fire and post-fire images
+    burns       each burn polygon of each pair (WKB) and its area
+    burnindex   bounding box of each burn polygon and the dates of the images of its pair
+
+A burn is dated by the interval between the pre-fire and post-fire images of its pair, so a date range matches every burn that
+could have happened within it. The index is built from the pair completion records (checkpoint.py): updateindex only reads
+the records and outputs of pairs completed (or reprocessed) since the last update, and drops pairs whose records have gone.
+It is updated at the end of each single run and planner run (config.BURN_INDEX = 'on'), and before each query from the
+command line, so queries only touch the outputs they return.
+
+Areas are given in the CRS of the outputs (EPSG:27700) as a bounding box (left, bottom, right, top), a GeoJSON like geometry
+or a shapely geometry. Dates are given as YYYYMMDD and are inclusive.
+
+Usage:
+python burnquery.py /gws/nopw/j04/jncc_muirburn/users/output --bbox 250000 750000 260000 760000 --start 20190301 --end 20190430
+python burnquery.py /gws/nopw/j04/jncc_muirburn/users/output --polygon estate.shp --granules T30VVJ --output estateburns.gpkg
+
+From Python:
+with burnquery.BurnIndex(od) as index:
+    burns = index.polygons(area=(250000, 750000, 260000, 760000), start='20190301', end='20190430')
+    for window in index.windows(area=estate, granules=['T30VVJ']): ...
+
+"""
+
+# --- Imports ---
+import argparse
+import datetime
+import logging
+import os
+import sqlite3
+
+import fiona
+import geopandas as gpd
+import numpy as np
+import rasterio
+from rasterio.features import geometry_mask
+from rasterio.windows import from_bounds
+from shapely import wkb
+from shapely.geometry import box, shape
+from shapely.geometry.base import BaseGeometry
+from shapely.ops import unary_union
+from shapely.prepared import prep
+
+from checkpoint import COMPLETED
+from workqueue import readjson
+
+
+# --- Constants ---
+INDEXNAME = 'burnindex.sqlite'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS pairs (id INTEGER PRIMARY KEY, pair TEXT UNIQUE, granule TEXT, predate TEXT, postdate TEXT,
+                                  raster TEXT, vector TEXT, crs TEXT, recordtime INTEGER);
+CREATE INDEX IF NOT EXISTS pairs_granule ON pairs (granule);
+CREATE VIRTUAL TABLE IF NOT EXISTS pairindex USING rtree (id, minx, maxx, miny, maxy, mindate, maxdate);
+CREATE TABLE IF NOT EXISTS burns (id INTEGER PRIMARY KEY, pairid INTEGER, area REAL, geometry BLOB);
+CREATE INDEX IF NOT EXISTS burns_pair ON burns (pairid);
+CREATE VIRTUAL TABLE IF NOT EXISTS burnindex USING rtree (id, minx, maxx, miny, maxy, mindate, maxdate);
+'''
+
+
+# --- Functions ---
+def daynumber(date):
+    '''
+    Converts a date to the number held in the date dimension of the index
+
+    Return:
+    Proleptic Gregorian ordinal of the date
+
+    Keyword arguments:
+    date -- date as YYYYMMDD
+    '''
+    return datetime.datetime.strptime(date, '%Y%m%d').toordinal()
+
+
+def areageometry(area):
+    '''
+    Converts a query area to a shapely geometry
+
+    Return:
+    Shapely geometry, or None for no area
+
+    Keyword arguments:
+    area -- None, bounding box (left, bottom, right, top), GeoJSON like geometry or shapely geometry
+    '''
+    if area is None or isinstance(area, BaseGeometry):
+        return area
+    if isinstance(area, dict):
+        return shape(area)
+    return box(*area)
+
+
+def pairraster(outputs):
+    '''
+    Finds the burn raster and shapefile of a pair among its outputs
+
+    Return:
+    Name of the burn raster (burnarea or burnclass) and name of the shapefile (None if not written)
+
+    Keyword arguments:
+    outputs -- names of the output files of the pair (from its completion record)
+    '''
+    raster = [o for o in outputs if o.endswith('_burnclass.tif') or o.endswith('_burnarea.tif')]
+    vector = [o for o in outputs if o.endswith('.shp')]
+    return (raster[0] if raster else None), (vector[0] if vector else None)
+
+
+# --- Classes ---
+class BurnIndex:
+    '''
+    Spatial and temporal index of the burn outputs of a run, with queries by area, date range and granule
+    '''
+    def __init__(self, od, indexpath=None, update=True):
+        self.od = od
+        self.path = indexpath if indexpath is not None else os.path.join(od, INDEXNAME)
+        self.db = sqlite3.connect(self.path)
+        self.db.row_factory = sqlite3.Row
+        self.db.executescript(SCHEMA)
+        if update:
+            self.updateindex()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        '''
+        Closes the index database
+
+        Return:
+        NA
+        '''
+        self.db.close()
+
+    def updateindex(self):
+        '''
+        Brings the index up to date with the pair completion records: pairs completed or reprocessed since the last update are
+        (re)indexed and pairs without a record are removed. Only the records and outputs of those pairs are read.
+
+        Return:
+        Number of pairs indexed and number removed
+        '''
+        folder = os.path.join(self.od, COMPLETED)
+        current = {}
+        if os.path.isdir(folder):
+            for item in os.scandir(folder):
+                if item.name.endswith('.json'):
+                    current[item.name[:-len('.json')]] = item.stat().st_mtime_ns
+        indexed = {row['pair']: (row['id'], row['recordtime']) for row in self.db.execute('SELECT id, pair, recordtime FROM pairs')}
+
+        added, removed = 0, 0
+        with self.db:
+            for pair, (pairid, recordtime) in indexed.items():
+                if current.get(pair) != recordtime:
+                    self.removepair(pairid)
+                    removed += pair not in current
+            for pair, recordtime in sorted(current.items()):
+                if pair in indexed and indexed[pair][1] == recordtime:
+                    continue
+                try:
+                    record = readjson(os.path.join(folder, pair + '.json'))
+                except ValueError:
+                    logging.warning('Unreadable completion record, not indexed: ' + pair)
+                    continue
+                added += self.addpair(record, recordtime)
+        logging.debug('Burn index updated: ' + str(added) + ' pairs indexed, ' + str(removed) + ' removed')
+        return added, removed
+
+    def removepair(self, pairid):
+        '''
+        Removes a pair and its burn polygons from the index
+
+        Return:
+        NA
+
+        Keyword arguments:
+        pairid -- row id of the pair
+        '''
+        burnids = [(row[0],) for row in self.db.execute('SELECT id FROM burns WHERE pairid = ?', (pairid,))]
+        self.db.executemany('DELETE FROM burnindex WHERE id = ?', burnids)
+        self.db.execute('DELETE FROM burns WHERE pairid = ?', (pairid,))
+        self.db.execute('DELETE FROM pairindex WHERE id = ?', (pairid,))
+        self.db.execute('DELETE FROM pairs WHERE id = ?', (pairid,))
+
+    def addpair(self, record, recordtime):
+        '''
+        Indexes a completed pair: the extent of its burn raster and each polygon of its shapefile
+
+        Return:
+        1 if the pair was indexed, 0 if its burn raster is missing
+
+        Keyword arguments:
+        record -- completion record of the pair
+        recordtime -- modification time of the record (ns)
+        '''
+        raster, vector = pairraster(record['outputs'])
+        if raster is None or not os.path.isfile(os.path.join(self.od, raster)):
+            logging.warning('Burn raster missing, pair not indexed: ' + record['pair'])
+            return 0
+        with rasterio.open(os.path.join(self.od, raster)) as dataset:
+            bounds = dataset.bounds
+            crs = dataset.crs.to_wkt() if dataset.crs else None
+
+        dates = (daynumber(record['predate']), daynumber(record['postdate']))
+        cursor = self.db.execute('INSERT INTO pairs (pair, granule, predate, postdate, raster, vector, crs, recordtime) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                 (record['pair'], record['granule'], record['predate'], record['postdate'], raster, vector, crs, recordtime))
+        pairid = cursor.lastrowid
+        self.db.execute('INSERT INTO pairindex VALUES (?, ?, ?, ?, ?, ?, ?)',
+                        (pairid, bounds.left, bounds.right, bounds.bottom, bounds.top) + dates)
+
+        if vector is None or not os.path.isfile(os.path.join(self.od, vector)):
+            return 1
+        with fiona.open(os.path.join(self.od, vector)) as features:
+            for feature in features:
+                if feature['geometry'] is None:
+                    continue
+                geometry = shape(feature['geometry'])
+                cursor = self.db.execute('INSERT INTO burns (pairid, area, geometry) VALUES (?, ?, ?)', (pairid, geometry.area, geometry.wkb))
+                minx, miny, maxx, maxy = geometry.bounds
+                self.db.execute('INSERT INTO burnindex VALUES (?, ?, ?, ?, ?, ?, ?)', (cursor.lastrowid, minx, maxx, miny, maxy) + dates)
+        return 1
+
+    def search(self, table, area=None, start=None, end=None, granules=None):
+        '''
+        Finds the rows of an R*Tree index whose bounding box and date interval overlap the query
+
+        Return:
+        List of rows holding the pair columns (and the burn columns when searching burnindex)
+
+        Keyword arguments:
+        table -- 'pairindex' or 'burnindex'
+        area -- shapely geometry of the query area, or None for anywhere
+        start -- first date of the query as YYYYMMDD, or None
+        end -- last date of the query as YYYYMMDD, or None
+        granules -- granule names to limit the query to, or None for all
+        '''
+        conditions, values = [], []
+        if area is not None:
+            minx, miny, maxx, maxy = area.bounds
+            conditions.append('i.maxx >= ? AND i.minx <= ? AND i.maxy >= ? AND i.miny <= ?')
+            values.extend([minx, maxx, miny, maxy])
+        if start is not None:
+            conditions.append('i.maxdate >= ?')
+            values.append(daynumber(start))
+        if end is not None:
+            conditions.append('i.mindate <= ?')
+            values.append(daynumber(end))
+        if granules:
+            conditions.append('p.granule IN (' + ', '.join('?' * len(granules)) + ')')
+            values.extend(granules)
+
+        if table == 'burnindex':
+            sql = 'SELECT p.*, b.id AS burnid, b.area, b.geometry FROM burnindex i JOIN burns b ON b.id = i.id JOIN pairs p ON p.id = b.pairid'
+        else:
+            sql = 'SELECT p.* FROM pairindex i JOIN pairs p ON p.id = i.id'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        return self.db.execute(sql + ' ORDER BY p.postdate, p.pair', values).fetchall()
+
+    def pairs(self, area=None, start=None, end=None, granules=None):
+        '''
+        Finds the pairs whose burn raster overlaps the area and whose image dates overlap the date range
+
+        Return:
+        List of dictionaries of the pair, granule, pre-fire and post-fire dates and output paths
+
+        Keyword arguments:
+        area -- query area (see areageometry), or None for anywhere
+        start -- first date as YYYYMMDD, or None
+        end -- last date as YYYYMMDD, or None
+        granules -- granule names, or None for all
+        '''
+        rows = self.search('pairindex', areageometry(area), start, end, granules)
+        return [{'pair': r['pair'], 'granule': r['granule'], 'predate': r['predate'], 'postdate': r['postdate'],
+                 'raster': os.path.join(self.od, r['raster']), 'vector': os.path.join(self.od, r['vector']) if r['vector'] else None}
+                for r in rows]
+
+    def polygons(self, area=None, start=None, end=None, granules=None):
+        '''
+        Finds the burn polygons that intersect the area, from pairs whose image dates overlap the date range
+
+        Return:
+        GeoDataFrame of the polygons with the pair, granule, pre-fire and post-fire dates and area (m2) of each
+
+        Keyword arguments:
+        area -- query area (see areageometry), or None for anywhere
+        start -- first date as YYYYMMDD, or None
+        end -- last date as YYYYMMDD, or None
+        granules -- granule names, or None for all
+        '''
+        geometry = areageometry(area)
+        prepared = prep(geometry) if geometry is not None else None
+        columns = {'pair': [], 'granule': [], 'predate': [], 'postdate': [], 'area': [], 'geometry': []}
+        crs = None
+        for row in self.search('burnindex', geometry, start, end, granules):
+            polygon = wkb.loads(row['geometry'])
+            if prepared is not None and not prepared.intersects(polygon):
+                continue
+            for name in ['pair', 'granule', 'predate', 'postdate', 'area']:
+                columns[name].append(row[name])
+            columns['geometry'].append(polygon)
+            crs = crs or row['crs']
+        return gpd.GeoDataFrame(columns, geometry='geometry', crs=crs)
+
+    def windows(self, area, start=None, end=None, granules=None):
+        '''
+        Reads the burn area of each matching pair over the bounding box of the area. Pixels outside the area are set to 0 when
+        the area is not a box.
+
+        Return:
+        List of dictionaries of the pair, granule, dates, burned array (uint8, 1 = burned), transform and CRS of each window
+
+        Keyword arguments:
+        area -- query area (see areageometry)
+        start -- first date as YYYYMMDD, or None
+        end -- last date as YYYYMMDD, or None
+        granules -- granule names, or None for all
+        '''
+        geometry = areageometry(area)
+        windows = []
+        for found in self.pairs(geometry, start, end, granules):
+            with rasterio.open(found['raster']) as dataset:
+                left, bottom, right, top = geometry.bounds
+                window = from_bounds(max(left, dataset.bounds.left), max(bottom, dataset.bounds.bottom),
+                                     min(right, dataset.bounds.right), min(top, dataset.bounds.top), dataset.transform)
+                window = window.round_offsets().round_lengths()
+                if window.width < 1 or window.height < 1:
+                    continue
+                burned = dataset.read(1, window=window) & 1
+                transform = dataset.window_transform(window)
+                crs = dataset.crs
+            if not geometry.equals(box(*geometry.bounds)):
+                burned[geometry_mask([geometry], out_shape=burned.shape, transform=transform)] = 0
+            found.update({'burned': burned.astype(np.uint8, copy=False), 'transform': transform, 'crs': crs})
+            windows.append(found)
+        return windows
+
+
+# --- Command line ---
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Query the burn outputs of a run by area, date range and granule')
+    parser.add_argument('od', help='output directory of the run')
+    # an area is given by one or the other, so a query with both is rejected rather than answered for one of them
+    areas = parser.add_mutually_exclusive_group()
+    areas.add_argument('--bbox', nargs=4, type=float, metavar=('LEFT', 'BOTTOM', 'RIGHT', 'TOP'), help='bounding box (EPSG:27700)')
+    areas.add_argument('--polygon', default=None, help='vector file of the area (all features, EPSG:27700)')
+    parser.add_argument('--start', default=None, help='first date (YYYYMMDD)')
+    parser.add_argument('--end', default=None, help='last date (YYYYMMDD)')
+    parser.add_argument('--granules', nargs='+', default=None, help='granule names')
+    parser.add_argument('--output', default=None, help='vector file to write the burn polygons to (e.g. burns.gpkg)')
+    args = parser.parse_args()
+
+    area = box(*args.bbox) if args.bbox else None
+    if args.polygon:
+        with fiona.open(args.polygon) as features:
+            area = unary_union([shape(f['geometry']) for f in features if f['geometry'] is not None])
+
+    with BurnIndex(args.od) as index:
+        found = index.pairs(area, args.start, args.end, args.granules)
+        burns = index.polygons(area, args.start, args.end, args.granules)
+
+    print('Pairs: ', len(found))
+    for pair in found:
+        print(' ', pair['predate'], pair['postdate'], pair['granule'], pair['pair'])
+    print('Burn polygons: ', len(burns), ' Area (ha): ', round(burns['area'].sum() / 10000, 2) if len(burns) else 0)
+    if args.output and len(burns):
+        burns.to_file(args.output)
+        print('Written to', args.output)
@@ -0,0 +1,179 @@
+"""
+This module contains the carried over pre-fire indices used when calculating burn locations in Scotland
+(config.CARRY_OVER = 'on').
+
+The latest image of each granule is left out of the processed image list so that it is used again as the pre-fire image of
+the first pair of the next run. Without a carry over that means reading, land cropping and cloud masking the whole image
+again, although only its NBR2 and SAVI are used in the pair. Instead, when the latest image of a granule is read, its NBR2
+and SAVI (land cropped and cloud masked, as used in the pair) are written to the carryover folder of the output directory:
+
+    <granule>_carry.tif   2 band Float32 GeoTIFF (NBR2, SAVI) on the land cropped grid, deflate compressed
+    <granule>_carry.json  name of the image and identity of everything the values depend on
+
+The next run uses them for the first pair of the granule instead of reading the image, as long as the image name, the size
+and modification time of the image, its cloud mask and the land mask, and the code version all match. The values are stored
+at full precision, so the outputs are identical to those from reading the image again. Only one image is held per granule.
+
+The latest image is read in the first pair of the chain but the carry over of the last run is only used in the last pair, so
+the new carry over is written under a pending name (<granule>_carry_pending.tif/.json) and only replaces the old one once the
+whole chain has been processed (commitcarry).
+
+"""
+
+# --- Imports ---
+import logging
+import os
+import socket
+
+import numpy as np
+import rasterio
+
+from workqueue import readjson, writejson
+
+
+# --- Constants ---
+CARRYOVER = 'carryover'
+
+
+# --- Functions ---
+def carrypath(od, granule, pending=False):
+    '''
+    Builds the path of the carried over index raster of a granule
+
+    Return:
+    Path to the raster
+
+    Keyword arguments:
+    od -- output directory
+    granule -- granule name (e.g. T30VVJ)
+    pending -- path of the carry over written in this run and not yet committed
+    '''
+    return os.path.join(od, CARRYOVER, granule + ('_carry_pending.tif' if pending else '_carry.tif'))
+
+
+def carryvalid(od, granule, imagename, identity):
+    '''
+    Checks whether the carry over of a granule holds the indices of an image, for the same inputs and code version
+
+    Return:
+    True if the carried over indices can be used
+
+    Keyword arguments:
+    od -- output directory
+    granule -- granule name
+    imagename -- name of the image
+    identity -- identity of the image inputs and code version for this run
+    '''
+    path = carrypath(od, granule)
+    if not os.path.isfile(path) or not os.path.isfile(path[:-len('.tif')] + '.json'):
+        return False
+    try:
+        record = readjson(path[:-len('.tif')] + '.json')
+    except ValueError:
+        logging.warning('Unreadable carry over record: ' + granule)
+        return False
+    return record.get('image') == imagename and record.get('identity') == identity
+
+
+def readcarry(od, granule, imagename, identity):
+    '''
+    Reads the carried over indices of an image, if they are valid for this run
+
+    Return:
+    Dictionary of the nbr2 and savi arrays and the profile of the land cropped image, or None, None
+
+    Keyword arguments:
+    od -- output directory
+    granule -- granule name
+    imagename -- name of the image
+    identity -- identity of the image inputs and code version for this run
+    '''
+    if not carryvalid(od, granule, imagename, identity):
+        return None, None
+    with rasterio.open(carrypath(od, granule)) as dataset:
+        indices = {'nbr2': dataset.read(1), 'savi': dataset.read(2)}
+        profile = dataset.profile.copy()
+
+    # the profile of the image itself, rather than that of the carry over raster
+    original = readjson(carrypath(od, granule)[:-len('.tif')] + '.json')['profile']
+    for key in ['count', 'dtype', 'nodata', 'compress', 'predictor', 'tiled', 'blockxsize', 'blockysize']:
+        profile.pop(key, None)
+    profile.update(original)
+    logging.debug('Carried over indices read: ' + imagename)
+    return indices, profile
+
+
+def writecarry(od, granule, imagename, nbr2, savi, profile, identity):
+    '''
+    Writes the indices of the latest image of a granule for the next run, under the pending name (see commitcarry). The raster and its record are
+    written to temporary files and renamed, and the old pending record is removed first, so a half written carry over is never committed.
+
+    Return:
+    NA
+
+    Keyword arguments:
+    od -- output directory
+    granule -- granule name
+    imagename -- name of the image
+    nbr2 -- NBR2 of the image
+    savi -- SAVI of the image
+    profile -- profile of the land cropped image
+    identity -- identity of the image inputs and code version
+    '''
+    os.makedirs(os.path.join(od, CARRYOVER), exist_ok=True)
+    path = carrypath(od, granule, pending=True)
+    recordpath = path[:-len('.tif')] + '.json'
+    if os.path.isfile(recordpath):
+        os.remove(recordpath)
+
+    # the settings changed for the carry over raster are recorded, so the profile of the image can be given back
+    settings = {'driver': 'GTiff', 'count': 2, 'dtype': rasterio.float32, 'nodata': None, 'compress': 'deflate',
+                'predictor': 3, 'tiled': True, 'blockxsize': 256, 'blockysize': 256}
+    original = {k: profile[k] for k in settings if k in profile}
+    profile = profile.copy()
+    profile.update(settings)
+    temppath = path + '.' + socket.gethostname() + '.' + str(os.getpid()) + '.tmp.tif'
+    with rasterio.open(temppath, 'w', **profile) as dest:
+        dest.write(nbr2.astype(np.float32, copy=False), 1)
+        dest.write(savi.astype(np.float32, copy=False), 2)
+        dest.set_band_description(1, 'nbr2')
+        dest.set_band_description(2, 'savi')
+    os.replace(temppath, path)
+    writejson(recordpath, {'image': imagename, 'granule': granule, 'identity': identity, 'profile': original})
+    logging.debug('Carry over written: ' + imagename)
+
+
+def commitcarry(od, granule, imagename):
+    '''
+    Replaces the carry over of a granule with the one written in this run, once the carry over of the last run is no longer needed.
+    The old record is removed first and the new record is moved into place last, so a half committed carry over is never used.
+
+    Return:
+    True if a pending carry over of the image was committed
+
+    Keyword arguments:
+    od -- output directory
+    granule -- granule name
+    imagename -- name of the latest image of the granule in this run
+    '''
+    pendingpath = carrypath(od, granule, pending=True)
+    pendingrecord = pendingpath[:-len('.tif')] + '.json'
+    if not os.path.isfile(pendingpath) or not os.path.isfile(pendingrecord):
+        return False
+    try:
+        record = readjson(pendingrecord)
+    except ValueError:
+        record = {}
+    if record.get('image') != imagename:
+        # left by an interrupted run for another image
+        logging.debug('Pending carry over not committed, written for ' + str(record.get('image')))
+        return False
+
+    path = carrypath(od, granule)
+    recordpath = path[:-len('.tif')] + '.json'
+    if os.path.isfile(recordpath):
+        os.remove(recordpath)
+    os.replace(pendingpath, path)
+    os.replace(pendingrecord, recordpath)
+    logging.debug('Carry over committed: ' + imagename)
+    return True
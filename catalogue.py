@@ -0,0 +1,282 @@
+"""
+This module contains the catalogue of image metadata used when calculating burn locations in Scotland.
+
+The crawl only knows the name and size of each ARD image, so any decision about its extent, grid, nodata or valid data area
+means opening the raster. The first time an image is opened (by pre/post) its metadata is written to a small JSON record in
+the catalogue folder of the output directory: the profile (driver, data type, nodata, size, band count, CRS, transform and
+block size), the bounds and a valid data footprint. The footprint is traced from a decimated read of the mask of the first
+band, so it costs one small read. Planning and pre-screening then use the records without opening the rasters again.
+
+The footprints also give a cheap estimate of how much of the land in a granule an image (or a pair of images) has valid data
+for, which is used to screen out images and pairs that would produce nothing (config.IMAGE_SCREEN = 'coverage'). With the cloud
+pre-screen on, the reduced resolution clear land mask of each image is kept in its record as well (one bit per pixel), so the
+cloud cover of a pair is worked out from the records without reading either cloud mask again.
+
+A record holds the size and modification time of the file it describes and is only used while they match, so an image that is
+reprocessed in the archive is catalogued again the next time it is opened. Records are written atomically, so workers sharing
+an output directory can catalogue images at the same time.
+
+"""
+
+# --- Imports ---
+import base64
+import datetime
+import logging
+import math
+import os
+
+import numpy as np
+import rasterio
+from rasterio.crs import CRS
+from rasterio.features import geometry_mask, shapes
+from rasterio.transform import Affine
+from shapely.geometry import box, shape
+from shapely.ops import unary_union
+
+from checkpoint import fileidentity
+from workqueue import readjson, writejson
+
+
+# --- Constants ---
+CATALOGUE = 'catalogue'
+
+
+# --- Functions ---
+def entrypath(od, source):
+    '''
+    Builds the path of the catalogue record of a file
+
+    Return:
+    Path to the record
+
+    Keyword arguments:
+    od -- output directory
+    source -- path of the file in the archive
+    '''
+    return os.path.join(od, CATALOGUE, os.path.basename(source) + '.json')
+
+
+def lookup(od, source):
+    '''
+    Reads the catalogue record of a file, if there is one for the current version of the file
+
+    Return:
+    The record, or None if the file is not catalogued (or has changed since)
+
+    Keyword arguments:
+    od -- output directory
+    source -- path of the file in the archive
+    '''
+    path = entrypath(od, source)
+    if not os.path.isfile(path):
+        return None
+    try:
+        record = readjson(path)
+    except ValueError:
+        logging.warning('Unreadable catalogue record: ' + path)
+        return None
+    if record.get('identity') != fileidentity(source):
+        logging.debug('File changed since it was catalogued: ' + source)
+        return None
+    return record
+
+
+def footprint(dataset, decimation):
+    '''
+    Traces the valid data area of a raster from a decimated read of the mask of its first band
+
+    Return:
+    GeoJSON MultiPolygon of the valid data area (in the raster CRS) and the fraction of the raster that is valid
+
+    Keyword arguments:
+    dataset -- open rasterio dataset
+    decimation -- factor the mask is reduced by in each direction
+    '''
+    height, width = math.ceil(dataset.height / decimation), math.ceil(dataset.width / decimation)
+    valid = dataset.read_masks(1, out_shape=(height, width)) > 0
+    transform = dataset.transform * Affine.scale(dataset.width / width, dataset.height / height)
+
+    polygons = [geometry['coordinates'] for geometry, value in shapes(valid.astype(rasterio.uint8), mask=valid, transform=transform)]
+    return {'type': 'MultiPolygon', 'coordinates': polygons}, float(np.count_nonzero(valid)) / valid.size
+
+
+def describe(dataset, decimation=16):
+    '''
+    Builds the catalogue metadata of an open raster
+
+    Return:
+    Dictionary of the raster metadata
+
+    Keyword arguments:
+    dataset -- open rasterio dataset
+    decimation -- factor the mask is reduced by when tracing the footprint
+    '''
+    shape, validfraction = footprint(dataset, decimation)
+    blocky, blockx = dataset.block_shapes[0]
+    return {'driver': dataset.driver, 'dtype': dataset.dtypes[0], 'nodata': dataset.nodata, 'count': dataset.count,
+            'width': dataset.width, 'height': dataset.height, 'crs': dataset.crs.to_wkt() if dataset.crs else None,
+            'transform': list(dataset.transform)[:6], 'bounds': list(dataset.bounds), 'blockxsize': blockx, 'blockysize': blocky,
+            'footprint': shape, 'validfraction': validfraction, 'decimation': decimation}
+
+
+def recordimage(od, source, dataset, decimation=16):
+    '''
+    Writes the catalogue record of a file from its open dataset. The record is written to a temporary file and renamed, so a record is either complete or absent.
+
+    Return:
+    The record
+
+    Keyword arguments:
+    od -- output directory
+    source -- path of the file in the archive (the dataset may be opened from a local copy)
+    dataset -- open rasterio dataset of the file
+    decimation -- factor the mask is reduced by when tracing the footprint
+    '''
+    os.makedirs(os.path.join(od, CATALOGUE), exist_ok=True)
+    record = {'name': os.path.basename(source), 'identity': fileidentity(source)}
+    record.update(describe(dataset, decimation))
+    record['catalogued'] = datetime.datetime.now().isoformat(timespec='seconds')
+    writejson(entrypath(od, source), record)
+    logging.debug('Catalogued ' + source)
+    return record
+
+
+def updaterecord(od, source, record):
+    '''
+    Writes back a catalogue record with added values (e.g. a cached coverage estimate)
+
+    Return:
+    NA
+
+    Keyword arguments:
+    od -- output directory
+    source -- path of the file in the archive
+    record -- catalogue record
+    '''
+    writejson(entrypath(od, source), record)
+
+
+def metadata(od, source, decimation=16):
+    '''
+    Gets the catalogue record of a file, opening the file and cataloguing it only if it has no up to date record
+
+    Return:
+    The record
+
+    Keyword arguments:
+    od -- output directory
+    source -- path of the file in the archive
+    decimation -- factor the mask is reduced by when tracing the footprint
+    '''
+    record = lookup(od, source)
+    if record is None:
+        with rasterio.open(source) as dataset:
+            record = recordimage(od, source, dataset, decimation)
+    return record
+
+
+def profile(record):
+    '''
+    Rebuilds a rasterio profile from a catalogue record
+
+    Return:
+    Profile dictionary
+
+    Keyword arguments:
+    record -- catalogue record
+    '''
+    return {'driver': record['driver'], 'dtype': record['dtype'], 'nodata': record['nodata'], 'count': record['count'],
+            'width': record['width'], 'height': record['height'],
+            'crs': CRS.from_wkt(record['crs']) if record['crs'] else None, 'transform': Affine(*record['transform']),
+            'blockxsize': record['blockxsize'], 'blockysize': record['blockysize']}
+
+
+def landclip(landmask, bounds):
+    '''
+    Clips the land mask polygons to the bounds of a granule
+
+    Return:
+    Shapely geometry of the land within the bounds
+
+    Keyword arguments:
+    landmask -- land mask polygons (GeoJSON like geometries, in the CRS of the images)
+    bounds -- (left, bottom, right, top) of the granule
+    '''
+    extent = box(*bounds)
+    parts = []
+    for geometry in landmask:
+        polygon = shape(geometry)
+        if polygon.intersects(extent):
+            parts.append(polygon.intersection(extent))
+    return unary_union(parts)
+
+
+def landcoverage(records, land):
+    '''
+    Estimates the fraction of the land in a granule that has valid data in all of the given images, from their footprints
+
+    Return:
+    Fraction of the land area (0 if there is no land in the granule)
+
+    Keyword arguments:
+    records -- catalogue records of the images
+    land -- land within the granule (from landclip)
+    '''
+    if land.is_empty or land.area == 0:
+        return 0.0
+    valid = land
+    for record in records:
+        valid = valid.intersection(shape(record['footprint']))
+    return valid.area / land.area
+
+
+def clearland(cloudsource, land, decimation=16):
+    '''
+    Reads a cloud mask at reduced resolution and finds the land pixels that are clear of cloud (cloud mask values below 1, as in getcloudmask)
+
+    Return:
+    Boolean array of the clear land pixels and boolean array of the land pixels, on the reduced grid
+
+    Keyword arguments:
+    cloudsource -- path of the cloud mask
+    land -- land within the granule (from landclip)
+    decimation -- factor the cloud mask is reduced by in each direction
+    '''
+    with rasterio.open(cloudsource) as dataset:
+        height, width = math.ceil(dataset.height / decimation), math.ceil(dataset.width / decimation)
+        clouds = dataset.read(1, out_shape=(height, width))
+        transform = dataset.transform * Affine.scale(dataset.width / width, dataset.height / height)
+
+    if land.is_empty:
+        landpixels = np.zeros((height, width), dtype=bool)
+    else:
+        landpixels = geometry_mask([land], out_shape=(height, width), transform=transform, invert=True)
+    return (clouds < 1) & landpixels, landpixels
+
+
+def packmask(mask):
+    '''
+    Packs a boolean array into a JSON serialisable form (one bit per pixel), so a reduced resolution mask can be kept in a record
+
+    Return:
+    Dictionary of the shape and the base64 encoded bits of the array
+
+    Keyword arguments:
+    mask -- boolean array
+    '''
+    return {'shape': list(mask.shape), 'bits': base64.b64encode(np.packbits(mask).tobytes()).decode('ascii')}
+
+
+def unpackmask(packed):
+    '''
+    Unpacks a boolean array packed by packmask
+
+    Return:
+    Boolean array
+
+    Keyword arguments:
+    packed -- dictionary from packmask
+    '''
+    bits = np.frombuffer(base64.b64decode(packed['bits']), dtype=np.uint8)
+    count = packed['shape'][0] * packed['shape'][1]
+    return np.unpackbits(bits, count=count).astype(bool).reshape(packed['shape'])
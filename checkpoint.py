@@ -0,0 +1,155 @@
+"""
+This module contains the per pair completion records used to make runs crash safe.
+
+As soon as the outputs of an image pair have been written, a small JSON record for the pair is written atomically to the
+completed folder of the output directory. A run that is restarted after a crash, walltime kill or lost lease skips every pair
+that has a record without reading its images, so it carries on from the pair after the last one completed in each granule.
+
+Each record also holds a fingerprint of everything the outputs depend on: the identity of the two ARD images and their cloud
+masks (size and modification time, or a checksum), the threshold values and the code version. A pair is only skipped if the
+fingerprint is unchanged and all of its outputs are present, so reprocessed ARD or new thresholds invalidate exactly the pairs
+they affect.
+
+"""
+
+# --- Imports ---
+import datetime
+import hashlib
+import logging
+import os
+
+from workqueue import readjson, writejson
+
+
+# --- Constants ---
+COMPLETED = 'completed'
+
+
+# --- Functions ---
+def recordpath(od, pair):
+    '''
+    Builds the path of the completion record of a pair
+
+    Return:
+    Path to the record
+
+    Keyword arguments:
+    od -- output directory
+    pair -- output base name of the pair
+    '''
+    return os.path.join(od, COMPLETED, pair + '.json')
+
+
+def fileidentity(path, checksum=False):
+    '''
+    Identifies the version of an input file by its size and modification time, or by a SHA-1 checksum of its contents
+    (which needs a full read of the file)
+
+    Return:
+    Dictionary describing the file
+
+    Keyword arguments:
+    path -- path to the file
+    checksum -- use a checksum rather than size and modification time
+    '''
+    stat = os.stat(path)
+    identity = {'size': stat.st_size}
+    if checksum:
+        sha = hashlib.sha1()
+        with open(path, 'rb') as infile:
+            for block in iter(lambda: infile.read(16 * 1024 * 1024), b''):
+                sha.update(block)
+        identity['sha1'] = sha.hexdigest()
+    else:
+        identity['mtime'] = stat.st_mtime_ns
+    return identity
+
+
+def pairdone(od, pair):
+    '''
+    Checks whether a pair has a completion record (whether or not it is up to date)
+
+    Return:
+    True if the pair has a completion record
+
+    Keyword arguments:
+    od -- output directory
+    pair -- output base name of the pair
+    '''
+    return os.path.isfile(recordpath(od, pair))
+
+
+def pairuptodate(od, pair, fingerprint):
+    '''
+    Checks whether a pair has been completed with the same inputs, parameters and code version, and its outputs are still present
+
+    Return:
+    True if the pair can be skipped
+
+    Keyword arguments:
+    od -- output directory
+    pair -- output base name of the pair
+    fingerprint -- fingerprint of the inputs, parameters and code version for this run
+    '''
+    if not pairdone(od, pair):
+        return False
+
+    try:
+        record = readjson(recordpath(od, pair))
+    except ValueError:
+        logging.warning('Unreadable completion record: ' + pair)
+        return False
+
+    if record.get('fingerprint') != fingerprint:
+        logging.debug('Inputs, parameters or code version changed since the pair was processed: ' + pair)
+        return False
+
+    for output in record['outputs']:
+        path = os.path.join(od, output)
+        if not os.path.isfile(path) or os.path.getsize(path) == 0:
+            logging.debug('Output missing: ' + output)
+            return False
+    return True
+
+
+def recordpair(od, pair, prelist, postlist, outputs, fingerprint=None):
+    '''
+    Writes the completion record of a pair. The record is written to a temporary file and renamed, so a record is either complete or absent.
+
+    Return:
+    The record
+
+    Keyword arguments:
+    od -- output directory
+    pair -- output base name of the pair
+    prelist -- pre-burn image details [imagename, imagepath, granule, size, date]
+    postlist -- post-burn image details
+    outputs -- names of the output files written for the pair
+    fingerprint -- fingerprint of the inputs, parameters and code version
+    '''
+    os.makedirs(os.path.join(od, COMPLETED), exist_ok=True)
+    record = {'pair': pair, 'granule': prelist[2], 'pre': prelist[0], 'post': postlist[0],
+              'predate': prelist[4], 'postdate': postlist[4], 'outputs': outputs, 'fingerprint': fingerprint,
+              'completed': datetime.datetime.now().isoformat(timespec='seconds')}
+    writejson(recordpath(od, pair), record)
+    return record
+
+
+def completedpairs(od):
+    '''
+    Reads all the completion records in the output directory
+
+    Return:
+    List of records
+
+    Keyword arguments:
+    od -- output directory
+    '''
+    folder = os.path.join(od, COMPLETED)
+    if not os.path.isdir(folder):
+        return []
+    records = []
+    for name in sorted(os.listdir(folder)):
+        if name.endswith('.json'):
+            records.append(readjson(os.path.join(folder, name)))
+    return records
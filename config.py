@@ -24,8 +24,132 @@ GROW = {'dsaviq1thresh': 0.206748, 'postnbrq1thresh': 0.173447, 'cloudthresh': 0
 # Toggle the file count function on and off. Value can be 'off' or 'on'
 FILECOUNT = 'off'
 
-# Cloud cover threshold (for use in future versions, not called in current code)
-#CLOUD = 0.9 
+# How partial granules are screened out. Value can be 'size' (images of MIN_FILE_SIZE GB or less are not processed) or 'coverage' 
+# (the valid data footprint of each image, traced from a decimated read of one band and cached in the catalogue, is compared with the 
+# land mask: images, and pairs, with valid data in both images for less than MIN_LAND_COVERAGE of the land in the granule are not processed)
+IMAGE_SCREEN = 'coverage'
+MIN_LAND_COVERAGE = 0.2
+
+# Minimum image file size (GB). Smaller files are treated as partial granules and are not processed (IMAGE_SCREEN = 'size' only).
+MIN_FILE_SIZE = 1
+
+# Packing of the burn rasters. Value can be 'off' (byte per pixel burnseed and burnarea files), 'nbits' (1-bit burnseed and burnarea files) 
+# or 'combined' (a single 2-bit burnclass file per pair where bit 0 = burnarea and bit 1 = burnseed)
+PACKED_RASTERS = 'off'
+
+# Intermediate products (float rasters of ~275-350 MB each). Values can be 'off' or 'on'. 
+# Products that are switched on are written by a background thread so that the next pair is not held up.
+INTERMEDIATES = {'postnbr': 'off', 'dnbr2': 'off', 'dsavi': 'off'}
+
+# Maximum number of intermediate products waiting to be written by the background thread (each held in memory until written)
+WRITER_QUEUE = 3
+
+# Toggle per stage memory tracking (RSS and tracemalloc allocation peaks) in the metrics file. Value can be 'off' or 'on'
+# tracemalloc slows allocation heavy code slightly, so leave this off for production runs unless sizing workers
+MEMORY_TRACE = 'off'
+
+# Run mode. Value can be 'single' (crawl and process everything in this process), 'plan' (crawl and write one work unit per granule 
+# chain to QUEUE_DIR), 'work' (claim and process work units from QUEUE_DIR until none are left) or 'dryrun' (crawl and report the 
+# pairs, GB to read and estimated runtime per granule, from the metrics of earlier runs, without opening any rasters). Any number of workers on any 
+# nodes can share one queue as long as QUEUE_DIR and GWS_DATA are on a shared filesystem. Run the planner again to record the 
+# completed units in the processed image list.
+RUN_MODE = 'single'
+QUEUE_DIR = '/gws/nopw/j04/jncc_muirburn/users/queue'
+
+# Seconds without a heartbeat before a claimed unit is returned to the queue, and the number of attempts before a unit is marked as failed
+LEASE_TIMEOUT = 1800
+MAX_ATTEMPTS = 3
+
+# Array engine. Value can be 'numpy' (whole granule arrays held in memory) or 'dask' (bands opened lazily as chunked arrays and 
+# outputs written chunk by chunk, so memory is bounded by the chunk size. Needs dask to be installed)
+ENGINE = 'numpy'
+
+# Dask engine settings. scheduler can be 'threads' or 'processes'. workers is the number of threads/processes (None = all cores). 
+# chunk is the target chunk size in pixels (rounded to the GeoTIFF block size). halo is the overlap in pixels used to sieve across chunk edges.
+DASK = {'scheduler': 'threads', 'workers': None, 'chunk': 2048, 'halo': 16}
+
+# Sieve used to remove clumps of fewer than 3 pixels from the burn masks. method can be 'gdal' (rasterio.features.sieve) or 'fast' 
+# (NumPy neighbour counts, identical output to the GDAL sieve for the burn masks). threads is the number of threads sieving strips 
+# of strip rows at the same time (fast method only)
+SIEVE = {'method': 'fast', 'threads': 4, 'strip': 2048}
+
+# GDAL settings used for all raster reads and writes, recorded in the processing log. Any GDAL configuration option can be added. 
+# GDAL_CACHEMAX is the block cache (MB), GDAL_NUM_THREADS the threads used to compress/decompress (lower it when running several 
+# workers per node), VSI_CACHE/VSI_CACHE_SIZE a per file read cache (bytes), GDAL_DISABLE_READDIR_ON_OPEN stops GDAL listing the 
+# large ARD folders on every open, and CPL_VSIL_CURL_CHUNK_SIZE is the read size (bytes) for files read over HTTP (/vsicurl/)
+GDAL_OPTIONS = {'GDAL_CACHEMAX': 1024, 'GDAL_NUM_THREADS': 'ALL_CPUS', 'VSI_CACHE': True, 'VSI_CACHE_SIZE': 67108864, 
+                'GDAL_DISABLE_READDIR_ON_OPEN': 'EMPTY_DIR', 'CPL_VSIL_CURL_CHUNK_SIZE': 4194304}
+
+# Run the seed (threshold_imgs) and grow (grow_burn) branches of each pair, and their raster writes, side by side on two threads. 
+# Value can be 'off' or 'on'. Uses a second core per pair (the thresholding, sieve and GDAL writes release the GIL) at the cost of 
+# holding the temporary arrays of both branches in memory at the same time
+BRANCH_THREADS = 'on'
+
+# Staged pipeline (NumPy engine only). mode can be 'off' (pairs processed one after another), 'threads' (the read, index/threshold, 
+# vectorise and write stages run at the same time on their own threads, connected by queues) or 'processes' (as 'threads' with the 
+# index/threshold stage run in a pool of processes and the bands passed in shared memory). workers sets the threads (or processes) 
+# of each stage, and queue the number of pairs that can wait in front of each stage. Each pair waiting for the index/threshold 
+# stage holds the bands of its images in memory (several GB for full granules), so keep queue and the read workers low.
+PIPELINE = {'mode': 'off', 'workers': {'read': 1, 'compute': 1, 'vectorise': 1, 'write': 1}, 'queue': 1}
+
+# Local staging cache for the inputs. Value can be 'off' or 'on'. When on, each image and its cloud mask are copied to node local 
+# scratch before they are read and later runs on the node read the local copy. dir is the cache folder (on local disk, not the GWS), 
+# size_gb the size limit (the least recently used copies are deleted to make room), prefetch the number of upcoming images copied 
+# ahead while the current pair is processed, and threads the number of prefetch copies run at the same time
+STAGE_INPUTS = 'off'
+STAGE_CACHE = {'dir': '/tmp/jncc_muirburn_stage', 'size_gb': 50, 'prefetch': 2, 'threads': 2}
+
+# Catalogue of image metadata (profile, transform, bounds, block size and valid data footprint), written to the catalogue folder of 
+# the output directory the first time each image is opened and reused for planning and pre-screening without opening the image again. 
+# mode can be 'off' or 'on'. decimation is the factor the nodata mask is reduced by when tracing the footprint
+CATALOGUE = {'mode': 'on', 'decimation': 16}
+
+# Rolling pre-fire baseline per granule. Value can be 'off' (each image is compared with the image before it) or 'on' (each image is 
+# read once and compared with a baseline holding the NBR2 and SAVI of each pixel in the latest image in which it was clear, which is then 
+# updated with the clear pixels of the image). The baselines are kept in the baseline folder of the output directory and carried 
+# over between runs. Uses the NumPy engine without the staged pipeline
+BASELINE = 'off'
+
+# Carry over of the latest image of each granule. Value can be 'off' or 'on'. When on, the NBR2 and SAVI of the latest image of each 
+# granule are saved in the carryover folder of the output directory (two Float32 bands, around the size of one intermediate product) and 
+# used as the pre-fire image of the first pair of the next run, so daily runs read only the new images. NumPy engine only
+CARRY_OVER = 'on'
+
+# Seasonal burn frequency rasters. Value can be 'off' or 'on'. When on, the burn area of each pair is added as it completes to a 
+# Cloud Optimized GeoTIFF per granule and season (year) in the season folder of the output directory, holding the number of pairs 
+# in which each pixel burned and the day of the year of the first and last of them
+BURN_FREQUENCY = 'on'
+
+# National burn mosaic. When mode is 'on', the burn raster of each pair is added as it completes to a VRT of the whole of Scotland 
+# on the British National Grid (EPSG:27700) in the mosaic folder of the output directory, covering bounds (left, bottom, right, top) 
+# at resolution (m). Overviews at each of factors are only recomputed over the areas added to since the last refresh: at the end of a 
+# run (or of the next planner run, for workers) with overviews 'end', or never with 'off' (call mosaic.refreshoverviews when needed). 
+# Each of factors must divide the largest (e.g. [16, 64], not [16, 24])
+MOSAIC = {'mode': 'on', 'bounds': (0, 530000, 470000, 1220000), 'resolution': 10, 'factors': [16, 64], 'overviews': 'end'}
+
+# Burn index. Value can be 'off' or 'on'. When on, the pairs completed in a run (or by workers, at the next planner run) are added 
+# to burnindex.sqlite in the output directory, so burnquery.py can find burns by area, date range and granule without opening every output
+BURN_INDEX = 'on'
+
+# How previously processed images are found. Value can be 'pickle' (images in imagelist.pkl are not crawled again) or 'manifest' 
+# (all images are crawled, and a pair is only skipped if its completion record shows the same inputs, thresholds and code version 
+# and its outputs exist, so reprocessed ARD or threshold changes are picked up)
+PROCESSED_CHECK = 'pickle'
+
+# How input files are identified in the completion records. Value can be 'stat' (size and modification time) or 'checksum' 
+# (SHA-1 of the file contents; needs a full read of every input so is much slower)
+MANIFEST_IDENTITY = 'stat'
+
+# Cloud pre-screen. Value can be 'off' or 'on'. When on, the cloud mask of each image is read at reduced resolution (the CATALOGUE 
+# decimation) before any full read. Images with more than CLOUD of the land in the granule under cloud are left out of their chain 
+# (so the next image is compared with the last clear one), and pairs are skipped when less than 1 - CLOUD of the land is clear in both 
+# images at once (the reduced resolution clear masks are cached in the catalogue, so each cloud mask is only read once).
+# Turning it on changes which images are paired (a cloudy image no longer starts or ends a pair), and so the pairs and output names 
+# produced, compared with runs with it off
+CLOUD_SCREEN = 'off'
+
+# Cloud cover threshold (fraction of the land in the granule) used by the cloud pre-screen
+CLOUD = 0.9 
 
 # Scottish granule filter - only process the granules for Scotland. 
 PROC_GRANULES = ['T29UPB', 'T29VNC', 'T29VND', 'T29VNE', 'T29VNF', 'T29VPC', 'T29VPD', 'T29VPE', 'T29VPF', 'T29VPG', 'T30UUF', 'T30UUG', 'T30UVF', 'T30UVG', 'T30UWF', 'T30UWG', 'T30VUH', 'T30VUJ', 'T30VUK', 'T30VUL', 'T30VUM', 'T30VVH', 'T30VVJ', 'T30VVK', 'T30VVL', 'T30VVM', 'T30VVN', 'T30VWH', 'T30VWJ', 'T30VWK', 'T30VWL', 'T30VWM', 'T30VWN', 'T30VXH', 'T30VXJ', 'T30VXK', 'T30VXL', 'T30VXM', 'T30VXN', 'T31VCG', 'T31VCH']
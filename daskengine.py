@@ -0,0 +1,286 @@
+"""
+This module contains the optional dask engine used when calculating burn locations in Scotland (config.ENGINE = 'dask').
+
+Instead of holding whole granule NumPy arrays from the read through to the thresholding, each band of the pre and post image
+is opened lazily as a chunked dask array over the land mask window, with chunk edges on the GeoTIFF block boundaries. The land
+mask, cloud mask, index and threshold steps are built as a lazy graph using the same index functions as the NumPy engine, the
+sieve is applied chunk by chunk with a halo (so chunk edges give the same result as a whole granule sieve), and the outputs
+are computed with the local threaded or process scheduler and written to the GeoTIFFs chunk by chunk. Memory use is bounded
+by the chunk size and number of workers rather than the granule size.
+
+dask is only needed when this engine is selected.
+
+"""
+
+# --- Imports ---
+import concurrent.futures
+import logging
+import os
+import warnings
+
+import dask
+import dask.array as da
+import numpy as np
+import rasterio
+from rasterio.features import geometry_mask, geometry_window
+from rasterio.windows import Window
+
+import config # config.py configuration parameters
+import operationalcode as oc
+import runmetrics # per stage timing instrumentation
+
+
+# --- Classes ---
+class RasterBand:
+    '''
+    Array-like view of one band of a raster within a window, read on demand. Used as the source of dask.array.from_array,
+    so each chunk opens the file and reads only its own window.
+    '''
+    def __init__(self, path, band, window, dtype):
+        self.path = path
+        self.band = band
+        self.window = window
+        self.shape = (int(window.height), int(window.width))
+        self.dtype = np.dtype(dtype)
+        self.ndim = 2
+
+    def __getitem__(self, key):
+        rows, cols = key
+        window = Window(self.window.col_off + cols.start, self.window.row_off + rows.start, cols.stop - cols.start, rows.stop - rows.start)
+        with rasterio.open(self.path) as dataset:
+            return dataset.read(self.band, window=window)
+
+
+class RasterWriter:
+    '''
+    Target for dask.array.store that writes each computed chunk into a band of an open raster
+    '''
+    def __init__(self, dataset, band=1):
+        self.dataset = dataset
+        self.band = band
+
+    def __setitem__(self, key, value):
+        rows, cols = key
+        self.dataset.write(value, self.band, window=Window(cols.start, rows.start, cols.stop - cols.start, rows.stop - rows.start))
+
+
+# --- Functions ---
+def blockchunks(offset, length, block, target):
+    '''
+    Splits one axis of a window into chunk lengths whose edges fall on the block boundaries of the file
+
+    Return:
+    Tuple of chunk lengths
+
+    Keyword arguments:
+    offset -- window offset along the axis (pixels)
+    length -- window length along the axis (pixels)
+    block -- GeoTIFF block size along the axis (pixels)
+    target -- target chunk size (pixels), rounded down to a whole number of blocks
+    '''
+    step = max(block, (target // block) * block)
+    chunks = []
+    first = min(length, step - (offset % step))
+    chunks.append(first)
+    done = first
+    while done < length:
+        chunks.append(min(step, length - done))
+        done += chunks[-1]
+    return tuple(chunks)
+
+
+def landarray(shapes, transform, chunks):
+    '''
+    Builds the land mask for the window as a lazy boolean array, rasterised chunk by chunk (True = land)
+
+    Return:
+    dask array
+
+    Keyword arguments:
+    shapes -- land mask polygons
+    transform -- transform of the window
+    chunks -- dask chunks of the window
+    '''
+    def landchunk(block_info=None):
+        (r0, r1), (c0, c1) = block_info[None]['array-location']
+        return geometry_mask(shapes, out_shape=(r1 - r0, c1 - c0), transform=transform * transform.translation(c0, r0), invert=True)
+
+    return da.map_blocks(landchunk, chunks=chunks, dtype=bool, meta=np.empty((0, 0), dtype=bool))
+
+
+def lazyimage(imagename, cloudname, window, chunks, land, fill):
+    '''
+    Opens the red, nir, swir1 and swir2 bands of an image lazily, masked to the land and by the cloud mask in the same way as pre/post
+
+    Return:
+    red, nir, swir1 and swir2 dask arrays (float64)
+
+    Keyword arguments:
+    imagename -- the path to the image
+    cloudname -- the path to the associated cloud mask
+    window -- land mask window of the image
+    chunks -- dask chunks of the window
+    land -- lazy land mask
+    fill -- value given to pixels outside the land mask (the image nodata value, or 0)
+    '''
+    with rasterio.open(imagename) as dataset:
+        dtype = dataset.dtypes[0]
+    with rasterio.open(cloudname) as clouddataset:
+        clouddtype = clouddataset.dtypes[0]
+
+    clouds = da.from_array(RasterBand(cloudname, 1, window, clouddtype), chunks=chunks, lock=False, meta=np.empty((0, 0), dtype=clouddtype))
+    cloudmask = (clouds < 1).astype(np.float64)
+
+    bands = []
+    for band in (3, 7, 9, 10):
+        data = da.from_array(RasterBand(imagename, band, window, dtype), chunks=chunks, lock=False, meta=np.empty((0, 0), dtype=dtype))
+        bands.append(da.where(land, data, fill).astype(dtype) * cloudmask)
+    return bands
+
+
+def sievechunk(block):
+    '''
+    Sieves one chunk (with its halo) in the same way as threshold_imgs and grow_burn
+
+    Return:
+    Sieved chunk
+
+    Keyword arguments:
+    block -- uint8 chunk
+    '''
+    return oc.sievemask(block)
+
+
+def processpair(prelist, postlist, od, landmask, intermediates=None, prepaths=None, postpaths=None):
+    '''
+    Processes one image pair with lazy chunked arrays and writes the outputs chunk by chunk
+
+    Return:
+    NA
+
+    Keyword arguments:
+    prelist -- pre-burn image details [imagename, imagepath, granule, size, date]
+    postlist -- post-burn image details
+    od -- output directory
+    landmask -- land mask polygons
+    intermediates -- names of the intermediate products to save (None for none)
+    prepaths -- (image, cloud mask) paths to read the pre-burn image from, e.g. local copies (default: the archive paths)
+    postpaths -- (image, cloud mask) paths to read the post-burn image from
+    '''
+    if intermediates is None:
+        intermediates = []
+    preimage, precloud = prepaths if prepaths is not None else (os.path.join(prelist[1], prelist[0]), oc.cloudpath(prelist))
+    postimage, postcloud = postpaths if postpaths is not None else (os.path.join(postlist[1], postlist[0]), oc.cloudpath(postlist))
+
+    with rasterio.open(preimage) as dataset:
+        window = geometry_window(dataset, landmask)
+        transform = dataset.window_transform(window)
+        profile = dataset.meta.copy()
+        profile.update({"driver": "GTiff", "height": int(window.height), "width": int(window.width), "transform": transform})
+        blocky, blockx = dataset.block_shapes[0]
+        fill = dataset.nodata if dataset.nodata is not None else 0
+        pregrid = (dataset.transform, dataset.shape)
+
+    with rasterio.open(postimage) as dataset:
+        if (dataset.transform, dataset.shape) != pregrid:
+            raise ValueError('Pre and post images are not on the same grid: ' + prelist[0] + ' ' + postlist[0])
+
+    target = config.DASK['chunk']
+    chunks = (blockchunks(int(window.row_off), int(window.height), blocky, target), blockchunks(int(window.col_off), int(window.width), blockx, target))
+    logging.debug('Dask chunks: ' + str(len(chunks[0])) + ' x ' + str(len(chunks[1])))
+
+    land = landarray(landmask, transform, chunks)
+    prered, prenir, preswir1, preswir2 = lazyimage(preimage, precloud, window, chunks, land, fill)
+    postred, postnir, postswir1, postswir2 = lazyimage(postimage, postcloud, window, chunks, land, fill)
+
+    # Index graph, using the same functions as the NumPy engine
+    postnbr = oc.nbr(postswir1, postnir)
+    dnbr2 = oc.nbr2(postswir2, postswir1) - oc.nbr2(preswir2, preswir1)
+    dsavi = oc.savi(postnir, postred) - oc.savi(prenir, prered)
+
+    # Thresholding and region growing, equivalent to threshold_imgs and grow_burn
+    thresholds = config.THRESHOLD
+    seed = ((dsavi >= thresholds['threshdsavi']) & (postnbr >= thresholds['threshpostnbr']) & ~(dnbr2 >= thresholds['threshdnbr2'])).astype(rasterio.uint8)
+    thresholds = config.GROW
+    grow = ((dsavi >= thresholds['dsaviq1thresh']) & (postnbr >= thresholds['postnbrq1thresh']) & ~(dnbr2 >= thresholds['cloudthresh'])).astype(rasterio.uint8)
+
+    halo = config.DASK['halo']
+    burnseed = seed.map_overlap(sievechunk, depth=halo, boundary='none', dtype=rasterio.uint8)
+    burnarray = grow.map_overlap(sievechunk, depth=halo, boundary='none', dtype=rasterio.uint8)
+
+    # Outputs to write, with the profile settings saveraster would use
+    outputs = []
+    if config.PACKED_RASTERS == 'combined':
+        outputs.append(('burnclass', oc.classify_burn(burnseed, burnarray), {'dtype': rasterio.uint8, 'count': 1, 'compress': 'lzw', 'nbits': 2}))
+    else:
+        packed = {'nbits': 1} if config.PACKED_RASTERS == 'nbits' else {}
+        outputs.append(('burnseed', burnseed, dict({'dtype': rasterio.uint8, 'count': 1, 'compress': 'lzw'}, **packed)))
+        outputs.append(('burnarea', burnarray, dict({'dtype': rasterio.uint8, 'count': 1, 'compress': 'lzw'}, **packed)))
+    products = {'postnbr': postnbr, 'dnbr2': dnbr2, 'dsavi': dsavi}
+    for name in intermediates:
+        outputs.append((name, products[name], {'dtype': 'float32', 'count': 1}))
+
+    outnames = {}
+    # the 0/0 divisions in cloud masked pixels warn once per chunk rather than once per pair, so the warnings are silenced
+    with runmetrics.stage('compute'), warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        if config.DASK['scheduler'] == 'processes':
+            writeblockrows(od, outputs, profile, prelist[0], postlist[0], outnames)
+        else:
+            datasets = []
+            try:
+                for name, array, kwds in outputs:
+                    outnames[name] = os.path.join(od, oc.outputbasename(prelist[0], postlist[0]) + '_' + name + '.tif')
+                    datasets.append(rasterio.open(outnames[name], 'w', **dict(profile, **kwds)))
+                da.store([o[1] for o in outputs], [RasterWriter(d) for d in datasets], lock=True,
+                         scheduler='threads', num_workers=config.DASK['workers'])
+            finally:
+                for d in datasets:
+                    d.close()
+
+    # Vectorise from the written rasters
+    if config.PACKED_RASTERS == 'combined':
+        with rasterio.open(outnames['burnclass']) as dataset:
+            burnclass = dataset.read(1)
+        seedout, areaout = (burnclass >> 1) & 1, burnclass & 1
+    else:
+        with rasterio.open(outnames['burnseed']) as dataset:
+            seedout = dataset.read(1)
+        with rasterio.open(outnames['burnarea']) as dataset:
+            areaout = dataset.read(1)
+    oc.saveVector(od, seedout, areaout, profile, transform, prelist[0], postlist[0])
+
+
+def writeblockrows(od, outputs, profile, prename, postname, outnames):
+    '''
+    Computes the outputs one row of chunks at a time with the process scheduler and writes each row from this process
+    (open raster datasets cannot be passed to other processes)
+
+    Return:
+    NA
+
+    Keyword arguments:
+    od -- output directory
+    outputs -- list of (name, dask array, profile settings)
+    profile -- base output profile
+    prename -- name of the preburn input image
+    postname -- name of the postburn input image
+    outnames -- dictionary filled with the output paths
+    '''
+    datasets = []
+    try:
+        for name, array, kwds in outputs:
+            outnames[name] = os.path.join(od, oc.outputbasename(prename, postname) + '_' + name + '.tif')
+            datasets.append(rasterio.open(outnames[name], 'w', **dict(profile, **kwds)))
+
+        # one pool for all the rows, rather than starting new processes for each row
+        with concurrent.futures.ProcessPoolExecutor(config.DASK['workers']) as pool:
+            rowstart = 0
+            for i, rows in enumerate(outputs[0][1].chunks[0]):
+                blocks = dask.compute(*[o[1].blocks[i, :] for o in outputs], scheduler='processes', pool=pool)
+                for dataset, block in zip(datasets, blocks):
+                    dataset.write(block, 1, window=Window(0, rowstart, block.shape[1], rows))
+                rowstart += rows
+    finally:
+        for d in datasets:
+            d.close()
@@ -0,0 +1,376 @@
+"""
+This module contains the national burn mosaic used when calculating burn locations in Scotland (config.MOSAIC mode = 'on').
+
+Each pair writes its own burn raster on the land cropped grid of its granule, so a national picture of the burns means
+opening and merging every pair output. Instead, as each pair completes, its burn raster is added as a source of a GDAL VRT
+covering the whole of Scotland on the British National Grid (EPSG:27700, config.MOSAIC bounds and resolution) in the mosaic
+folder of the output directory:
+
+    mosaic/burnarea.vrt             national mosaic, 1 band Byte: 100 where any pair added so far found a burn, 0 elsewhere
+    mosaic/burnarea_<factor>.tif    overview at <factor> times the resolution: percentage of each cell burned (rounded up)
+    mosaic/sources/<granule>.json   sources added for the granule and the pairs whose areas are out of date in the overviews
+    mosaic/mosaic.lock              held while the source lists or the VRT are updated
+
+The VRT only references the pair outputs, so adding a pair rewrites a small XML file and nothing is copied. The sources of
+each granule are listed in their own file and the VRT is rebuilt from all of the lists each time. The lists and the VRT are
+only updated while holding the lock file (created exclusively, so only one process on any node can hold it), so workers
+processing different granules can add to the mosaic at the same time without leaving out each other's pairs. The VRT is
+also rebuilt whenever the overviews are refreshed. Pairs are drawn in date order with unburned pixels transparent.
+
+The overviews are maintained lazily. Adding a pair only records its extent as out of date, and refreshoverviews recomputes
+the overviews over the out of date areas from the full resolution mosaic (at the end of a single run, or of a planner run
+after workers have finished, with config.MOSAIC overviews = 'end'). The overviews are computed without holding the lock,
+and an area is only marked up to date if no pair has been added to it in the meantime. GIS tools zoomed out read the
+overviews rather than every pair output, and show burns up to the last refresh.
+
+Only rasters in EPSG:27700 and aligned with the mosaic grid are added (the ARD is already on the British National Grid).
+
+"""
+
+# --- Imports ---
+import contextlib
+import datetime
+import glob
+import logging
+import math
+import os
+import socket
+import threading
+import time
+from xml.sax.saxutils import escape
+
+import numpy as np
+import rasterio
+from rasterio.crs import CRS
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+
+from workqueue import filelock, readjson, writejson
+
+
+# --- Constants ---
+MOSAIC = 'mosaic'
+MOSAICNAME = 'burnarea'
+
+# Value of burned pixels in the mosaic (so overviews read as a percentage of each cell burned)
+BURNED = 100
+
+# Source values to mosaic values, by pair raster: bit 0 of the burnclass raster is the burn area, bit 1 the burn seed
+LUTS = {'burnarea': '0:0,1:' + str(BURNED), 'burnclass': '0:0,1:' + str(BURNED) + ',2:0,3:' + str(BURNED)}
+
+EPSG = 27700
+
+# Seconds after which a lock file is taken to have been left by a process that was killed
+LOCK_TIMEOUT = 300
+
+
+# --- Process state ---
+# threads of a process wait for each other here rather than all polling the lock file
+_lock = threading.Lock()
+
+
+# --- Functions ---
+def mosaicpath(od, suffix='.vrt'):
+    '''
+    Builds the path of a mosaic file
+
+    Return:
+    Path to the file
+
+    Keyword arguments:
+    od -- output directory
+    suffix -- end of the file name (e.g. '.vrt' or '_16.tif')
+    '''
+    return os.path.join(od, MOSAIC, MOSAICNAME + suffix)
+
+
+def sourcespath(od, granule):
+    '''
+    Builds the path of the source list of a granule
+
+    Return:
+    Path to the source list
+
+    Keyword arguments:
+    od -- output directory
+    granule -- granule name (e.g. T30VVJ)
+    '''
+    return os.path.join(od, MOSAIC, 'sources', granule + '.json')
+
+
+@contextlib.contextmanager
+def mosaiclock(od):
+    '''
+    Holds the mosaic lock file while the source lists or the VRT are read and replaced. A lock file older than LOCK_TIMEOUT
+    is taken to have been left by a process that was killed and is removed.
+
+    Return:
+    Context manager
+
+    Keyword arguments:
+    od -- output directory
+    '''
+    path = os.path.join(od, MOSAIC, 'mosaic.lock')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with _lock:
+        with filelock(path, LOCK_TIMEOUT):
+            yield
+
+
+def mosaicgrid(settings):
+    '''
+    Builds the national grid of the mosaic from the configuration. The size is rounded up to a whole number of cells of the
+    coarsest overview, so every overview cell covers the same number of mosaic pixels. Every factor must divide the coarsest,
+    as the overviews are refreshed in blocks of whole coarsest cells.
+
+    Return:
+    Dictionary of the transform, width, height, resolution and overview factors
+
+    Keyword arguments:
+    settings -- config.MOSAIC dictionary
+    '''
+    left, bottom, right, top = settings['bounds']
+    resolution = settings['resolution']
+    factors = sorted(settings['factors'])
+    coarsest = factors[-1] if factors else 1
+    uneven = [f for f in factors if f < 1 or coarsest % f != 0]
+    if uneven:
+        raise ValueError('Mosaic overview factors must be positive and divide the largest factor (' + str(coarsest) + '): ' + str(uneven))
+    width = math.ceil((right - left) / resolution / coarsest) * coarsest
+    height = math.ceil((top - bottom) / resolution / coarsest) * coarsest
+    return {'transform': from_origin(left, top, resolution, resolution), 'width': width, 'height': height,
+            'resolution': resolution, 'factors': factors}
+
+
+def sourcewindow(dataset, grid):
+    '''
+    Finds where a pair raster sits in the mosaic grid
+
+    Return:
+    [column, row, width, height] of the raster in the mosaic, or None if the raster cannot be added (CRS or grid differ, or it lies outside the mosaic)
+
+    Keyword arguments:
+    dataset -- open rasterio dataset of the pair raster
+    grid -- mosaic grid (from mosaicgrid)
+    '''
+    if dataset.crs is None or dataset.crs.to_epsg() != EPSG:
+        logging.warning('Not added to the burn mosaic, not in EPSG:' + str(EPSG) + ': ' + dataset.name)
+        return None
+    transform = dataset.transform
+    resolution = grid['resolution']
+    column = (transform.c - grid['transform'].c) / resolution
+    row = (grid['transform'].f - transform.f) / resolution
+    if (transform.a, transform.e, transform.b, transform.d) != (resolution, -resolution, 0, 0) or \
+            abs(column - round(column)) > 1e-6 or abs(row - round(row)) > 1e-6:
+        logging.warning('Not added to the burn mosaic, not aligned with the mosaic grid: ' + dataset.name)
+        return None
+    column, row = int(round(column)), int(round(row))
+    if column >= grid['width'] or row >= grid['height'] or column + dataset.width <= 0 or row + dataset.height <= 0:
+        logging.warning('Not added to the burn mosaic, outside the mosaic bounds: ' + dataset.name)
+        return None
+    return [column, row, dataset.width, dataset.height]
+
+
+def sourcexml(vrtdir, source):
+    '''
+    Builds the VRT ComplexSource element of a pair raster
+
+    Return:
+    XML string
+
+    Keyword arguments:
+    vrtdir -- folder of the VRT (source paths are written relative to it)
+    source -- source entry from a source list
+    '''
+    column, row, width, height = source['window']
+    return ('    <ComplexSource>\n'
+            '      <SourceFilename relativeToVRT="1">' + escape(os.path.relpath(source['path'], vrtdir)) + '</SourceFilename>\n'
+            '      <SourceBand>1</SourceBand>\n'
+            '      <SrcRect xOff="0" yOff="0" xSize="' + str(width) + '" ySize="' + str(height) + '"/>\n'
+            '      <DstRect xOff="' + str(column) + '" yOff="' + str(row) + '" xSize="' + str(width) + '" ySize="' + str(height) + '"/>\n'
+            '      <NODATA>0</NODATA>\n'
+            '      <LUT>' + LUTS[source['raster']] + '</LUT>\n'
+            '    </ComplexSource>\n')
+
+
+def writevrt(od, grid):
+    '''
+    Rebuilds the mosaic VRT from the source lists of all granules. The VRT is written to a temporary file and renamed.
+
+    Return:
+    Number of sources in the mosaic
+
+    Keyword arguments:
+    od -- output directory
+    grid -- mosaic grid (from mosaicgrid)
+    '''
+    vrtdir = os.path.join(od, MOSAIC)
+    sources = []
+    for listpath in sorted(glob.glob(sourcespath(od, '*'))):
+        sources.extend(readjson(listpath)['sources'])
+    sources.sort(key=lambda s: (s['date'], s['pair']))
+
+    transform = grid['transform']
+    geotransform = ', '.join(repr(float(v)) for v in transform.to_gdal())
+    parts = ['<VRTDataset rasterXSize="' + str(grid['width']) + '" rasterYSize="' + str(grid['height']) + '">\n',
+             '  <SRS>' + escape(CRS.from_epsg(EPSG).to_wkt()) + '</SRS>\n',
+             '  <GeoTransform>' + geotransform + '</GeoTransform>\n',
+             '  <VRTRasterBand dataType="Byte" band="1">\n',
+             '    <Description>burned</Description>\n']
+    for factor in grid['factors']:
+        if os.path.isfile(mosaicpath(od, '_' + str(factor) + '.tif')):
+            parts.append('    <Overview>\n'
+                         '      <SourceFilename relativeToVRT="1">' + MOSAICNAME + '_' + str(factor) + '.tif</SourceFilename>\n'
+                         '      <SourceBand>1</SourceBand>\n'
+                         '    </Overview>\n')
+    parts.extend(sourcexml(vrtdir, source) for source in sources)
+    parts.append('  </VRTRasterBand>\n</VRTDataset>\n')
+
+    path = mosaicpath(od)
+    temppath = path + '.' + socket.gethostname() + '.' + str(os.getpid()) + '.tmp'
+    with open(temppath, 'w') as f:
+        f.write(''.join(parts))
+    os.replace(temppath, path)
+    return len(sources)
+
+
+def addpair(od, granule, pair, date, path, raster, grid):
+    '''
+    Adds the burn raster of a pair to the mosaic and marks its extent as needing the overviews refreshed. A pair added again
+    (e.g. reprocessed) replaces its earlier entry.
+
+    Return:
+    True if the pair was added
+
+    Keyword arguments:
+    od -- output directory
+    granule -- granule name
+    pair -- output base name of the pair
+    date -- date of the post-fire image as YYYYMMDD
+    path -- path of the burn raster of the pair
+    raster -- type of the burn raster ('burnarea' or 'burnclass')
+    grid -- mosaic grid (from mosaicgrid)
+    '''
+    with rasterio.open(path) as dataset:
+        window = sourcewindow(dataset, grid)
+    if window is None:
+        return False
+
+    listpath = sourcespath(od, granule)
+    with mosaiclock(od):
+        os.makedirs(os.path.dirname(listpath), exist_ok=True)
+        entries = readjson(listpath) if os.path.isfile(listpath) else {'granule': granule, 'sources': [], 'stale': {}}
+        entries['sources'] = [s for s in entries['sources'] if s['pair'] != pair]
+        entries['sources'].append({'pair': pair, 'date': date, 'path': os.path.abspath(path), 'raster': raster, 'window': window})
+        entries['stale'][pair] = {'window': window, 'added': time.time()}
+        writejson(listpath, entries)
+        writevrt(od, grid)
+    logging.debug('Pair added to the burn mosaic: ' + pair)
+    return True
+
+
+def createoverview(path, grid, factor):
+    '''
+    Creates an empty overview raster of the mosaic. Tiles that are never written are left out of the file.
+
+    Return:
+    NA
+
+    Keyword arguments:
+    path -- path of the overview raster
+    grid -- mosaic grid (from mosaicgrid)
+    factor -- overview factor
+    '''
+    transform = grid['transform']
+    profile = {'driver': 'GTiff', 'width': grid['width'] // factor, 'height': grid['height'] // factor, 'count': 1,
+               'dtype': rasterio.uint8, 'nodata': None, 'crs': CRS.from_epsg(EPSG),
+               'transform': from_origin(transform.c, transform.f, grid['resolution'] * factor, grid['resolution'] * factor),
+               'compress': 'deflate', 'tiled': True, 'blockxsize': 256, 'blockysize': 256, 'sparse_ok': True}
+    with rasterio.open(path, 'w', **profile):
+        pass
+
+
+def snapwindow(window, grid):
+    '''
+    Expands a mosaic window to whole cells of the coarsest overview, clipped to the mosaic
+
+    Return:
+    (column, row, width, height) of the expanded window
+
+    Keyword arguments:
+    window -- [column, row, width, height] in the mosaic
+    grid -- mosaic grid (from mosaicgrid)
+    '''
+    coarsest = grid['factors'][-1]
+    column, row, width, height = window
+    left, top = max(column, 0) // coarsest * coarsest, max(row, 0) // coarsest * coarsest
+    right = min(math.ceil((column + width) / coarsest) * coarsest, grid['width'])
+    bottom = min(math.ceil((row + height) / coarsest) * coarsest, grid['height'])
+    return left, top, right - left, bottom - top
+
+
+def rebuildvrt(od, grid):
+    '''
+    Rebuilds the mosaic VRT from the source lists, holding the mosaic lock
+
+    Return:
+    Number of sources in the mosaic
+
+    Keyword arguments:
+    od -- output directory
+    grid -- mosaic grid (from mosaicgrid)
+    '''
+    if not os.path.isdir(os.path.join(od, MOSAIC, 'sources')):
+        return 0
+    with mosaiclock(od):
+        return writevrt(od, grid)
+
+
+def refreshoverviews(od, grid):
+    '''
+    Rebuilds the mosaic VRT and recomputes the mosaic overviews over the areas added to since the last refresh, from the full
+    resolution mosaic. Each overview cell holds the percentage of its mosaic pixels that are burned, rounded up so that any burn shows.
+
+    Return:
+    Number of areas refreshed
+
+    Keyword arguments:
+    od -- output directory
+    grid -- mosaic grid (from mosaicgrid)
+    '''
+    if not os.path.isdir(os.path.join(od, MOSAIC, 'sources')):
+        return 0
+
+    with mosaiclock(od):
+        # pairs out of date in each list, as read now: a pair added again during the refresh is left out of date
+        pending = {}
+        for listpath in sorted(glob.glob(sourcespath(od, '*'))):
+            stale = readjson(listpath)['stale']
+            if stale:
+                pending[listpath] = stale
+        if grid['factors']:
+            for factor in grid['factors']:
+                if not os.path.isfile(mosaicpath(od, '_' + str(factor) + '.tif')):
+                    createoverview(mosaicpath(od, '_' + str(factor) + '.tif'), grid, factor)
+        writevrt(od, grid)
+    if not grid['factors'] or len(pending) == 0:
+        return 0
+
+    windows = set(snapwindow(entry['window'], grid) for stale in pending.values() for entry in stale.values())
+    with rasterio.open(mosaicpath(od)) as dataset:
+        for column, row, width, height in windows:
+            burned = dataset.read(1, window=Window(column, row, width, height))
+            for factor in grid['factors']:
+                cells = burned.reshape(height // factor, factor, width // factor, factor).sum(axis=(1, 3), dtype=np.uint32)
+                percent = np.ceil(cells / (factor * factor)).astype(np.uint8)
+                with rasterio.open(mosaicpath(od, '_' + str(factor) + '.tif'), 'r+') as overview:
+                    overview.write(percent, 1, window=Window(column // factor, row // factor, width // factor, height // factor))
+
+    with mosaiclock(od):
+        for listpath, stale in pending.items():
+            entries = readjson(listpath)
+            entries['stale'] = {pair: entry for pair, entry in entries['stale'].items() if stale.get(pair) != entry}
+            entries['refreshed'] = datetime.datetime.now().isoformat(timespec='seconds')
+            writejson(listpath, entries)
+    logging.debug('Burn mosaic overviews refreshed over ' + str(len(windows)) + ' areas')
+    return len(windows)
@@ -5,7 +5,7 @@ This module contains code for testing the scaling up on JASMIN of calculating bu
 Description:
 This code takes in a working and output directory which is validated, and searches for new images (checking the images found against a saved list of previously processed images). The list of processed images is retrieved from a file that is saved in pickle format. The working directory is generated by a crawl of the working directory filesystem. 
 
-The list of images is sorted by date. A check is made that images are larger than 1GB so that only full granules are used (partially covered granules throw up errors when the division is applied). A cleaned, sorted list of files is fed into functions that read the imagery (having checked they are for the same granule) as pre-burn and post-burn datasets and passes that to functions that calculate NBR, NBR2 and SAVI. These outputs are then thresholded to create a seed layer, ready for region growing. 
+The list of images is sorted by date. Partial granules are screened out, either by file size (images larger than 1GB) or by the fraction of the land in the granule that has valid data in each image and pair (estimated from a decimated read of one band and cached in the catalogue). A cleaned, sorted list of files is fed into functions that read the imagery (having checked they are for the same granule) as pre-burn and post-burn datasets and passes that to functions that calculate NBR, NBR2 and SAVI. These outputs are then thresholded to create a seed layer, ready for region growing. 
 
 Finally the imagery datasets and logfiles are exported.
 
@@ -20,13 +20,17 @@ Possible things to do:
 """
 
 # --- Imports ---
+import concurrent.futures
 import logging
+import multiprocessing
 import os
 import sys
 import datetime
 import glob
 import pickle
-import copy
+import queue
+import socket
+import threading
 
 import numpy as np
 import rasterio
@@ -36,6 +40,39 @@ from rasterio.mask import mask
 import geopandas as gpd
 
 import config # config.py configuration parameters
+import runmetrics # per stage timing instrumentation
+import checkpoint # per pair completion records
+import fastsieve # fast equivalent of the GDAL sieve for the burn masks
+import workqueue # shared filesystem work queue for distributed runs
+import stages # staged pipeline of reader, compute, vectorise and write threads
+import sharedbands # shared memory band buffers for the compute processes of the pipeline
+import stagecache # node local staging cache for the inputs
+import catalogue # cached metadata of the images
+import baseline # rolling pre-fire baselines per granule
+import carryover # pre-fire indices of the latest image of each granule, kept for the next run
+import seasonal # seasonal burn frequency rasters per granule
+import mosaic # national burn mosaic
+import burnquery # spatial and temporal index of the burn outputs
+
+
+# --- Version ---
+# Increase when a change to the code alters the outputs, so that pairs processed by older code are reprocessed
+VERSION = '1.1'
+
+
+# --- Staging cache ---
+# Local copies of the inputs, set up in the main block when config.STAGE_INPUTS is 'on' (None reads from the archive)
+inputcache = None
+
+
+# --- Work queue ---
+# Unit being processed by a worker and the event set by its heartbeat if the lease is lost (None outside runworker)
+unitlease = None
+
+
+# --- Land coverage ---
+# Land mask clipped to each granule, by granule bounds (filled as images are screened, IMAGE_SCREEN = 'coverage')
+landclips = {}
 
 
 # --- Functions ---
@@ -227,6 +264,20 @@ def maskify(image, cloudmask):#, landmask):
     return maskedimage
 
 
+def tempname():
+    '''
+    Builds the name of the temporary land masked image. The name includes the host and process so that workers sharing an output directory do not overwrite each other's file,
+    and the thread name for images read on other threads than the main one (the read stage of the staged pipeline).
+    
+    Return:
+    Path to the temporary file
+    '''
+    name = 'temp_' + socket.gethostname() + '_' + str(os.getpid())
+    if threading.current_thread() is not threading.main_thread():
+        name = name + '_' + threading.current_thread().name
+    return os.path.join(od, name + '.tif')
+
+
 def masktheland(dataset):
     '''
     Masks the image dataset by the land mask
@@ -247,10 +298,29 @@ def masktheland(dataset):
         "transform": out_transform})
 
     # Write to temporary file
-    with rasterio.open(os.path.join(od, 'temp.tif'), "w", **out_meta) as dest:
+    with rasterio.open(tempname(), "w", **out_meta) as dest:
         dest.write(out_image)
 
 
+def catalogueimage(imagename, dataset):
+    '''
+    Records the metadata of an image in the catalogue the first time it is opened (toggle on-off set in config file)
+    
+    Return:
+    NA
+
+    Keyword arguments:
+    imagename -- the path the image was opened from (the archive path or its local copy in the staging cache)
+    dataset -- the open rasterio dataset of the image
+    '''
+    if config.CATALOGUE['mode'] != 'on':
+        return
+    source = inputcache.source(imagename) if inputcache is not None else imagename
+    if catalogue.lookup(od, source) is None:
+        with runmetrics.stage('catalogue'):
+            catalogue.recordimage(od, source, dataset, config.CATALOGUE['decimation'])
+
+
 def pre(imagename, cloudname):
     '''
     Opens and reads the pre fire image. 
@@ -270,21 +340,25 @@ def pre(imagename, cloudname):
         print('Width: ', dataset.width)
         print('Height: ', dataset.height)
         print('CRS: ', dataset.crs)
+        catalogueimage(imagename, dataset)
 
         print('Cropping to land mask')
-        masktheland(dataset)
+        with runmetrics.stage('landcrop'):
+            masktheland(dataset)
         
-    with rasterio.open(os.path.join(od, 'temp.tif')) as dataset:
+    with rasterio.open(tempname()) as dataset:
         profile = dataset.profile.copy()
         transform = dataset.transform
 
-        cloudmask = getcloudmask(cloudname) 
+        with runmetrics.stage('cloudmask'):
+            cloudmask = getcloudmask(cloudname) 
         
         print('Masking for cloud')
-        red = maskify(dataset.read(3), cloudmask)
-        nir = maskify(dataset.read(7), cloudmask)
-        swir1 = maskify(dataset.read(9), cloudmask)
-        swir2 = maskify(dataset.read(10), cloudmask)
+        with runmetrics.stage('bandread'):
+            red = maskify(dataset.read(3), cloudmask)
+            nir = maskify(dataset.read(7), cloudmask)
+            swir1 = maskify(dataset.read(9), cloudmask)
+            swir2 = maskify(dataset.read(10), cloudmask)
         
         logging.debug('PRE image data read')
         return red, nir, swir1, swir2, profile, transform
@@ -310,19 +384,23 @@ def post(imagename, cloudname):
         print('Width: ', dataset.width)
         print('Height: ', dataset.height)
         print('CRS: ', dataset.crs)
+        catalogueimage(imagename, dataset)
 
         print('Cropping to land mask')
-        masktheland(dataset)
+        with runmetrics.stage('landcrop'):
+            masktheland(dataset)
         
-    with rasterio.open(os.path.join(od, 'temp.tif')) as dataset:
+    with rasterio.open(tempname()) as dataset:
         profile = dataset.profile.copy()
-        cloudmask = getcloudmask(cloudname) 
+        with runmetrics.stage('cloudmask'):
+            cloudmask = getcloudmask(cloudname) 
         
         print('Masking for cloud')
-        red = maskify(dataset.read(3), cloudmask)
-        nir = maskify(dataset.read(7), cloudmask)
-        swir1 = maskify(dataset.read(9), cloudmask)
-        swir2 = maskify(dataset.read(10), cloudmask)
+        with runmetrics.stage('bandread'):
+            red = maskify(dataset.read(3), cloudmask)
+            nir = maskify(dataset.read(7), cloudmask)
+            swir1 = maskify(dataset.read(9), cloudmask)
+            swir2 = maskify(dataset.read(10), cloudmask)
 
         logging.debug('POST image data read')
         return red, nir, swir1, swir2, profile
@@ -392,21 +470,40 @@ def threshold_imgs(dsavi, postnbr, dnbr2, thresholds):
     thresholds -- dictionary of thresholds
     '''
 
-    # Create a copy of the postnbr image and reset all values in output raster to 0
-    reclassArray = postnbr.copy()
-    reclassArray[np.where(reclassArray != 0)] = 0
+    with runmetrics.stage('threshold'):
+        # Create a copy of the postnbr image and reset all values in output raster to 0
+        reclassArray = postnbr.copy()
+        reclassArray[np.where(reclassArray != 0)] = 0
 
-    # where dsavi is greater than the median and post fire image NBR is greater than the mean 
-    reclassArray[np.where((dsavi>=(thresholds['threshdsavi'])) & (postnbr>=(thresholds['threshpostnbr'])))] = 1 
+        # where dsavi is greater than the median and post fire image NBR is greater than the mean 
+        reclassArray[np.where((dsavi>=(thresholds['threshdsavi'])) & (postnbr>=(thresholds['threshpostnbr'])))] = 1 
     
-    # attempt to solve issue of edges of clouds being falsely identified which have high values in dnbr2
-    # rasterio function to exclude clumps of pixels smaller than 3.  Diagonally joined pixels are allowed.
+        # attempt to solve issue of edges of clouds being falsely identified which have high values in dnbr2
+        # rasterio function to exclude clumps of pixels smaller than 3.  Diagonally joined pixels are allowed.
     
-    reclassArray[np.where(dnbr2>=(thresholds['threshdnbr2']))] = 0
-    sievedArray = rasterio.features.sieve(reclassArray.astype(rasterio.uint8), size=3, connectivity=8)
+        reclassArray[np.where(dnbr2>=(thresholds['threshdnbr2']))] = 0
+
+    with runmetrics.stage('sieve'):
+        sievedArray = sievemask(reclassArray)
     return sievedArray
 
 
+def sievemask(array):
+    '''
+    Removes clumps of fewer than 3 pixels (diagonally joined pixels are allowed) from a burn mask, with the GDAL sieve or the
+    equivalent fast sieve (set in config file)
+    
+    Return:
+    Sieved uint8 array
+
+    Keyword arguements:
+    array -- 0/1 burn mask
+    '''
+    if config.SIEVE['method'] == 'fast':
+        return fastsieve.fastsieve(array, size=3, connectivity=8, threads=config.SIEVE['threads'], striprows=config.SIEVE['strip'])
+    return rasterio.features.sieve(array.astype(rasterio.uint8), size=3, connectivity=8)
+
+
 def grow_burn(dsavi, postnbr, dnbr2, thresholds):
     '''
     Uses a specified dictionary of thresholds applied to three input images to `grow` burn areas from the seed areas. 
@@ -421,25 +518,61 @@ def grow_burn(dsavi, postnbr, dnbr2, thresholds):
     thresholds -- dictionary of thresholds
     '''
 
-    # read in a single band as a template for the output 
-    extendArray = postnbr.copy()
+    with runmetrics.stage('threshold'):
+        # read in a single band as a template for the output 
+        extendArray = postnbr.copy()
 
-    # reset all values in output raster to 0 
-    extendArray[np.where(extendArray != 0)] = 0
+        # reset all values in output raster to 0 
+        extendArray[np.where(extendArray != 0)] = 0
 
-    # reclassify the second array to contain extended burn pixels
-    extendArray[np.where((dsavi>=(thresholds['dsaviq1thresh'])) & (postnbr>=(thresholds['postnbrq1thresh'])))] = 1 
-    # solve issue of edges of clouds being falsely identified
-    extendArray[np.where(dnbr2>=(thresholds['cloudthresh']))] = 0
+        # reclassify the second array to contain extended burn pixels
+        extendArray[np.where((dsavi>=(thresholds['dsaviq1thresh'])) & (postnbr>=(thresholds['postnbrq1thresh'])))] = 1 
+        # solve issue of edges of clouds being falsely identified
+        extendArray[np.where(dnbr2>=(thresholds['cloudthresh']))] = 0
 
     # rasterio function to exclude clumps of pixels smaller than 3.  Diagonally joined pixels are allowed.
-    burnedArray = rasterio.features.sieve(extendArray.astype(rasterio.uint8), size=3, connectivity=8)
+    with runmetrics.stage('sieve'):
+        burnedArray = sievemask(extendArray)
 
     return burnedArray
 
+def classify_burn(sievedArray, burnedArray):
+    '''
+    Combines the seed and grown burn layers into a single classification so that both can be stored in one 2-bit file.
+    Bit 0 holds the grown burn area and bit 1 holds the burn seed, giving values of 0 (unburnt), 1 (grown area only), 2 (seed only) and 3 (seed within grown area).
+    
+    Return:
+    Burn classification array
+
+    Keyword arguements:
+    sievedArray -- seed burn array
+    burnedArray -- region grown burn array
+    '''
+    burnclass = (burnedArray.astype(rasterio.uint8) & 1) | ((sievedArray.astype(rasterio.uint8) & 1) << 1)
+    logging.debug('Burn classification calculated')
+    return burnclass
+
+
+def outputbasename(prename, postname):
+    '''
+    Builds the base name shared by all outputs of an image pair, in the form: preburn image details _ postburn image details
+    
+    Return:
+    Output base name
+
+    Keyword arguements:
+    prename -- name of the preburn input image
+    postname -- name of the postburn input image
+    '''
+    prename = prename.split('_')
+    postname = postname.split('_')
+    return prename[0] + prename[1] + prename[3] + prename[4] + '_' + postname[0] + postname[1] + postname[3] + postname[4]
+
+
 def saveraster(od, datafile, profile, name, prename, postname):
     '''
     Saves spatial data to tif file 
+    The burnseed and burnarea layers are written as 1-bit files if config.PACKED_RASTERS is 'nbits'. The combined burnclass layer is always written as a 2-bit file.
     
     Return:
     NA
@@ -454,28 +587,29 @@ def saveraster(od, datafile, profile, name, prename, postname):
     '''
     
     #create output base name
-    prename = prename.split('_')
-    postname = postname.split('_')
+    outname = outputbasename(prename, postname) + '_' + name + '.tif'
 
-    kwds = profile
+    # copy the profile so that the settings for one output do not leak into the next
+    kwds = profile.copy()
     
-    if name == 'burnseed':
+    if name in ('burnseed', 'burnarea'):
         #Export the thresholded raster
         kwds.update(dtype=rasterio.uint8,
             count=1,
             compress='lzw')
-        outname = prename[0] + prename[1] + prename[3] + prename[4] + '_' + postname[0] + postname[1] + postname[3] + postname[4] + '_' + name + '.tif'
+        if config.PACKED_RASTERS == 'nbits':
+            kwds['nbits'] = 1
 
         with rasterio.open(os.path.join(od, outname), 'w', **kwds) as dst_dataset:
             dst_dataset.write(datafile, 1)
 
 
-    elif name == 'burnarea':
-        #Export the thresholded raster
+    elif name == 'burnclass':
+        #Export the combined seed/grow classification
         kwds.update(dtype=rasterio.uint8,
             count=1,
-            compress='lzw')
-        outname = prename[0] + prename[1] + prename[3] + prename[4] + '_' + postname[0] + postname[1] + postname[3] + postname[4] + '_' + name + '.tif'
+            compress='lzw',
+            nbits=2)
 
         with rasterio.open(os.path.join(od, outname), 'w', **kwds) as dst_dataset:
             dst_dataset.write(datafile, 1)
@@ -486,13 +620,92 @@ def saveraster(od, datafile, profile, name, prename, postname):
         kwds['dtype'] = 'float32'
         kwds['count'] = 1
 
-        outname = prename[0] + prename[1] + prename[3] + prename[4] + '_' + postname[0] + postname[1] + postname[3] + postname[4] + '_' + name + '.tif'
-
         with rasterio.open((os.path.join(od, outname)), 'w', **kwds) as dst_dataset:
         # Write data to the destination dataset.
             dst_dataset.write(datafile, 1)    
 
 
+def gdalenv():
+    '''
+    Creates a rasterio environment holding the GDAL settings in config.GDAL_OPTIONS (block cache, decompression threads, 
+    VSI caching and read sizes). The whole run is made inside it.
+    
+    Return:
+    rasterio.Env
+    '''
+    return rasterio.Env(**config.GDAL_OPTIONS)
+
+
+def gdalthread():
+    '''
+    Gives the calling thread a rasterio environment with the GDAL settings in config.GDAL_OPTIONS. rasterio keeps an environment
+    per thread, so threads started by the code (the background writer and the branch threads) call this before opening rasters.
+    
+    Return:
+    NA
+    '''
+    rasterio.env.defenv(**config.GDAL_OPTIONS)
+
+
+def writerworker(writequeue):
+    '''
+    Background writer. Takes saveraster arguments off the queue and writes them to disk until a None sentinel is received.
+    Errors are logged rather than raised so that a failed diagnostic write does not stop the main processing.
+    
+    Return:
+    NA
+    
+    Keyword arguements:
+    writequeue -- queue of saveraster argument tuples
+    '''
+    gdalthread()
+    while True:
+        item = writequeue.get()
+        try:
+            if item is None:
+                return
+            saveraster(*item)
+            logging.debug('Background write complete: ' + item[3] + ' ' + item[5])
+        except Exception:
+            logging.exception('Background write failed')
+        finally:
+            writequeue.task_done()
+
+
+def startwriter(maxqueue):
+    '''
+    Starts the background writer thread for the optional intermediate products.
+    The queue is bounded so that the main loop blocks (rather than holding more and more arrays in memory) if the writer falls behind.
+    
+    Return:
+    The write queue and the writer thread
+    
+    Keyword arguements:
+    maxqueue -- maximum number of datasets waiting to be written
+    '''
+    writequeue = queue.Queue(maxsize=maxqueue)
+    writer = threading.Thread(target=writerworker, args=(writequeue,), name='intermediate-writer', daemon=True)
+    writer.start()
+    logging.debug('Background writer started')
+    return writequeue, writer
+
+
+def stopwriter(writequeue, writer):
+    '''
+    Waits for the queued writes to finish and stops the background writer thread.
+    
+    Return:
+    NA
+    
+    Keyword arguements:
+    writequeue -- queue of saveraster argument tuples
+    writer -- the writer thread
+    '''
+    writequeue.put(None)
+    writer.join()
+    logging.debug('Background writer stopped')
+
+
 def saveVector(od, sievedArray, burnedArray, profile, transform, prename, postname):
     '''
     Saves spatial data to shp file. Calculates the vector layer at the same time 
@@ -509,229 +722,1471 @@ def saveVector(od, sievedArray, burnedArray, profile, transform, prename, postna
     prename -- name of the preburn input image
     postname -- name of the postburn input image
     '''
+    gpd_finalShapes = vectorisepair(sievedArray, burnedArray, transform, prename, postname)
+    writevector(od, gpd_finalShapes, prename, postname)
+
+
+def writevector(od, gpd_finalShapes, prename, postname):
+    '''
+    Saves the burn polygons of a pair to shp file
+    
+    Return:
+    NA
+    
+    Keyword arguements:
+    od -- output directory  
+    gpd_finalShapes -- burn polygons from vectorisepair
+    prename -- name of the preburn input image
+    postname -- name of the postburn input image
+    '''
+    outname = outputbasename(prename, postname) + '.shp'
+
+    # export to shapefile
+    with runmetrics.stage('vectorwrite'):
+        gpd_finalShapes.to_file(os.path.join(od,outname), driver='ESRI Shapefile')
+
+
+def vectorisepair(sievedArray, burnedArray, transform, prename, postname):
+    '''
+    Calculates the burn polygons of a pair: the region grown burn areas that intersect the seed burn areas
+    
+    Return:
+    GeoDataFrame of burn polygons
+    
+    Keyword arguements:
+    sieveArray -- seed burn data
+    burnedArray -- region grown data
+    transform -- transform of the arrays
+    prename -- name of the preburn input image
+    postname -- name of the postburn input image
+    '''
     prename1 = prename
     postname1 = postname
 
     #create output base name
     prename = prename1.split('_')
     postname = postname1.split('_')
-    # satname 
-    outname = prename[0] + prename[1] + prename[3] + prename[4] + '_' + postname[0] + postname[1] + postname[3] + postname[4] + '.shp'
 
 
-    shapes = (
-                {'properties': {'raster_val': v, 'pre': prename1, 'post': postname1, 'predate': prename[1], 'postdate': postname[1],'granule': prename[3]}, 'geometry': s}
-                for i, (s, v) 
-                in enumerate(
-                    rasterio.features.shapes(sievedArray, transform=transform)))
+    with runmetrics.stage('vectorise'):
+        shapes = (
+                    {'properties': {'raster_val': v, 'pre': prename1, 'post': postname1, 'predate': prename[1], 'postdate': postname[1],'granule': prename[3]}, 'geometry': s}
+                    for i, (s, v) 
+                    in enumerate(
+                        rasterio.features.shapes(sievedArray, transform=transform)))
 
 
-    coreShapesGeoms = list(shapes)
-    # convert geoJSON objects to a geopandas data frame
-    gpd_coreShapes  = gpd.GeoDataFrame.from_features(coreShapesGeoms)
-    gpd_coreShapes = gpd_coreShapes.set_crs(epsg=27700)
+        coreShapesGeoms = list(shapes)
+        # convert geoJSON objects to a geopandas data frame
+        gpd_coreShapes  = gpd.GeoDataFrame.from_features(coreShapesGeoms)
+        gpd_coreShapes = gpd_coreShapes.set_crs(epsg=27700)
 
-    # do the same for extended burn areas
-    extendShapes = (
-                {'properties': {'raster_val': v}, 'geometry': s}
-                for i, (s, v) 
-                in enumerate(
-                    rasterio.features.shapes(burnedArray, transform=transform)))
+        # do the same for extended burn areas
+        extendShapes = (
+                    {'properties': {'raster_val': v}, 'geometry': s}
+                    for i, (s, v) 
+                    in enumerate(
+                        rasterio.features.shapes(burnedArray, transform=transform)))
 
-    extendShapesGeoms = list(extendShapes)
+        extendShapesGeoms = list(extendShapes)
 
-    # convert geoJSON objects to a geopandas data frame
-    gpd_extendShapes  = gpd.GeoDataFrame.from_features(extendShapesGeoms)
-    gpd_extendShapes = gpd_extendShapes.set_crs(epsg=27700)
+        # convert geoJSON objects to a geopandas data frame
+        gpd_extendShapes  = gpd.GeoDataFrame.from_features(extendShapesGeoms)
+        gpd_extendShapes = gpd_extendShapes.set_crs(epsg=27700)
 
-    #Use spatial join to detect polygons in extended burn areas that intersect core burn pixels
+        #Use spatial join to detect polygons in extended burn areas that intersect core burn pixels
 
-    # subset the geodataframes to only include rows that are burns
-    gpd_coreBurnShapes = gpd_coreShapes[gpd_coreShapes["raster_val"] == 1.0]
-    gpd_extendBurnShapes = gpd_extendShapes[gpd_extendShapes["raster_val"] == 1.0]
+        # subset the geodataframes to only include rows that are burns
+        gpd_coreBurnShapes = gpd_coreShapes[gpd_coreShapes["raster_val"] == 1.0]
+        gpd_extendBurnShapes = gpd_extendShapes[gpd_extendShapes["raster_val"] == 1.0]
 
-    # indexing needs to be reset to enable spatial join to work properly
-    gpd_coreBurnShapes = gpd_coreBurnShapes.reset_index(drop=True)
-    gpd_extendBurnShapes = gpd_extendBurnShapes.reset_index(drop=True)
+        # indexing needs to be reset to enable spatial join to work properly
+        gpd_coreBurnShapes = gpd_coreBurnShapes.reset_index(drop=True)
+        gpd_extendBurnShapes = gpd_extendBurnShapes.reset_index(drop=True)
 
-    # carry out spatial join
-    gpd_spatialJoin = gpd.sjoin(gpd_extendBurnShapes, gpd_coreBurnShapes, how="inner", op='intersects')
+        # carry out spatial join
+        gpd_spatialJoin = gpd.sjoin(gpd_extendBurnShapes, gpd_coreBurnShapes, how="inner", predicate='intersects')
 
-    # get rid of attribute columns which are not required
-    gpd_spatialJoin = gpd_spatialJoin.drop(columns=['index_right','raster_val_left','raster_val_right'])
+        # get rid of attribute columns which are not required
+        gpd_spatialJoin = gpd_spatialJoin.drop(columns=['index_right','raster_val_left','raster_val_right'])
 
-    # drop duplicate geometries
-    gpd_finalShapes = gpd_spatialJoin.drop_duplicates(subset = 'geometry', keep = 'first')
+        # drop duplicate geometries
+        gpd_finalShapes = gpd_spatialJoin.drop_duplicates(subset = 'geometry', keep = 'first')
 
-    # export to shapefile
-    gpd_finalShapes.to_file(os.path.join(od,outname), driver='ESRI Shapefile')
+    return gpd_finalShapes
 
+
+def pairoutputs(prename, postname):
+    '''
+    Lists the output files written for a pair with the current configuration
+    
+    Return:
+    List of output file names
     
+    Keyword arguements:
+    prename -- name of the preburn input image
+    postname -- name of the postburn input image
+    '''
+    basename = outputbasename(prename, postname)
+    if config.PACKED_RASTERS == 'combined':
+        rasters = ['burnclass']
+    else:
+        rasters = ['burnseed', 'burnarea']
+    return [basename + '_' + r + '.tif' for r in rasters] + [basename + '.shp']
 
 
-# ======================================================================    
-# ========================== MAIN CODE ======================================
-# ======================================================================
+def pairfingerprint(prelist, postlist):
+    '''
+    Builds the fingerprint of everything the outputs of a pair depend on: the identity of both images, their cloud masks and the land mask, 
+    the threshold values, the packing of the burn rasters, the sieve method and the code version
+    
+    Return:
+    Fingerprint dictionary
+    
+    Keyword arguements:
+    prelist -- pre-burn image details [imagename, imagepath, granule, size, date]
+    postlist -- post-burn image details
+    '''
+    checksum = config.MANIFEST_IDENTITY == 'checksum'
+    return {'pre': checkpoint.fileidentity(os.path.join(prelist[1], prelist[0]), checksum),
+            'precloud': checkpoint.fileidentity(cloudpath(prelist), checksum),
+            'post': checkpoint.fileidentity(os.path.join(postlist[1], postlist[0]), checksum),
+            'postcloud': checkpoint.fileidentity(cloudpath(postlist), checksum),
+            'landmask': checkpoint.fileidentity(config.LANDMASK, checksum),
+            'threshold': {k: v for k, v in config.THRESHOLD.items() if k != 'type'},
+            'grow': {k: v for k, v in config.GROW.items() if k != 'type'},
+            'packing': config.PACKED_RASTERS,
+            'sieve': config.SIEVE['method'],
+            'version': VERSION}
+
+
+def cloudpath(imagelist):
+    '''
+    Creates the path of the cloud mask associated with an image
+    
+    Return:
+    Path to the cloud mask
+    
+    Keyword arguements:
+    imagelist -- image details [imagename, imagepath, granule, size, date]
+    '''
+    names = imagelist[0].split('_')[:7]
+    names.append('clouds.tif')
+    s = '_'
+    return os.path.join(imagelist[1], s.join(names))
 
-if __name__ == "__main__":
+
+def inputpaths(imagelist):
+    '''
+    Gives the paths to read an image and its cloud mask from: the local copies in the staging cache when it is in use, otherwise the archive paths
     
-    # Set working directory
-    wd = config.ARD_WRKDIR
+    Return:
+    Image path, cloud mask path
     
-    # Set output directory
-    od = config.GWS_DATA
+    Keyword arguements:
+    imagelist -- image details [imagename, imagepath, granule, size, date]
+    '''
+    imagepath, cloudmaskpath = os.path.join(imagelist[1], imagelist[0]), cloudpath(imagelist)
+    if inputcache is None:
+        return imagepath, cloudmaskpath
+    with runmetrics.stage('stage'):
+        return inputcache.path(imagepath), inputcache.path(cloudmaskpath)
+
+
+def prefetchinputs(upcoming):
+    '''
+    Starts copying the next images of a chain (and their cloud masks) into the staging cache on the background threads, so they are on local disk by the time they are read
     
-    # Set logfile 
-    logfile = os.path.join(od, (datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S")+'-processing.log'))
-    logging.basicConfig(filename=logfile, level=logging.DEBUG, format='%(asctime)s %(message)s')
+    Return:
+    NA
+    
+    Keyword arguements:
+    upcoming -- image details of the images still to be read, in the order they will be read
+    '''
+    if inputcache is None:
+        return
+    sources = []
+    for imagelist in upcoming[:config.STAGE_CACHE['prefetch']]:
+        sources.extend([os.path.join(imagelist[1], imagelist[0]), cloudpath(imagelist)])
+    inputcache.prefetch(sources)
 
-    # Check directory validity
-    directorycheck(wd, od)
-    logging.debug('Directories validated')
 
-    # Get count of files (toggle on-off set in config file)
-    if config.FILECOUNT == 'on':
-        file_count = countfiles(wd)
+def granuleland(record):
+    '''
+    Gets the land mask clipped to the granule of a catalogued image (clipped once per granule)
+    
+    Return:
+    Shapely geometry of the land in the granule
+    
+    Keyword arguements:
+    record -- catalogue record of the image
+    '''
+    key = tuple(record['bounds'])
+    if key not in landclips:
+        landclips[key] = catalogue.landclip(landmask, record['bounds'])
+    return landclips[key]
+
 
-    # Get data and list of processed files
-    # First call in any file names that have been processed. Then get unprocessed files, for the granules in PROC_GRANULES, ignoring certain months listed in MONTHS_OUT
+def imagerecord(imagelist, opennew=True):
+    '''
+    Gets the catalogue record of an image, cataloguing it (a decimated read of one band) if it has no up to date record
+    
+    Return:
+    The record, or None if the image is not catalogued and opennew is False
     
-    landmask = getlandmask(config.LANDMASK)
-    proc_list = picklecheck(od)
-    toprocess = getdatalist(wd, proc_list, config.PROC_GRANULES, config.MONTHS_OUT)
+    Keyword arguements:
+    imagelist -- image details [imagename, imagepath, granule, size, date]
+    opennew -- catalogue images that are not in the catalogue yet (False to use the catalogue only, opening no rasters)
+    '''
+    source = os.path.join(imagelist[1], imagelist[0])
+    if opennew:
+        return catalogue.metadata(od, source, config.CATALOGUE['decimation'])
+    return catalogue.lookup(od, source)
 
-    print('Processing list constructed')
-    logging.debug('Processing list constructed')
-    logging.debug(toprocess)
 
+def imagecoverage(imagelist, opennew=True):
+    '''
+    Estimates the fraction of the land in the granule that has valid data in an image, from its footprint in the catalogue. 
+    The estimate is cached in the catalogue record (for the land mask in use).
+    
+    Return:
+    Fraction of the land with valid data, or None if the image is not catalogued and opennew is False
+    
+    Keyword arguements:
+    imagelist -- image details [imagename, imagepath, granule, size, date]
+    opennew -- catalogue images that are not in the catalogue yet
+    '''
+    record = imagerecord(imagelist, opennew)
+    if record is None:
+        return None
+    landidentity = checkpoint.fileidentity(config.LANDMASK)
+    cached = record.get('landcoverage')
+    if cached is not None and cached['landmask'] == landidentity:
+        return cached['fraction']
 
-    # Start timer
-    starttime1 = datetime.datetime.now()
-    print('--STARTING PROCESSING--')
+    fraction = catalogue.landcoverage([record], granuleland(record))
+    record['landcoverage'] = {'landmask': landidentity, 'fraction': fraction}
+    catalogue.updaterecord(od, os.path.join(imagelist[1], imagelist[0]), record)
+    return fraction
 
-    cleanlist = []
-    # Look for full scenes: remove to process all images (what is effect of null data?)
-    for j in toprocess:
-        if j[3] > 1:
-            cleanlist.append(j)
 
-    # Get total number of files to process
-    tot2process = len(cleanlist)
+def paircovered(prelist, postlist, opennew=True):
+    '''
+    Checks whether enough of the land in the granule has valid data in both images of a pair (IMAGE_SCREEN = 'coverage' only)
+    
+    Return:
+    False if the pair has less than MIN_LAND_COVERAGE valid land, otherwise True (including pairs with images not yet catalogued when opennew is False)
+    
+    Keyword arguements:
+    prelist -- pre-burn image details [imagename, imagepath, granule, size, date]
+    postlist -- post-burn image details
+    opennew -- catalogue images that are not in the catalogue yet
+    '''
+    if config.IMAGE_SCREEN != 'coverage':
+        return True
+    records = [imagerecord(prelist, opennew), imagerecord(postlist, opennew)]
+    if None in records:
+        return True
+    return catalogue.landcoverage(records, granuleland(records[0])) >= config.MIN_LAND_COVERAGE
 
-    # If too few images for comparison, exit the program
-    if len(cleanlist) < 2:
-            print('--EXITING--')
-            print('Too few images to process in test')
-            logging.error('Too few images supplied for processing')
 
-            sys.exit()
+def clearmask(imagelist, opennew=True):
+    '''
+    Gets the land in the granule that is clear of cloud in an image, from a reduced resolution read of its cloud mask (through the staging 
+    cache when it is in use). The mask and the clear fraction are cached in the catalogue record of the image (for the cloud mask and land 
+    mask in use), so each cloud mask is only read once.
+    
+    Return:
+    Catalogue cache entry {'identity', 'fraction', 'land', 'clear'}, or None if the image is not catalogued (or has no cached mask) and opennew is False
+    
+    Keyword arguements:
+    imagelist -- image details [imagename, imagepath, granule, size, date]
+    opennew -- read the cloud masks of images with no cached mask
+    '''
+    record = imagerecord(imagelist, opennew)
+    if record is None:
+        return None
+    identity = {'cloudmask': checkpoint.fileidentity(cloudpath(imagelist)), 'landmask': checkpoint.fileidentity(config.LANDMASK), 'decimation': config.CATALOGUE['decimation']}
+    cached = record.get('clearland')
+    if cached is not None and cached['identity'] == identity and 'clear' in cached:
+        return cached
+    if not opennew:
+        return None
+
+    cloudsource = inputcache.path(cloudpath(imagelist)) if inputcache is not None else cloudpath(imagelist)
+    clear, land = catalogue.clearland(cloudsource, granuleland(record), config.CATALOGUE['decimation'])
+    landcount = int(np.count_nonzero(land))
+    record['clearland'] = {'identity': identity, 'fraction': float(np.count_nonzero(clear)) / max(landcount, 1), 
+                           'land': landcount, 'clear': catalogue.packmask(clear)}
+    catalogue.updaterecord(od, os.path.join(imagelist[1], imagelist[0]), record)
+    return record['clearland']
+
+
+def imageclear(imagelist, opennew=True):
+    '''
+    Estimates the fraction of the land in the granule that is clear of cloud in an image, from its cached clear land mask
+    
+    Return:
+    Fraction of the land clear of cloud, or None if the image is not catalogued and opennew is False
+    
+    Keyword arguements:
+    imagelist -- image details [imagename, imagepath, granule, size, date]
+    opennew -- read the cloud masks of images with no cached mask
+    '''
+    cached = clearmask(imagelist, opennew)
+    return cached['fraction'] if cached is not None else None
 
-    checklist = copy.deepcopy(cleanlist)
 
+def pairclear(prelist, postlist, opennew=True):
+    '''
+    Checks whether enough of the land in the granule is clear of cloud in both images of a pair (CLOUD_SCREEN = 'on' only), from the 
+    cached clear land masks of the two images. A pixel only counts as clear if it is clear in both images, so two images that each pass 
+    the image screen can still fail as a pair when their clouds are in different places.
+    
+    Return:
+    False if more than CLOUD of the land is cloudy in the pre-fire image, the post-fire image or both, otherwise True (also True if either image has no cached mask and opennew is False)
     
-    count = 1
-    runno = 0
-    while len(cleanlist) > 0:
-        print('--GETTING DATA--')
-        runno = runno+1
-        if count == 1:
-            postlist = cleanlist.pop()
+    Keyword arguements:
+    prelist -- pre-burn image details [imagename, imagepath, granule, size, date]
+    postlist -- post-burn image details
+    opennew -- read the cloud masks of images with no cached mask
+    '''
+    if config.CLOUD_SCREEN != 'on':
+        return True
+    precached, postcached = clearmask(prelist, opennew), clearmask(postlist, opennew)
+    if precached is None or postcached is None:
+        return True
+    preclear, postclear = catalogue.unpackmask(precached['clear']), catalogue.unpackmask(postcached['clear'])
+    if preclear.shape != postclear.shape:
+        # masks on different grids cannot be combined pixel by pixel, so fall back to the images on their own
+        return 1 - min(precached['fraction'], postcached['fraction']) <= config.CLOUD
+    clear = float(np.count_nonzero(preclear & postclear)) / max(precached['land'], 1)
+    return 1 - clear <= config.CLOUD
+
+
+def screenimages(toprocess, opennew=True):
+    '''
+    Removes partial granules from the list of images to process: images of MIN_FILE_SIZE GB or less (IMAGE_SCREEN = 'size'), 
+    or images with valid data for less than MIN_LAND_COVERAGE of the land in the granule (IMAGE_SCREEN = 'coverage'). 
+    With CLOUD_SCREEN on, images with more than CLOUD of the land in the granule under cloud are also removed.
+    
+    Return:
+    List of the images to process
+    
+    Keyword arguements:
+    toprocess -- list of image details from the crawl
+    opennew -- catalogue images that are not in the catalogue yet (False keeps images that are not catalogued or have no cached cloud estimate)
+    '''
+    if config.IMAGE_SCREEN == 'size':
+        cleanlist = [j for j in toprocess if j[3] > config.MIN_FILE_SIZE]
+    else:
+        cleanlist = []
+        for j in toprocess:
+            fraction = imagecoverage(j, opennew)
+            if fraction is None or fraction >= config.MIN_LAND_COVERAGE:
+                cleanlist.append(j)
+            else:
+                print('Image below minimum land coverage:', j[0], round(fraction, 3))
+                logging.debug('Image below minimum land coverage: ' + j[0] + ' ' + str(round(fraction, 3)))
+
+    if config.CLOUD_SCREEN != 'on':
+        return cleanlist
+
+    # cloudy images are left out of their chain, so the next image is compared with the last clear one
+    clearlist = []
+    for j in cleanlist:
+        fraction = imageclear(j, opennew)
+        if fraction is None or 1 - fraction <= config.CLOUD:
+            clearlist.append(j)
+        else:
+            print('Image above maximum cloud cover:', j[0], round(1 - fraction, 3))
+            logging.debug('Image above maximum cloud cover: ' + j[0] + ' ' + str(round(1 - fraction, 3)))
+    return clearlist
 
-            # post-fire image
-            # create associated cloud image name
-            names = postlist[0].split('_')[:7]
-            names.append('clouds.tif')
-            s = '_'
-            cloudname = s.join(names)
 
-            postred, postnir, postswir1, postswir2, postprofile = post(os.path.join(postlist[1], postlist[0]), os.path.join(postlist[1], cloudname))
-        
-        
-        count = 2
-        prelist = cleanlist.pop()
-
-        # pre-fire image
-        # create associated cloud image name
-        names = prelist[0].split('_')[:7]
-        names.append('clouds.tif')
-        s = '_'
-        cloudname = s.join(names)
-        prered, prenir, preswir1, preswir2, preprofile, pretransform = pre(os.path.join(prelist[1], prelist[0]), os.path.join(prelist[1], cloudname))
-                
-        if prelist[2]==postlist[2]:
+def checkunit():
+    '''
+    Stops a worker processing a unit whose lease has been lost (checked before each pair), so it does not write the same outputs as the worker now holding the unit
+    
+    Return:
+    NA
+    '''
+    if unitlease is not None:
+        workqueue.checklease(unitlease['lost'], unitlease['unit'])
 
-            #PROCESSING
 
-            print('--CALCULATING postNBR--')
-            #prenbr = nbr(preswir1, prenir)
-            postnbr = nbr(postswir1, postnir)
-            #dnbr = postnbr - prenbr
+def skippair(od, pair, fingerprint, prelist, postlist):
+    '''
+    Checks whether a pair can be skipped without reading its images: it has an up to date completion record, or too little of the land has valid data (or is clear of cloud) in both images
+    
+    Return:
+    True if the pair is skipped
+    
+    Keyword arguements:
+    od -- output directory
+    pair -- output base name of the pair
+    fingerprint -- fingerprint of the pair inputs, parameters and code version
+    prelist -- pre-burn image details [imagename, imagepath, granule, size, date]
+    postlist -- post-burn image details
+    '''
+    if checkpoint.pairuptodate(od, pair, fingerprint):
+        print('Pair already completed:', pair)
+        logging.debug('Pair already completed: ' + pair)
+        return True
+    if not paircovered(prelist, postlist):
+        print('Pair below minimum land coverage:', pair)
+        logging.debug('Pair below minimum land coverage: ' + pair)
+        return True
+    if not pairclear(prelist, postlist):
+        print('Pair above maximum cloud cover:', pair)
+        logging.debug('Pair above maximum cloud cover: ' + pair)
+        return True
+    return False
+
+
+def granulechains(cleanlist):
+    '''
+    Splits the sorted list of images into one date sorted chain per granule
+    
+    Return:
+    List of chains (lists of image details)
+    
+    Keyword arguements:
+    cleanlist -- list of images sorted by granule and date
+    '''
+    chains = []
+    for j in cleanlist:
+        if len(chains) > 0 and chains[-1][-1][2] == j[2]:
+            chains[-1].append(j)
+        else:
+            chains.append([j])
+    return chains
+
+
+def processedimages(chains):
+    '''
+    Lists the images to record as processed. The latest image of each granule is left out so that it is read again as the pre-burn image of the next run.
+    
+    Return:
+    List of image details
+    
+    Keyword arguements:
+    chains -- list of processed chains
+    '''
+    processed = []
+    for chain in chains:
+        processed.extend(chain[:-1])
+    return processed
+
+
+def writeimagelist(od, proc_list):
+    '''
+    Saves the list of processed images to the pickle file (and a text copy for ease of reading)
+    
+    Return:
+    NA
+    
+    Keyword arguements:
+    od -- output directory
+    proc_list -- list of processed images
+    '''
+    # pickle file
+    with open(os.path.join(od, 'imagelist.pkl'),'wb') as outfile:
+        pickle.dump(proc_list,outfile)
+    
+    # text file
+    with open(os.path.join(od, 'imagelist.txt'), 'w') as outfiletxt:
+        outfiletxt.writelines("%s" % line for line in proc_list)
+
+
+def computepair(prebands, postbands, branchpool=None):
+    '''
+    Calculates the indices of a pair and thresholds them into the seed and region grown burn masks
+    
+    Return:
+    Burn seed array, burn area array and a dictionary of the intermediate products (postnbr, dnbr2, dsavi)
+    
+    Keyword arguements:
+    prebands -- dictionary of the red, nir, swir1 and swir2 bands of the pre-fire image (or of its nbr2 and savi, carried over from the last run)
+    postbands -- dictionary of the red, nir, swir1 and swir2 bands of the post-fire image
+    branchpool -- thread pool to run the seed branch on, side by side with the grow branch (None to run them one after the other)
+    '''
+    with runmetrics.stage('index'):
+        print('--CALCULATING postNBR--')
+        #prenbr = nbr(preswir1, prenir)
+        postnbr = nbr(postbands['swir1'], postbands['nir'])
+        #dnbr = postnbr - prenbr
 
 
-            print('--CALCULATING dNBR2--')
-            # Pre/post NBR2 difference
-            dnbr2 = nbr2(postswir2, postswir1) - nbr2(preswir2, preswir1)
+        print('--CALCULATING dNBR2--')
+        # Pre/post NBR2 difference
+        # the pre-fire indices may have been carried over from the last run rather than the bands read
+        prenbr2 = prebands['nbr2'] if 'nbr2' in prebands else nbr2(prebands['swir2'], prebands['swir1'])
+        dnbr2 = nbr2(postbands['swir2'], postbands['swir1']) - prenbr2
 
 
-            print('--CALCULATING dSAVI--')
-            # Pre/post SAVI difference
-            dsavi = savi(postnir, postred) - savi(prenir, prered)
+        print('--CALCULATING dSAVI--')
+        # Pre/post SAVI difference
+        presavi = prebands['savi'] if 'savi' in prebands else savi(prebands['nir'], prebands['red'])
+        dsavi = savi(postbands['nir'], postbands['red']) - presavi
 
 
-            # Thresholding
-            print('--CALCULATING THRESHOLDING--')
-            thresholds = config.THRESHOLD 
-            print('Thresholds used: ', thresholds)
-            burnseed = threshold_imgs(dsavi, postnbr, dnbr2, thresholds)
+    burnseed, burnarray = burnmasks(dsavi, postnbr, dnbr2, branchpool)
+    return burnseed, burnarray, {'postnbr': postnbr, 'dnbr2': dnbr2, 'dsavi': dsavi}
 
-            # Region growing
-            print('--CALCULATING BURN REGIONS--')
-            thresholds = config.GROW 
-            print('Thresholds used: ', thresholds)
-            burnarray = grow_burn(dsavi, postnbr, dnbr2, thresholds)
 
-            # Save data
-            print('--SAVING DATA--')
-            #saveraster(od, postnbr, preprofile, 'postnbr', prelist[0], postlist[0])
-            #saveraster(od, dnbr2, preprofile, 'dnbr2', prelist[0], postlist[0])
-            #saveraster(od, dsavi, preprofile, 'dsavi', prelist[0], postlist[0])
-            saveraster(od, burnseed, preprofile, 'burnseed', prelist[0], postlist[0])
-            saveraster(od, burnarray, preprofile, 'burnarea', prelist[0], postlist[0])
+def burnmasks(dsavi, postnbr, dnbr2, branchpool=None):
+    '''
+    Thresholds the indices of a pair into the seed and region grown burn masks
+    
+    Return:
+    Burn seed array, burn area array
+    
+    Keyword arguements:
+    dsavi -- SAVI difference
+    postnbr -- post-fire NBR
+    dnbr2 -- NBR2 difference
+    branchpool -- thread pool to run the seed branch on, side by side with the grow branch (None to run them one after the other)
+    '''
+    # Thresholding
+    print('--CALCULATING THRESHOLDING--')
+    thresholds = config.THRESHOLD 
+    print('Thresholds used: ', thresholds)
+    if branchpool is not None:
+        seedfuture = branchpool.submit(runmetrics.bind(runmetrics.current(), threshold_imgs), dsavi, postnbr, dnbr2, thresholds)
+    else:
+        burnseed = threshold_imgs(dsavi, postnbr, dnbr2, thresholds)
 
-            saveVector(od, burnseed, burnarray, preprofile, pretransform, prelist[0], postlist[0])
+    # Region growing
+    print('--CALCULATING BURN REGIONS--')
+    thresholds = config.GROW 
+    print('Thresholds used: ', thresholds)
+    burnarray = grow_burn(dsavi, postnbr, dnbr2, thresholds)
+    if branchpool is not None:
+        burnseed = seedfuture.result()
 
-            print('Processed', runno, 'of', tot2process, 'files')
-        
+    return burnseed, burnarray
+
+
+def carryidentity(imagelist):
+    '''
+    Identifies everything the carried over indices of an image depend on: the image, its cloud mask, the land mask and the code version
+    
+    Return:
+    Dictionary describing the inputs
+    
+    Keyword arguements:
+    imagelist -- image details [imagename, imagepath, granule, size, date]
+    '''
+    return {'image': checkpoint.fileidentity(os.path.join(imagelist[1], imagelist[0])), 'cloudmask': checkpoint.fileidentity(cloudpath(imagelist)),
+            'landmask': checkpoint.fileidentity(config.LANDMASK), 'version': VERSION}
+
+
+def savecarry(od, imagelist, bands, profile):
+    '''
+    Saves the pre-fire indices of the latest image of a granule, so the next run does not need to read it again (toggle on-off set in config file)
+    
+    Return:
+    NA
+    
+    Keyword arguements:
+    od -- output directory
+    imagelist -- image details of the latest image of the granule
+    bands -- dictionary of the red, nir, swir1 and swir2 bands of the image
+    profile -- profile of the land cropped image
+    '''
+    if config.CARRY_OVER != 'on':
+        return
+    with runmetrics.stage('carrywrite'):
+        carryover.writecarry(od, imagelist[2], imagelist[0], nbr2(bands['swir2'], bands['swir1']), savi(bands['nir'], bands['red']), profile, carryidentity(imagelist))
+
+
+def commitcarry(od, imagelist):
+    '''
+    Replaces the carry over of a granule with the indices of its latest image saved in this run, once the chain has been processed (toggle on-off set in config file)
+    
+    Return:
+    NA
+    
+    Keyword arguements:
+    od -- output directory
+    imagelist -- image details of the latest image of the granule
+    '''
+    if config.CARRY_OVER != 'on':
+        return
+    # a worker that has lost its unit leaves the carry over to the worker now holding it
+    checkunit()
+    carryover.commitcarry(od, imagelist[2], imagelist[0])
+
+
+def loadcarry(od, imagelist):
+    '''
+    Loads the pre-fire indices of an image carried over from the last run, if they are still valid
+    
+    Return:
+    Dictionary of the nbr2 and savi arrays, profile and transform of the land cropped image, or None, None, None
+    
+    Keyword arguements:
+    od -- output directory
+    imagelist -- image details [imagename, imagepath, granule, size, date]
+    '''
+    if config.CARRY_OVER != 'on':
+        return None, None, None
+    with runmetrics.stage('carryread'):
+        indices, profile = carryover.readcarry(od, imagelist[2], imagelist[0], carryidentity(imagelist))
+    if indices is None:
+        return None, None, None
+    print('Pre-fire indices carried over from the last run:', imagelist[0])
+    return indices, profile, profile['transform']
+
+
+def readburnarea(od, prename, postname):
+    '''
+    Reads the burn area of a pair back from its output raster (the burnarea file, or bit 0 of the burnclass file)
+    
+    Return:
+    Burn area array, profile of the raster
+    
+    Keyword arguements:
+    od -- output directory
+    prename -- name of the preburn input image
+    postname -- name of the postburn input image
+    '''
+    name = 'burnclass' if config.PACKED_RASTERS == 'combined' else 'burnarea'
+    with rasterio.open(os.path.join(od, outputbasename(prename, postname) + '_' + name + '.tif')) as dataset:
+        burnarray = dataset.read(1) & 1
+        return burnarray, dataset.profile.copy()
+
+
+def addfrequency(od, pair, postlist, burnarray, profile):
+    '''
+    Adds the burn area of a pair to the seasonal burn frequency raster of its granule (toggle on-off set in config file)
+    
+    Return:
+    NA
+    
+    Keyword arguements:
+    od -- output directory
+    pair -- output base name of the pair
+    postlist -- post-burn image details [imagename, imagepath, granule, size, date]
+    burnarray -- burn area array of the pair
+    profile -- profile of the land cropped image
+    '''
+    if config.BURN_FREQUENCY != 'on':
+        return
+    with runmetrics.stage('frequency'):
+        seasonal.addpair(od, postlist[2], pair, postlist[4], burnarray == 1, profile)
+
+
+def addmosaic(od, pair, prelist, postlist):
+    '''
+    Adds the burn raster of a pair to the national burn mosaic (toggle on-off set in config file)
+    
+    Return:
+    NA
+    
+    Keyword arguements:
+    od -- output directory
+    pair -- output base name of the pair
+    prelist -- pre-burn image details [imagename, imagepath, granule, size, date]
+    postlist -- post-burn image details [imagename, imagepath, granule, size, date]
+    '''
+    if config.MOSAIC['mode'] != 'on':
+        return
+    name = 'burnclass' if config.PACKED_RASTERS == 'combined' else 'burnarea'
+    path = os.path.join(od, outputbasename(prelist[0], postlist[0]) + '_' + name + '.tif')
+    with runmetrics.stage('mosaic'):
+        mosaic.addpair(od, postlist[2], pair, postlist[4], path, name, mosaic.mosaicgrid(config.MOSAIC))
+
+
+def refreshmosaic(od):
+    '''
+    Rebuilds the national burn mosaic from the source lists of all granules, and refreshes its overviews over the areas added to since the last refresh (toggle on-off set in config file)
+    
+    Return:
+    NA
+    
+    Keyword arguements:
+    od -- output directory
+    '''
+    if config.MOSAIC['mode'] != 'on':
+        return
+    grid = mosaic.mosaicgrid(config.MOSAIC)
+    if config.MOSAIC['overviews'] != 'end':
+        mosaic.rebuildvrt(od, grid)
+        return
+    refreshed = mosaic.refreshoverviews(od, grid)
+    print('Burn mosaic overviews refreshed over', refreshed, 'areas')
+    logging.debug('Burn mosaic overviews refreshed over ' + str(refreshed) + ' areas')
+
+
+def indexoutputs(od):
+    '''
+    Adds the pairs completed since the last update to the burn index of the output directory (toggle on-off set in config file)
+    
+    Return:
+    NA
+    
+    Keyword arguements:
+    od -- output directory
+    '''
+    if config.BURN_INDEX != 'on':
+        return
+    with burnquery.BurnIndex(od, update=False) as index:
+        added, removed = index.updateindex()
+    print('Burn index updated:', added, 'pairs indexed,', removed, 'removed')
+
+
+def savepair(od, burnseed, burnarray, products, profile, transform, prename, postname, writequeue=None, intermediates=None, branchpool=None):
+    '''
+    Saves the burn rasters and vectors of a pair, and hands the intermediate products to the background writer
+    
+    Return:
+    NA
+    
+    Keyword arguements:
+    od -- output directory
+    burnseed -- burn seed array
+    burnarray -- burn area array
+    products -- dictionary of the intermediate products (postnbr, dnbr2, dsavi)
+    profile -- profile of the land cropped image
+    transform -- transform of the land cropped image
+    prename -- name of the preburn input image
+    postname -- name of the postburn input image
+    writequeue -- queue of the background writer for intermediate products
+    intermediates -- names of the intermediate products to save (None for none)
+    branchpool -- thread pool to write the burn seed raster on, side by side with the burn area raster (None to write them one after the other)
+    '''
+    if intermediates is None:
+        intermediates = []
+    print('--SAVING DATA--')
+    # Intermediate products are handed to the background writer (blocks only if the write queue is full)
+    for name in intermediates:
+        writequeue.put((od, products[name], profile, name, prename, postname))
+
+    with runmetrics.stage('rasterwrite'):
+        if config.PACKED_RASTERS == 'combined':
+            saveraster(od, classify_burn(burnseed, burnarray), profile, 'burnclass', prename, postname)
+        elif branchpool is not None:
+            seedfuture = branchpool.submit(saveraster, od, burnseed, profile, 'burnseed', prename, postname)
+            saveraster(od, burnarray, profile, 'burnarea', prename, postname)
+            seedfuture.result()
+        else:
+            saveraster(od, burnseed, profile, 'burnseed', prename, postname)
+            saveraster(od, burnarray, profile, 'burnarea', prename, postname)
+
+    saveVector(od, burnseed, burnarray, profile, transform, prename, postname)
 
 
-        if len(cleanlist) >= 1:
+def baselinechain(chain, od, metricsfile, writequeue=None, intermediates=None):
+    '''
+    Processes the chain of one granule against its rolling baseline (BASELINE = 'on'), working forward from the earliest image. 
+    Each image is read once: it is compared with the baseline (the NBR2 and SAVI of each pixel in the latest image in which it was clear) and then used to update the baseline where it is clear. 
+    The outputs of each image are named as a pair with the image applied to the baseline before it. Images already applied to the baseline are skipped without reading them, 
+    and an image older than the last one applied only fills in the baseline where it holds older values.
+    
+    Return:
+    Number of images compared with the baseline
+    
+    Keyword arguements:
+    chain -- date sorted list of images for one granule
+    od -- output directory
+    metricsfile -- path to the metrics file
+    writequeue -- queue of the background writer for intermediate products
+    intermediates -- names of the intermediate products to save (None for none)
+    '''
+    if intermediates is None:
+        intermediates = []
+    granule = chain[0][2]
+    base, state = baseline.readbaseline(od, granule)
+    if state is None:
+        state = {'granule': granule, 'last': None, 'lastimage': None, 'applied': []}
+
+    branchpool = None
+    if config.BRANCH_THREADS == 'on':
+        branchpool = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='branch', initializer=gdalthread)
+
+    pairs = 0
+    chain = [j for j in chain if j[0] not in state['applied']]
+    print('Images to apply to the baseline for granule', granule, ':', len(chain))
+    try:
+        for i, imagelist in enumerate(chain):
+            checkunit()
+            print('--GETTING DATA--')
+            baserecord = runmetrics.newrecord(imagelist[0], granule)
+            baserecord.update({'engine': 'baseline', 'readgb': imagelist[3]})
+            runmetrics.activate(baserecord)
+            prefetchinputs(chain[i + 1:])
+            red, nir, swir1, swir2, profile, transform = pre(*inputpaths(imagelist))
+
+            with runmetrics.stage('index'):
+                imagenbr2 = nbr2(swir2, swir1)
+                imagesavi = savi(nir, red)
+                # cloud masked, nodata and sea pixels are all 0
+                clear = (nir > 0) & (swir1 > 0)
+
+            if base is not None and base['date'].shape != imagenbr2.shape:
+                logging.warning('Baseline grid does not match the image, starting a new baseline: ' + granule)
+                base = None
+
+            lastimage = state['lastimage']
+            newer = lastimage is None or imagelist[4] >= lastimage[4]
+            if base is not None and newer:
+                pair = outputbasename(lastimage[0], imagelist[0])
+                print('--PROCESSING AGAINST BASELINE--', pair)
+                with runmetrics.stage('index'):
+                    postnbr = nbr(swir1, nir)
+                    dnbr2 = imagenbr2 - base['nbr2']
+                    dsavi = imagesavi - base['savi']
+                burnseed, burnarray = burnmasks(dsavi, postnbr, dnbr2, branchpool)
+                products = {'postnbr': postnbr, 'dnbr2': dnbr2, 'dsavi': dsavi}
+                savepair(od, burnseed, burnarray, products, profile, transform, lastimage[0], imagelist[0], writequeue, intermediates, branchpool)
+                addfrequency(od, pair, imagelist, burnarray, profile)
+                addmosaic(od, pair, lastimage, imagelist)
+                fingerprint = dict(pairfingerprint(lastimage, imagelist), baseline=True)
+                checkpoint.recordpair(od, pair, lastimage, imagelist, pairoutputs(lastimage[0], imagelist[0]), fingerprint)
+                pairs += 1
+            elif base is not None:
+                print('Image older than the baseline, filling in older values only:', imagelist[0])
+                logging.debug('Image older than the baseline: ' + imagelist[0])
+
+            # the baseline is only updated once the outputs are written, so an image interrupted before then is applied again
+            if base is None:
+                base = baseline.newbaseline(imagenbr2.shape)
+            with runmetrics.stage('baseline'):
+                updated = baseline.updatebaseline(base, imagenbr2, imagesavi, clear, imagelist[4])
+                state['applied'].append(imagelist[0])
+                if newer:
+                    state['last'], state['lastimage'] = imagelist[0], imagelist
+                baseline.writebaseline(od, granule, base, profile, state)
+            logging.debug('Baseline pixels updated: ' + str(updated))
+            runmetrics.writerecord(metricsfile, baserecord)
+    finally:
+        if branchpool is not None:
+            branchpool.shutdown()
+        runmetrics.activate(None)
+    return pairs
+
+
+def processchain(chain, od, metricsfile, writequeue=None, intermediates=None):
+    '''
+    Processes each consecutive pair of images in the chain of one granule, working back from the latest image. 
+    Each image is read once: the pre-burn image of one pair is the post-burn image of the next.
+    Pairs with an up to date completion record (same inputs, thresholds and code version, outputs present) are skipped without reading their images, and a record is written as each pair completes.
+    
+    Return:
+    Number of pairs processed
+    
+    Keyword arguements:
+    chain -- date sorted list of images for one granule
+    od -- output directory
+    metricsfile -- path to the metrics file
+    writequeue -- queue of the background writer for intermediate products
+    intermediates -- names of the intermediate products to save (None for none)
+    '''
+    if intermediates is None:
+        intermediates = []
+    if config.BASELINE == 'on':
+        return baselinechain(chain, od, metricsfile, writequeue, intermediates)
+    if config.ENGINE == 'numpy' and config.PIPELINE['mode'] != 'off':
+        return runstaged([chain], od, metricsfile, writequeue, intermediates)
+
+    chain = list(chain)
+    pairs = 0
+    totpairs = len(chain) - 1
+
+    if config.ENGINE == 'dask':
+        # optional engine, only imported (and dask only needed) when selected
+        import daskengine
+
+        # pairs are independent lazy graphs, so each image is read for both of its pairs
+        for i in range(totpairs, 0, -1):
+            checkunit()
+            prelist, postlist = chain[i-1], chain[i]
+            pair = outputbasename(prelist[0], postlist[0])
+            fingerprint = pairfingerprint(prelist, postlist)
+            if skippair(od, pair, fingerprint, prelist, postlist):
+                continue
+
+            pairrecord = runmetrics.newrecord(pair, prelist[2])
+            pairrecord.update({'engine': 'dask', 'readgb': prelist[3] + postlist[3]})
+            runmetrics.activate(pairrecord)
+            print('--PROCESSING PAIR (DASK)--', pair)
+            prefetchinputs(chain[i-2::-1] if i >= 2 else [])
+            daskengine.processpair(prelist, postlist, od, landmask, intermediates, inputpaths(prelist), inputpaths(postlist))
+            if config.BURN_FREQUENCY == 'on':
+                addfrequency(od, pair, postlist, *readburnarea(od, prelist[0], postlist[0]))
+            addmosaic(od, pair, prelist, postlist)
+            checkpoint.recordpair(od, pair, prelist, postlist, pairoutputs(prelist[0], postlist[0]), fingerprint)
+            pairs += 1
+            print('Processed', pairs, 'of', totpairs, 'pairs for granule', prelist[2])
+            runmetrics.writerecord(metricsfile, pairrecord)
+        runmetrics.activate(None)
+        return pairs
+
+    # the seed and grow branches of each pair (and their raster writes) can run side by side on a second thread
+    branchpool = None
+    if config.BRANCH_THREADS == 'on':
+        branchpool = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='branch', initializer=gdalthread)
+
+    # post-fire image (read when the first pair to be processed is reached)
+    postlist = chain.pop()
+    latest = postlist
+    postred = None
+
+    try:
+        while len(chain) > 0:
+            checkunit()
+            prelist = chain.pop()
+            pair = outputbasename(prelist[0], postlist[0])
+            fingerprint = pairfingerprint(prelist, postlist)
+
+            # pairs completed by an earlier run (and still up to date), or with too little valid land, are skipped without reading either image
+            if skippair(od, pair, fingerprint, prelist, postlist):
+                postlist = prelist
+                postred = None
+                continue
+
+            print('--GETTING DATA--')
+            pairrecord = runmetrics.newrecord(pair, prelist[2])
+            pairrecord.update({'engine': 'numpy', 'readgb': prelist[3]})
+            runmetrics.activate(pairrecord)
+
+            # the images of the next pairs are copied to local disk while this one is processed (staging cache only)
+            prefetchinputs(chain[::-1])
+
+            # indices of the first image of the chain carried over from the last run (the carry over of the latest image is only committed after the chain)
+            carried, preprofile, pretransform = loadcarry(od, prelist) if len(chain) == 0 else (None, None, None)
+
+            # post-fire image, unless it was read as the pre-fire image of the previous pair
+            if postred is None:
+                pairrecord['readgb'] += postlist[3]
+                postred, postnir, postswir1, postswir2, postprofile = post(*inputpaths(postlist))
+                if postlist is latest:
+                    savecarry(od, postlist, {'red': postred, 'nir': postnir, 'swir1': postswir1, 'swir2': postswir2}, postprofile)
+
+            # pre-fire image
+            if carried is not None:
+                pairrecord['readgb'] -= prelist[3]
+                prebands = carried
+                prered = prenir = preswir1 = preswir2 = None
+            else:
+                prered, prenir, preswir1, preswir2, preprofile, pretransform = pre(*inputpaths(prelist))
+                prebands = {'red': prered, 'nir': prenir, 'swir1': preswir1, 'swir2': preswir2}
+
+            #PROCESSING
+            postbands = {'red': postred, 'nir': postnir, 'swir1': postswir1, 'swir2': postswir2}
+            burnseed, burnarray, products = computepair(prebands, postbands, branchpool)
+
+            # Save data
+            savepair(od, burnseed, burnarray, products, preprofile, pretransform, prelist[0], postlist[0], writequeue, intermediates, branchpool)
+            addfrequency(od, pair, postlist, burnarray, preprofile)
+            addmosaic(od, pair, prelist, postlist)
+            checkpoint.recordpair(od, pair, prelist, postlist, pairoutputs(prelist[0], postlist[0]), fingerprint)
+
+            pairs += 1
+            print('Processed', pairs, 'of', totpairs, 'pairs for granule', prelist[2])
+            runmetrics.writerecord(metricsfile, pairrecord)
+
+            # the pre-fire image becomes the post-fire image of the next pair
             postlist = prelist
             postred, postnir, postswir1, postswir2, postprofile = prered, prenir, preswir1, preswir2, preprofile
+    finally:
+        if branchpool is not None:
+            branchpool.shutdown()
+        runmetrics.activate(None)
+    commitcarry(od, latest)
+    return pairs
+
+
+def runstaged(chains, od, metricsfile, writequeue=None, intermediates=None):
+    '''
+    Processes the granule chains with the staged pipeline (config.PIPELINE): the read, index/threshold, vectorise and write
+    stages run at the same time on their own threads, connected by bounded queues. Each chain is read by one read worker in
+    the same order as processchain, so each image is still read once, and pairs with an up to date completion record are skipped.
+    With mode 'processes' the index/threshold stage runs in a process pool, with the bands passed in shared memory.
+    
+    Return:
+    Number of pairs processed
     
+    Keyword arguements:
+    chains -- list of date sorted image chains, one per granule
+    od -- output directory
+    metricsfile -- path to the metrics file
+    writequeue -- queue of the background writer for intermediate products
+    intermediates -- names of the intermediate products to save (None for none)
+    '''
+    if intermediates is None:
+        intermediates = []
+    settings = config.PIPELINE
+    shared = settings['mode'] == 'processes'
+    processed = []
+
+    def imagebands(bands):
+        # with compute processes the bands are moved into shared memory (the read copy is dropped once copied)
+        if not shared:
+            return bands, None
+        buffers = sharedbands.SharedBands.fromarrays(bands)
+        return buffers.arrays, buffers
+
+    def readpairs(chain):
+        chain = list(chain)
+        postlist = chain.pop()
+        latest = postlist
+        postbands, postbuffers = None, None
+        while len(chain) > 0:
+            checkunit()
+            prelist = chain.pop()
+            pair = outputbasename(prelist[0], postlist[0])
+            fingerprint = pairfingerprint(prelist, postlist)
+            if skippair(od, pair, fingerprint, prelist, postlist):
+                oldbuffers = postbuffers
+                postlist = prelist
+                postbands, postbuffers = None, None
+                if oldbuffers is not None:
+                    oldbuffers.release()
+                continue
+
+            pairrecord = runmetrics.newrecord(pair, prelist[2])
+            pairrecord.update({'engine': 'numpy', 'readgb': prelist[3]})
+            runmetrics.activate(pairrecord)
+            prefetchinputs(chain[::-1])
+            carried, preprofile, pretransform = loadcarry(od, prelist) if len(chain) == 0 else (None, None, None)
+            if postbands is None:
+                pairrecord['readgb'] += postlist[3]
+                postred, postnir, postswir1, postswir2, postprofile = post(*inputpaths(postlist))
+                postbands = {'red': postred, 'nir': postnir, 'swir1': postswir1, 'swir2': postswir2}
+                del postred, postnir, postswir1, postswir2
+                if postlist is latest:
+                    savecarry(od, postlist, postbands, postprofile)
+                postbands, postbuffers = imagebands(postbands)
+            if carried is not None:
+                pairrecord['readgb'] -= prelist[3]
+                prebands = carried
+            else:
+                prered, prenir, preswir1, preswir2, preprofile, pretransform = pre(*inputpaths(prelist))
+                prebands = {'red': prered, 'nir': prenir, 'swir1': preswir1, 'swir2': preswir2}
+                del prered, prenir, preswir1, preswir2
+            prebands, prebuffers = imagebands(prebands)
+            runmetrics.activate(None)
+
+            # the pair holds the bands of both images until the index/threshold stage has finished with them
+            for buffers in (prebuffers, postbuffers):
+                if buffers is not None:
+                    buffers.hold()
+            yield {'pair': pair, 'fingerprint': fingerprint, 'prelist': prelist, 'postlist': postlist, 'record': pairrecord,
+                   'pre': prebands, 'post': postbands, 'buffers': [prebuffers, postbuffers], 'profile': preprofile, 'transform': pretransform}
+
+            # the pre-fire image becomes the post-fire image of the next pair
+            oldbuffers = postbuffers
+            postlist = prelist
+            postbands, postbuffers = prebands, prebuffers
+            del prebands, prebuffers
+            if oldbuffers is not None:
+                oldbuffers.release()
+
+        postbands = None
+        if postbuffers is not None:
+            postbuffers.release()
+        commitcarry(od, latest)
+
+    def computeitem(item):
+        runmetrics.activate(item['record'])
+        try:
+            if shared:
+                descriptions = [buffers.describe() for buffers in item['buffers']]
+                burnseed, burnarray, products, stagetimes = computepool.submit(stages.computeshared, descriptions[0], descriptions[1], intermediates).result()
+                for name, seconds in stagetimes.items():
+                    runmetrics.addtime(name, seconds)
+            else:
+                burnseed, burnarray, products = computepair(item['pre'], item['post'])
+        finally:
+            # drop the bands so the memory of an image is freed once its second pair has used it
+            del item['pre'], item['post']
+            for buffers in item.pop('buffers'):
+                if buffers is not None:
+                    buffers.release()
+            runmetrics.activate(None)
+        item.update({'burnseed': burnseed, 'burnarray': burnarray, 'products': {name: products[name] for name in intermediates}})
+        return [item]
+
+    def vectoriseitem(item):
+        runmetrics.activate(item['record'])
+        try:
+            item['shapes'] = vectorisepair(item['burnseed'], item['burnarray'], item['transform'], item['prelist'][0], item['postlist'][0])
+        finally:
+            runmetrics.activate(None)
+        return [item]
+
+    def writeitem(item):
+        prelist, postlist, profile = item['prelist'], item['postlist'], item['profile']
+        runmetrics.activate(item['record'])
+        try:
+            print('--SAVING DATA--', item['pair'])
+            for name in intermediates:
+                writequeue.put((od, item['products'][name], profile, name, prelist[0], postlist[0]))
+            with runmetrics.stage('rasterwrite'):
+                if config.PACKED_RASTERS == 'combined':
+                    saveraster(od, classify_burn(item['burnseed'], item['burnarray']), profile, 'burnclass', prelist[0], postlist[0])
+                else:
+                    saveraster(od, item['burnseed'], profile, 'burnseed', prelist[0], postlist[0])
+                    saveraster(od, item['burnarray'], profile, 'burnarea', prelist[0], postlist[0])
+            writevector(od, item['shapes'], prelist[0], postlist[0])
+            addfrequency(od, item['pair'], postlist, item['burnarray'], profile)
+            addmosaic(od, item['pair'], prelist, postlist)
+            checkpoint.recordpair(od, item['pair'], prelist, postlist, pairoutputs(prelist[0], postlist[0]), item['fingerprint'])
+            runmetrics.writerecord(metricsfile, item['record'])
+        finally:
+            runmetrics.activate(None)
+        processed.append(item['pair'])
+        print('Processed pair', len(processed), item['pair'])
+        return []
+
+    workers = settings['workers']
+    pipeline = [stages.Stage('read', readpairs, workers['read']),
+                stages.Stage('compute', computeitem, workers['compute'], settings['queue']),
+                stages.Stage('vectorise', vectoriseitem, workers['vectorise'], settings['queue']),
+                stages.Stage('write', writeitem, workers['write'], settings['queue'])]
+
+    computepool = None
+    if shared:
+        # compute processes are spawned (not forked from a process running threads) and given this run's configuration
+        computesettings = {name: getattr(config, name) for name in ('THRESHOLD', 'GROW', 'SIEVE')}
+        computepool = concurrent.futures.ProcessPoolExecutor(workers['compute'], mp_context=multiprocessing.get_context('spawn'),
+                                                             initializer=stages.initcompute, initargs=(computesettings,))
+    try:
+        walltime = stages.runpipeline(chains, pipeline, initializer=gdalthread)
+    finally:
+        if computepool is not None:
+            computepool.shutdown()
+        sharedbands.releaseall()
+
+    summary = stages.summarisestages(pipeline, walltime)
+    print(summary)
+    logging.debug('Pipeline stages\n' + summary)
+    return len(processed)
+
+
+def planchain(chain, od):
+    '''
+    Works out which pairs of a chain still need processing (using the completion records and catalogue, so no rasters are opened) and the
+    GB of image data each of them will read, following the read pattern of processchain. With MANIFEST_IDENTITY = 'checksum' the 
+    fingerprints of completed pairs are not checked, as that would read every input in full.
+    
+    Return:
+    List of [pair, GB read] for the pairs to process
+    
+    Keyword arguements:
+    chain -- date sorted list of images for one granule
+    od -- output directory
+    '''
+    planned = []
+    if config.BASELINE == 'on':
+        # each image not yet applied to the baseline is read once
+        state = baseline.readstate(od, chain[0][2])
+        lastimage = state['lastimage'] if state is not None else None
+        for imagelist in chain:
+            if state is not None and imagelist[0] in state['applied']:
+                continue
+            if lastimage is not None and imagelist[4] >= lastimage[4]:
+                planned.append([outputbasename(lastimage[0], imagelist[0]), imagelist[3]])
+            lastimage = imagelist
+        return planned
+
+    # checksum fingerprints need a full read of every input, so with MANIFEST_IDENTITY = 'checksum' a pair with a completion record is 
+    # taken as done without checking its fingerprint
+    checkfingerprint = config.MANIFEST_IDENTITY != 'checksum'
+    postread = False
+    for i in range(len(chain) - 1, 0, -1):
+        prelist, postlist = chain[i-1], chain[i]
+        pair = outputbasename(prelist[0], postlist[0])
+        done = checkpoint.pairuptodate(od, pair, pairfingerprint(prelist, postlist)) if checkfingerprint else checkpoint.pairdone(od, pair)
+        if (done or not paircovered(prelist, postlist, opennew=False)
+                or not pairclear(prelist, postlist, opennew=False)):
+            postread = False
+            continue
+        readgb = prelist[3]
+        if i == 1 and config.CARRY_OVER == 'on' and config.ENGINE == 'numpy' and carryover.carryvalid(od, prelist[2], prelist[0], carryidentity(prelist)):
+            # the first image of the chain is carried over from the last run
+            readgb = 0
+        # the NumPy engine reuses the pre-fire image of the previous pair as the post-fire image
+        if not postread or config.ENGINE == 'dask':
+            readgb += postlist[3]
+        planned.append([pair, readgb])
+        postread = True
+    return planned
+
+
+def dryrunreport(chains, od):
+    '''
+    Reports the pairs, GB to read and estimated runtime of each granule chain without processing anything. The runtime is 
+    estimated from the metrics files of earlier runs in the output directory.
+    
+    Return:
+    Report as a string
+    
+    Keyword arguements:
+    chains -- list of date sorted image chains, one per granule
+    od -- output directory
+    '''
+    engine = 'baseline' if config.BASELINE == 'on' else config.ENGINE
+    rates = runmetrics.estimaterates(glob.glob(os.path.join(od, '*-metrics.jsonl')), engine)
+
+    def estimate(planned):
+        if rates is None:
+            return None
+        seconds = rates['fixed'] * len(planned)
+        if rates['pergb'] is not None:
+            seconds += rates['pergb'] * sum(p[1] for p in planned)
+        return seconds
+
+    def hours(seconds):
+        return 'n/a' if seconds is None else '{0:.2f}'.format(seconds / 3600)
+
+    rows = ['{0:<10}{1:>8}{2:>8}{3:>8}{4:>10}{5:>12}'.format('granule', 'images', 'pairs', 'to do', 'GB read', 'est. (hr)')]
+    totals = [0, 0, 0, 0.0]
+    longest = 0
+    for chain in chains:
+        planned = planchain(chain, od)
+        readgb = sum(p[1] for p in planned)
+        seconds = estimate(planned)
+        longest = max(longest, seconds or 0)
+        rows.append('{0:<10}{1:>8}{2:>8}{3:>8}{4:>10.1f}{5:>12}'.format(chain[0][2], len(chain), len(chain) - 1, len(planned), readgb, hours(seconds)))
+        totals = [totals[0] + len(chain), totals[1] + len(chain) - 1, totals[2] + len(planned), totals[3] + readgb]
+
+    alltime = None if rates is None else rates['fixed'] * totals[2] + (rates['pergb'] or 0) * totals[3]
+    rows.append('{0:<10}{1:>8}{2:>8}{3:>8}{4:>10.1f}{5:>12}'.format('total', totals[0], totals[1], totals[2], totals[3], hours(alltime)))
+    rows.append('')
+    if config.MANIFEST_IDENTITY == 'checksum':
+        rows.append('MANIFEST_IDENTITY is checksum, so completed pairs were not checked for changed inputs (pairs to do may be undercounted)')
+    if rates is None:
+        rows.append('No earlier ' + engine + ' metrics in ' + od + ' so no runtime estimate')
+    else:
+        rows.append('Estimate from ' + str(rates['records']) + ' earlier pairs: ' + '{0:.1f}'.format(rates['fixed']) + ' s per pair'
+                    + ('' if rates['pergb'] is None else ' + ' + '{0:.1f}'.format(rates['pergb']) + ' s per GB read'))
+        rows.append('Walltime with one worker per granule (' + str(len(chains)) + ' workers): ' + hours(longest) + ' hr')
+    return '\n'.join(rows)
+
 
+def runworker(od, metricsfile, writequeue=None, intermediates=None):
+    '''
+    Claims work units (granule chains) from the shared queue and processes them until no units are left to claim.
+    Expired leases of other workers are requeued before each claim. A unit whose lease is lost while it is processed is 
+    dropped at the next pair and left to the worker that holds it.
+    
+    Return:
+    Number of units processed
+    
+    Keyword arguements:
+    od -- output directory
+    metricsfile -- path to the metrics file
+    writequeue -- queue of the background writer for intermediate products
+    intermediates -- names of the intermediate products to save (None for none)
+    '''
+    global unitlease
+    if intermediates is None:
+        intermediates = []
+    workqueue.makequeue(config.QUEUE_DIR)
+    units = 0
+    while True:
+        workqueue.requeueexpired(config.QUEUE_DIR, config.LEASE_TIMEOUT, config.MAX_ATTEMPTS)
+        unit = workqueue.claimunit(config.QUEUE_DIR)
+        if unit is None:
+            break
+
+        print('--PROCESSING UNIT--', unit['unit'])
+        logging.debug('Processing unit ' + unit['unit'] + ' as ' + workqueue.workerid())
+        stop, beat, lost = workqueue.startheartbeat(config.QUEUE_DIR, unit, config.LEASE_TIMEOUT / 4)
+        unitlease = {'unit': unit['unit'], 'lost': lost}
+        error = None
+        try:
+            unit['pairs'] = processchain(unit['chain'], od, metricsfile, writequeue, intermediates)
+        except workqueue.LeaseLost:
+            # another worker holds the unit now, so it is neither finished nor failed here
+            logging.warning('Lease lost, unit left to its new owner: ' + unit['unit'])
+            continue
+        except Exception as e:
+            logging.exception('Unit failed: ' + unit['unit'])
+            error = repr(e)
+        finally:
+            workqueue.stopheartbeat(stop, beat)
+            unitlease = None
+
+        if error is None:
+            workqueue.finishunit(config.QUEUE_DIR, unit, 'done')
+            units += 1
+        else:
+            workqueue.finishunit(config.QUEUE_DIR, unit, 'failed', error)
 
-    print('--WRITING OUTPUT--')
-    logging.debug('Writing output file')
+    logging.debug('No units left to claim. Status: ' + str(workqueue.queuestatus(config.QUEUE_DIR)))
+    return units
 
 
-    # pickle file
-    checklist.pop()
-    with open(os.path.join(od, 'imagelist.pkl'),'wb') as outfile:
-        pickle.dump(checklist,outfile)
+# ======================================================================    
+# ========================== MAIN CODE ======================================
+# ======================================================================
+
+if __name__ == "__main__":
     
-    # text file
-    with open(os.path.join(od, 'imagelist.txt'), 'w') as outfiletxt:
-        outfiletxt.writelines("%s" % line for line in checklist)
+    # Set working directory
+    wd = config.ARD_WRKDIR
+    
+    # Set output directory
+    od = config.GWS_DATA
+    
+    # Set logfile 
+    logfile = os.path.join(od, (datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S")+'-' + socket.gethostname() + '-' + str(os.getpid()) + '-processing.log'))
+    logging.basicConfig(filename=logfile, level=logging.DEBUG, format='%(asctime)s %(message)s')
 
-    # clean up temp file
-    if os.path.exists(os.path.join(od, 'temp.tif')):
-        os.remove(os.path.join(od, 'temp.tif'))
-    else:
-        print("The file does not exist")
-        pass
+    # Set metrics file (per pair, per stage timings as JSON lines)
+    metricsfile = logfile.replace('-processing.log', '-metrics.jsonl')
+
+    # GDAL settings for all raster reads and writes (set in config file), recorded in the log
+    with gdalenv():
+        print('GDAL settings: ', config.GDAL_OPTIONS)
+        logging.debug('GDAL ' + rasterio.__gdal_version__ + ' settings: ' + str(rasterio.env.getenv()))
+
+        # Optional memory tracking (toggle on-off set in config file)
+        if config.MEMORY_TRACE == 'on':
+            runmetrics.startmemory()
+            logging.debug('Memory tracking on')
+
+        # Check directory validity
+        directorycheck(wd, od)
+        logging.debug('Directories validated')
+
+        # Check the mosaic grid before any pair is processed, as bad overview factors would only fail at the end of the run
+        if config.MOSAIC['mode'] == 'on':
+            mosaic.mosaicgrid(config.MOSAIC)
+        logging.debug('Run mode: ' + config.RUN_MODE)
+
+        # Get count of files (toggle on-off set in config file)
+        if config.FILECOUNT == 'on':
+            file_count = countfiles(wd)
 
-    # Stop timer
-    endtime1=datetime.datetime.now()
-    deltatime1=endtime1-starttime1
-    print(("Time to process:  {0}  hr:min:sec".format(deltatime1)))
-    logging.debug("Time to process:  {0}  hr:min:sec".format(deltatime1))
+        # the land mask is only needed by the modes that process pairs, and for screening images by their land coverage
+        if config.RUN_MODE not in ('plan', 'dryrun') or config.IMAGE_SCREEN == 'coverage' or config.CLOUD_SCREEN == 'on':
+            landmask = getlandmask(config.LANDMASK)
+
+        # Local staging cache for the inputs (toggle on-off set in config file)
+        if config.STAGE_INPUTS == 'on' and config.RUN_MODE not in ('plan', 'dryrun'):
+            inputcache = stagecache.StageCache(config.STAGE_CACHE['dir'], config.STAGE_CACHE['size_gb'], config.STAGE_CACHE['threads'])
+            logging.debug('Staging cache: ' + config.STAGE_CACHE['dir'])
+
+        # Start timer
+        starttime1 = datetime.datetime.now()
+
+        # Start the background writer if any intermediate products are to be saved
+        intermediates = [k for k, v in config.INTERMEDIATES.items() if v == 'on']
+        writequeue = None
+        if len(intermediates) > 0 and config.RUN_MODE not in ('plan', 'dryrun'):
+            writequeue, writer = startwriter(config.WRITER_QUEUE)
+
+        if config.RUN_MODE == 'work':
+            # Worker: claim and process granule chains from the shared queue
+            print('--STARTING WORKER--')
+            units = runworker(od, metricsfile, writequeue, intermediates)
+            print('Processed', units, 'units')
+
+        else:
+            # Get data and list of processed files
+            # First call in any file names that have been processed. Then get unprocessed files, for the granules in PROC_GRANULES, ignoring certain months listed in MONTHS_OUT
+            # With PROCESSED_CHECK set to 'manifest' every image is crawled and the pair completion records decide what is reprocessed
+            proc_list = picklecheck(od) if config.PROCESSED_CHECK == 'pickle' else []
+
+            if config.RUN_MODE == 'plan':
+                # Record the chains completed by workers since the last plan, and leave out images already queued
+                workqueue.makequeue(config.QUEUE_DIR)
+                doneunits = workqueue.collectdone(config.QUEUE_DIR)
+                proc_list = proc_list + processedimages([u['chain'] for u in doneunits])
+                writeimagelist(od, proc_list)
+                workqueue.removedone(config.QUEUE_DIR, doneunits)
+                refreshmosaic(od)
+                indexoutputs(od)
+                queued = workqueue.queuedimages(config.QUEUE_DIR)
+                proc_list = proc_list + [[name] for name in queued]
+
+            runrecord = runmetrics.newrecord('run')
+            runmetrics.activate(runrecord)
+            with runmetrics.stage('crawl'):
+                toprocess = getdatalist(wd, proc_list, config.PROC_GRANULES, config.MONTHS_OUT)
+
+            print('Processing list constructed')
+            logging.debug('Processing list constructed')
+            logging.debug(toprocess)
+
+            # Screen out partial granules (by file size, or by the valid land coverage from the catalogue) and cloudy images. A dry run only uses images already catalogued.
+            with runmetrics.stage('screen'):
+                cleanlist = screenimages(toprocess, opennew=config.RUN_MODE != 'dryrun')
+            runmetrics.writerecord(metricsfile, runrecord)
+
+            print('--STARTING PROCESSING--')
+
+            # Split into one chain per granule. A chain needs at least two images to make a pair.
+            chains = [c for c in granulechains(cleanlist) if len(c) >= 2]
+
+            # If too few images for comparison, exit the program
+            if len(chains) == 0:
+                    print('--EXITING--')
+                    print('Too few images to process in test')
+                    logging.error('Too few images supplied for processing')
+
+                    sys.exit()
+
+            if config.RUN_MODE == 'plan':
+                # Planner: write the chains to the shared queue for workers to claim
+                planned = workqueue.planunits(config.QUEUE_DIR, chains)
+                print('Planned', len(planned), 'units. Queue status: ', workqueue.queuestatus(config.QUEUE_DIR))
+                logging.debug('Queue status: ' + str(workqueue.queuestatus(config.QUEUE_DIR)))
+                sys.exit()
+
+            if config.RUN_MODE == 'dryrun':
+                # Dry run: report the work and estimated runtime without processing (or recording) anything
+                report = dryrunreport(chains, od)
+                print(report)
+                logging.debug('Dry run\n' + report)
+                sys.exit()
+
+            if config.ENGINE == 'numpy' and config.PIPELINE['mode'] != 'off' and config.BASELINE != 'on':
+                # all chains go through one pipeline, so reading of one granule overlaps processing of another
+                runstaged(chains, od, metricsfile, writequeue, intermediates)
+            else:
+                for chain in chains:
+                    processchain(chain, od, metricsfile, writequeue, intermediates)
+
+            print('--WRITING OUTPUT--')
+            logging.debug('Writing output file')
+            writeimagelist(od, proc_list + processedimages(chains))
+
+        # Wait for any intermediate products still being written
+        if writequeue is not None:
+            stopwriter(writequeue, writer)
+
+        # Bring the overviews of the burn mosaic and the burn index up to date (workers leave them to the next planner run)
+        if config.RUN_MODE == 'single':
+            refreshmosaic(od)
+            indexoutputs(od)
+
+        # Wait for any prefetches still copying
+        if inputcache is not None:
+            print('Staging cache: ', inputcache.close())
+
+        # clean up temp file (and those of the read threads of the pipeline)
+        if os.path.exists(tempname()):
+            os.remove(tempname())
+        else:
+            print("The file does not exist")
+            pass
+        for threadtemp in glob.glob(tempname()[:-len('.tif')] + '_*.tif'):
+            os.remove(threadtemp)
+
+        # Stop timer
+        endtime1=datetime.datetime.now()
+        deltatime1=endtime1-starttime1
+        print(("Time to process:  {0}  hr:min:sec".format(deltatime1)))
+        logging.debug("Time to process:  {0}  hr:min:sec".format(deltatime1))
+
+        # Stage timing summary
+        summary = runmetrics.summarise(metricsfile)
+        print(summary)
+        logging.debug('Stage timing summary\n' + summary)
@@ -0,0 +1,355 @@
+"""
+This module contains the timing instrumentation used when calculating burn locations in Scotland.
+
+Each image pair gets a record holding the time spent in each processing stage. Records are activated per thread, so the
+functions in operationalcode.py can time their own stages without the record being passed through every call. Completed
+records are written as JSON lines to a metrics file next to the processing log, and a summary table can be built from that
+file at the end of a run.
+
+Memory tracking can optionally be switched on. Each stage then also records the resident set size (RSS) of the process at the
+end of the stage, how far the stage raised the peak RSS of the process (from getrusage, so a stage that allocates and frees a
+large array within the stage still shows up) and the peak of Python/NumPy allocations (from tracemalloc) during the stage, and
+each record carries the high-water marks for the pair. When stages of a pair run concurrently (see bind) their times overlap, so
+the stage times of a pair can add up to more than its total. The peak RSS and tracemalloc are process wide, so when stages run
+concurrently on several threads the peaks of a stage include the allocations of the other threads running at the same time.
+
+Pair records also carry the engine used and the GB of image data read for the pair, so that the runtime of a planned run can
+be estimated from earlier runs without opening any rasters (see estimaterates).
+
+Stage names used by the processing code:
+crawl, landcrop, cloudmask, bandread, index, threshold, sieve, vectorise, rasterwrite, vectorwrite
+(the dask engine reads, computes and writes the rasters of a pair lazily, which is recorded as a single compute stage)
+
+"""
+
+# --- Imports ---
+import contextlib
+import datetime
+import json
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+
+
+# --- Constants ---
+# Stages whose time scales with the amount of image data read
+READSTAGES = ('stage', 'landcrop', 'cloudmask', 'bandread')
+
+
+# --- Thread state ---
+_local = threading.local()
+_lock = threading.Lock()
+_memory = {'on': False}
+
+
+# --- Functions ---
+def newrecord(pair, granule=None):
+    '''
+    Creates an empty metrics record for an image pair (or for run level stages such as the crawl)
+
+    Return:
+    Metrics record dictionary
+
+    Keyword arguments:
+    pair -- identifier for the record, normally the output base name of the pair
+    granule -- granule ID
+    '''
+    return {'pair': pair, 'granule': granule, 'stages': {}, 'start': time.perf_counter()}
+
+
+def activate(record):
+    '''
+    Makes the record the one that stage timings on the calling thread are added to. Passing None switches timing off for the thread.
+
+    Return:
+    NA
+
+    Keyword arguments:
+    record -- metrics record dictionary (or None)
+    '''
+    _local.record = record
+
+
+def current():
+    '''
+    Returns the active record for the calling thread
+
+    Return:
+    Metrics record dictionary (or None)
+    '''
+    return getattr(_local, 'record', None)
+
+
+def bind(record, function):
+    '''
+    Wraps a function so that it runs with the record active, for stages run on another thread (e.g. from a thread pool)
+
+    Return:
+    Wrapped function
+
+    Keyword arguments:
+    record -- metrics record dictionary
+    function -- function to wrap
+    '''
+    def bound(*args, **kwargs):
+        previous = current()
+        activate(record)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            activate(previous)
+    return bound
+
+
+def addtime(name, seconds, record=None):
+    '''
+    Adds time to a stage of a record. Repeated stages (e.g. the band read of the pre and post image) are summed.
+
+    Return:
+    NA
+
+    Keyword arguments:
+    name -- stage name
+    seconds -- elapsed time
+    record -- metrics record to add to (defaults to the active record of the calling thread)
+    '''
+    if record is None:
+        record = current()
+    if record is None:
+        return
+    with _lock:
+        record['stages'][name] = record['stages'].get(name, 0.0) + seconds
+
+
+def startmemory():
+    '''
+    Switches on memory tracking for all stages and starts tracemalloc
+
+    Return:
+    NA
+    '''
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+    _memory['on'] = True
+
+
+def stopmemory():
+    '''
+    Switches off memory tracking and stops tracemalloc
+
+    Return:
+    NA
+    '''
+    _memory['on'] = False
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def maxrss():
+    '''
+    Returns the peak resident set size of the process so far in MB, as reported by getrusage (in KB on Linux, bytes on macOS)
+
+    Return:
+    Peak resident set size in MB
+    '''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def rss():
+    '''
+    Returns the current resident set size of the process in MB. Uses /proc on Linux, falling back to the peak RSS reported by getrusage elsewhere.
+
+    Return:
+    Resident set size in MB
+    '''
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        return maxrss()
+
+
+def addmemory(name, rssmb, peakmb, record=None, maxrssmb=None, growthmb=0.0):
+    '''
+    Adds memory readings to a stage of a record, keeping the maximum for repeated stages, and updates the high-water marks of the record
+
+    Return:
+    NA
+
+    Keyword arguments:
+    name -- stage name
+    rssmb -- resident set size at the end of the stage (MB)
+    peakmb -- peak of traced allocations during the stage (MB)
+    record -- metrics record to add to (defaults to the active record of the calling thread)
+    maxrssmb -- peak resident set size of the process at the end of the stage (MB, defaults to rssmb)
+    growthmb -- how far the stage raised the peak resident set size of the process (MB)
+    '''
+    if record is None:
+        record = current()
+    if record is None:
+        return
+    if maxrssmb is None:
+        maxrssmb = rssmb
+    with _lock:
+        memory = record.setdefault('memory', {})
+        stagememory = memory.setdefault(name, {'rss_end_mb': 0.0, 'maxrss_growth_mb': 0.0, 'peak_mb': 0.0})
+        stagememory['rss_end_mb'] = round(max(stagememory['rss_end_mb'], rssmb), 1)
+        stagememory['maxrss_growth_mb'] = round(max(stagememory['maxrss_growth_mb'], growthmb), 1)
+        stagememory['peak_mb'] = round(max(stagememory['peak_mb'], peakmb), 1)
+        record['rss_highwater_mb'] = round(max(record.get('rss_highwater_mb', 0.0), maxrssmb), 1)
+        record['peak_highwater_mb'] = round(max(record.get('peak_highwater_mb', 0.0), peakmb), 1)
+
+
+@contextlib.contextmanager
+def stage(name):
+    '''
+    Context manager that times the enclosed code and adds it to the named stage of the active record.
+    If memory tracking is on, the RSS at the end of the stage, the rise in the peak RSS of the process during the stage and the allocation 
+    peak of the stage are also recorded. Nested stages pass their peak up to the enclosing stage.
+
+    Keyword arguments:
+    name -- stage name
+    '''
+    record = current()
+    memory = _memory['on'] and tracemalloc.is_tracing()
+    if memory:
+        stack = _local.__dict__.setdefault('peaks', [])
+        if len(stack) > 0:
+            stack[-1] = max(stack[-1], tracemalloc.get_traced_memory()[1])
+        stack.append(0)
+        tracemalloc.reset_peak()
+        startmaxrss = maxrss()
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        addtime(name, time.perf_counter() - start, record)
+        if memory:
+            peak = max(tracemalloc.get_traced_memory()[1], stack.pop())
+            if len(stack) > 0:
+                stack[-1] = max(stack[-1], peak)
+            endmaxrss = maxrss()
+            addmemory(name, rss(), peak / (1024 * 1024), record, endmaxrss, endmaxrss - startmaxrss)
+
+
+def writerecord(metricsfile, record):
+    '''
+    Appends a completed record to the metrics file as a single JSON line
+
+    Return:
+    NA
+
+    Keyword arguments:
+    metricsfile -- path to the JSON lines metrics file
+    record -- metrics record dictionary
+    '''
+    line = {'time': datetime.datetime.now().isoformat(timespec='seconds'),
+            'pair': record['pair'],
+            'granule': record['granule'],
+            'total': round(time.perf_counter() - record['start'], 4),
+            'stages': {k: round(v, 4) for k, v in record['stages'].items()}}
+    if _memory['on']:
+        addmemory('end', rss(), 0.0, record, maxrss())
+    for k, v in record.items():
+        if k not in ('pair', 'granule', 'stages', 'start'):
+            line[k] = v
+
+    with _lock:
+        with open(metricsfile, 'a') as outfile:
+            outfile.write(json.dumps(line) + '\n')
+
+
+def readmetrics(metricsfiles):
+    '''
+    Reads records back from one or more metrics files. Lines that cannot be parsed (e.g. from a killed run) are skipped.
+
+    Return:
+    List of record dictionaries
+
+    Keyword arguments:
+    metricsfiles -- path, or list of paths, to JSON lines metrics files
+    '''
+    if isinstance(metricsfiles, str):
+        metricsfiles = [metricsfiles]
+
+    records = []
+    for metricsfile in metricsfiles:
+        if not os.path.isfile(metricsfile):
+            continue
+        with open(metricsfile) as infile:
+            for line in infile:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    return records
+
+
+def summarise(metricsfiles):
+    '''
+    Builds a summary table of the stage timings of the pair records in the metrics file(s)
+
+    Return:
+    Summary table as a string
+
+    Keyword arguments:
+    metricsfiles -- path, or list of paths, to JSON lines metrics files
+    '''
+    totals = {}
+    memory = {}
+    for record in readmetrics(metricsfiles):
+        for name, seconds in record['stages'].items():
+            totals.setdefault(name, []).append(seconds)
+        for name, readings in record.get('memory', {}).items():
+            peaks = memory.setdefault(name, [0.0, 0.0, 0.0])
+            # records from older runs only have the RSS at the end of each stage
+            peaks[0] = max(peaks[0], readings.get('rss_end_mb', readings.get('rss_mb', 0.0)))
+            peaks[1] = max(peaks[1], readings.get('maxrss_growth_mb', 0.0))
+            peaks[2] = max(peaks[2], readings['peak_mb'])
+
+    alltime = sum(sum(v) for v in totals.values())
+    rows = ['{0:<14}{1:>8}{2:>12}{3:>10}{4:>10}{5:>8}'.format('stage', 'count', 'total (s)', 'mean (s)', 'max (s)', '%')]
+    for name, times in sorted(totals.items(), key=lambda x: sum(x[1]), reverse=True):
+        share = 100 * sum(times) / alltime if alltime > 0 else 0
+        rows.append('{0:<14}{1:>8}{2:>12.1f}{3:>10.2f}{4:>10.2f}{5:>8.1f}'.format(name, len(times), sum(times), sum(times) / len(times), max(times), share))
+
+    if len(memory) > 0:
+        rows.append('')
+        rows.append('{0:<14}{1:>16}{2:>20}{3:>18}'.format('stage', 'end RSS (MB)', 'peak RSS rise (MB)', 'max alloc (MB)'))
+        for name, peaks in sorted(memory.items(), key=lambda x: x[1][0], reverse=True):
+            rows.append('{0:<14}{1:>16.1f}{2:>20.1f}{3:>18.1f}'.format(name, peaks[0], peaks[1], peaks[2]))
+    return '\n'.join(rows)
+
+
+def estimaterates(metricsfiles, engine=None):
+    '''
+    Estimates the cost of processing a pair from the pair records of earlier runs: a fixed time per pair (index, threshold,
+    sieve, vectorise and write) plus a read time per GB of image data. Records without the GB read only give a mean time per pair.
+
+    Return:
+    Dictionary of the number of records used, fixed seconds per pair and read seconds per GB (None if it cannot be estimated),
+    or None if there are no pair records
+
+    Keyword arguments:
+    metricsfiles -- path, or list of paths, to JSON lines metrics files
+    engine -- only use records from this engine ('numpy' or 'dask')
+    '''
+    records = [r for r in readmetrics(metricsfiles) if r['pair'] != 'run' and 'total' in r]
+    if engine is not None:
+        records = [r for r in records if r.get('engine', engine) == engine]
+    if len(records) == 0:
+        return None
+
+    sized = [r for r in records if r.get('readgb', 0) > 0]
+    if len(sized) == 0:
+        return {'records': len(records), 'fixed': sum(r['total'] for r in records) / len(records), 'pergb': None}
+
+    readtime = [sum(r['stages'].get(name, 0.0) for name in READSTAGES) for r in sized]
+    pergb = sum(readtime) / sum(r['readgb'] for r in sized)
+    fixed = sum(r['total'] - t for r, t in zip(sized, readtime)) / len(sized)
+    return {'records': len(sized), 'fixed': fixed, 'pergb': pergb}
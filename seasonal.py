@@ -0,0 +1,199 @@
+"""
+This module contains the seasonal burn frequency rasters used when calculating burn locations in Scotland
+(config.BURN_FREQUENCY = 'on').
+
+Each pair writes its own burn area raster, so finding how often a pixel has burned in a season means opening every burn
+area output. Instead, as each pair completes, its burn area is added to a burn frequency raster for the granule and season
+(the year of the post-fire image, as the autumn and winter months are not processed) in the season folder of the output
+directory:
+
+    season/<year>/<granule>_burnfrequency.tif   3 band UInt16 Cloud Optimized GeoTIFF on the land cropped grid
+        band 1  number of pairs in which the pixel was burned
+        band 2  day of the year of the post-fire image of the first pair in which the pixel was burned (0 = not burned)
+        band 3  day of the year of the post-fire image of the last pair in which the pixel was burned (0 = not burned)
+
+    season/<year>/<granule>_burnfrequency.json  pairs already added
+    season/<year>/<granule>_burnfrequency.lock  held while the raster and the JSON file are updated
+
+A pair is only added once, so a pair that is processed again (e.g. after a crash) is not counted twice. The pairs counted in
+the raster are listed in its own metadata (tag 'pairs'), so the counts and the list of pairs are replaced together and a crash
+between writing the raster and the JSON file cannot lead to a pair being counted again. Pairs without burned pixels are
+recorded in the JSON file only, without rewriting the raster. The JSON file lists all the pairs added (those in the raster
+metadata are added back to it if it was not written). To rebuild a season after a change of thresholds, delete its folder and
+process the pairs again. The rasters are written as COGs (tiled, compressed, with overviews) to a temporary file and renamed,
+so they can be read by GIS tools or over HTTP while a run is adding to them. A pair is only added while holding the lock file
+of the granule and season (created exclusively, so only one process on any node can hold it), so workers sharing the output
+directory cannot read the same raster and drop each other's counts when they replace it.
+
+"""
+
+# --- Imports ---
+import datetime
+import json
+import logging
+import os
+import socket
+import threading
+
+import numpy as np
+import rasterio
+import rasterio.shutil
+from rasterio.io import MemoryFile
+
+from workqueue import filelock, readjson, writejson
+
+
+# --- Constants ---
+SEASON = 'season'
+
+# Band names of the burn frequency raster
+BANDS = ['count', 'first', 'last']
+
+
+# --- Process state ---
+# threads of a process wait for each other here rather than all polling the lock file
+_lock = threading.Lock()
+
+
+# --- Functions ---
+def frequencypath(od, season, granule):
+    '''
+    Builds the path of the burn frequency raster of a granule and season
+
+    Return:
+    Path to the raster
+
+    Keyword arguments:
+    od -- output directory
+    season -- season (year) as a string
+    granule -- granule name (e.g. T30VVJ)
+    '''
+    return os.path.join(od, SEASON, season, granule + '_burnfrequency.tif')
+
+
+def seasonday(date):
+    '''
+    Splits an image date into its season and day of the year
+
+    Return:
+    Season (year) as a string, day of the year
+
+    Keyword arguments:
+    date -- image date as YYYYMMDD
+    '''
+    day = datetime.datetime.strptime(date, '%Y%m%d')
+    return date[:4], day.timetuple().tm_yday
+
+
+def rasterpairs(path):
+    '''
+    Reads the list of pairs counted in a burn frequency raster from its metadata
+
+    Return:
+    List of pair names (empty if the raster does not exist)
+
+    Keyword arguments:
+    path -- path of the raster
+    '''
+    if not os.path.isfile(path):
+        return []
+    with rasterio.open(path) as dataset:
+        return json.loads(dataset.tags().get('pairs', '[]'))
+
+
+def readfrequency(path):
+    '''
+    Reads a burn frequency raster
+
+    Return:
+    Dictionary of the count, first and last arrays
+
+    Keyword arguments:
+    path -- path of the raster
+    '''
+    with rasterio.open(path) as dataset:
+        return {name: dataset.read(i + 1) for i, name in enumerate(BANDS)}
+
+
+def writefrequency(path, frequency, profile, pairs):
+    '''
+    Writes a burn frequency raster as a Cloud Optimized GeoTIFF, with the pairs counted in its metadata. The raster is built in memory, copied to a temporary file and renamed.
+
+    Return:
+    NA
+
+    Keyword arguments:
+    path -- path of the raster
+    frequency -- dictionary of the count, first and last arrays
+    profile -- profile of the land cropped granule grid
+    pairs -- names of the pairs counted in the raster
+    '''
+    profile = profile.copy()
+    for key in ['nbits', 'compress', 'predictor', 'tiled', 'blockxsize', 'blockysize', 'interleave', 'photometric']:
+        profile.pop(key, None)
+    profile.update({'driver': 'GTiff', 'count': len(BANDS), 'dtype': rasterio.uint16, 'nodata': None})
+
+    temppath = path + '.' + socket.gethostname() + '.' + str(os.getpid()) + '.tmp.tif'
+    with MemoryFile() as memfile:
+        with memfile.open(**profile) as dataset:
+            for i, name in enumerate(BANDS):
+                dataset.write(frequency[name], i + 1)
+                dataset.set_band_description(i + 1, name)
+            dataset.update_tags(pairs=json.dumps(pairs))
+        with memfile.open() as dataset:
+            rasterio.shutil.copy(dataset, temppath, driver='COG', compress='DEFLATE', predictor=2, overview_resampling='nearest')
+    os.replace(temppath, path)
+
+
+def addpair(od, granule, pair, date, burned, profile):
+    '''
+    Adds the burn area of a pair to the burn frequency raster of its granule and season, unless the pair has been added already
+
+    Return:
+    True if the pair was added
+
+    Keyword arguments:
+    od -- output directory
+    granule -- granule name
+    pair -- output base name of the pair
+    date -- date of the post-fire image as YYYYMMDD
+    burned -- boolean array of the burned pixels of the pair
+    profile -- profile of the land cropped granule grid
+    '''
+    season, day = seasonday(date)
+    path = frequencypath(od, season, granule)
+    statepath = path[:-len('.tif')] + '.json'
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with _lock, filelock(path[:-len('.tif')] + '.lock'):
+        state = readjson(statepath) if os.path.isfile(statepath) else {'granule': granule, 'season': season, 'pairs': []}
+        counted = rasterpairs(path)
+        # pairs counted in the raster before a crash stopped the JSON file being written
+        missing = [p for p in counted if p not in state['pairs']]
+        state['pairs'].extend(missing)
+        if pair in state['pairs']:
+            if missing:
+                writejson(statepath, state)
+            logging.debug('Pair already in the burn frequency raster: ' + pair)
+            return False
+
+        if np.any(burned):
+            if os.path.isfile(path):
+                frequency = readfrequency(path)
+                if frequency['count'].shape != burned.shape:
+                    raise ValueError('Burn frequency raster does not match the grid of pair ' + pair + ': ' + path)
+            else:
+                frequency = {name: np.zeros(burned.shape, dtype=np.uint16) for name in BANDS}
+
+            count = frequency['count']
+            count[burned & (count < np.iinfo(np.uint16).max)] += 1
+            first = frequency['first']
+            first[burned & ((first == 0) | (first > day))] = day
+            last = frequency['last']
+            last[burned & (last < day)] = day
+            writefrequency(path, frequency, profile, counted + [pair])
+
+        state['pairs'].append(pair)
+        writejson(statepath, state)
+    logging.debug('Pair added to the burn frequency raster: ' + pair)
+    return True
@@ -0,0 +1,215 @@
+"""
+This module contains the shared memory band buffers used to pass image bands between processes when calculating burn
+locations in Scotland.
+
+Passing the full granule band arrays returned by pre/post to another process by pickling copies each array (around 1 GB per
+float64 band). Instead a process holds the bands of an image in one shared memory block and passes a small description of
+the block (its name and the name, shape, data type and offset of each band) to the other processes, which attach to the same
+memory and use the bands as NumPy arrays without copying them.
+
+Buffer lifecycle:
+
+    create/fromarrays  the creating process allocates the block (and owns it until it is unlinked)
+    describe           a picklable description is sent to the consuming process(es), e.g. on a multiprocessing queue
+    attach             each consumer maps the block and gets NumPy views of the bands
+    close              each process (creator included) drops its views and unmaps the block when it has finished with it
+    unlink             one process (normally the last consumer) frees the block. The memory is returned to the system once
+                       every process has closed it
+
+In the creating process a block can be used by several consumers at once (e.g. an image that is the pre-fire image of one
+pair and the post-fire image of the next). hold and release count the users of the block; the last release closes and
+unlinks it.
+
+A block that is never unlinked stays in /dev/shm after the run, so the creating process records the blocks it owns and
+releaseall can be called (e.g. in a finally block) to unlink any that are left after an error. The processes sharing a block
+should be started with multiprocessing from the same parent, so that they share the resource tracker that cleans up after
+processes that are killed.
+
+"""
+
+# --- Imports ---
+import logging
+import sys
+import threading
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+# --- Constants ---
+# Byte alignment of each band within a block
+ALIGN = 64
+
+
+# --- Process state ---
+# blocks created by this process and not yet unlinked, by block name
+_owned = {}
+
+
+# --- Classes ---
+class SharedBands:
+    '''
+    A set of named 2D band arrays held in one shared memory block
+    '''
+    def __init__(self, shm, layout, owner=False):
+        self.shm = shm
+        self.layout = layout
+        self.owner = owner
+        self.users = 1
+        self.lock = threading.Lock()
+        self.arrays = {name: np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf, offset=offset)
+                       for name, shape, dtype, offset in layout}
+
+    @classmethod
+    def create(cls, bands):
+        '''
+        Allocates a new block for bands of the given shapes and data types (contents are not initialised)
+
+        Return:
+        SharedBands owned by this process
+
+        Keyword arguments:
+        bands -- list of (name, shape, dtype) for each band
+        '''
+        layout = []
+        size = 0
+        for name, shape, dtype in bands:
+            offset = -(-size // ALIGN) * ALIGN
+            layout.append((name, tuple(shape), np.dtype(dtype).str, offset))
+            size = offset + int(np.prod(shape)) * np.dtype(dtype).itemsize
+
+        shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        _owned[shm.name] = shm
+        logging.debug('Shared band buffer created: ' + shm.name + ' (' + str(round(size / (1024 * 1024), 1)) + ' MB)')
+        return cls(shm, layout, owner=True)
+
+    @classmethod
+    def fromarrays(cls, arrays):
+        '''
+        Allocates a new block and copies the arrays into it (the one copy made by the process that read them)
+
+        Return:
+        SharedBands owned by this process
+
+        Keyword arguments:
+        arrays -- dictionary of band name to NumPy array
+        '''
+        buffers = cls.create([(name, array.shape, array.dtype) for name, array in arrays.items()])
+        for name, array in arrays.items():
+            buffers.arrays[name][...] = array
+        return buffers
+
+    @classmethod
+    def attach(cls, description):
+        '''
+        Attaches to a block created by another process, without copying the bands
+
+        Return:
+        SharedBands (not owned by this process)
+
+        Keyword arguments:
+        description -- description returned by describe in the creating process
+        '''
+        if sys.version_info >= (3, 13):
+            # the creating process is responsible for the block, so it is not tracked again here
+            shm = shared_memory.SharedMemory(name=description['name'], track=False)
+        else:
+            shm = shared_memory.SharedMemory(name=description['name'])
+        return cls(shm, [tuple(band) for band in description['layout']])
+
+    def describe(self):
+        '''
+        Builds a picklable description of the block to send to other processes
+
+        Return:
+        Dictionary of the block name and band layout
+        '''
+        return {'name': self.shm.name, 'layout': self.layout}
+
+    def close(self):
+        '''
+        Drops the band views of this process and unmaps the block. Any other references to the band arrays must be deleted first.
+
+        Return:
+        NA
+        '''
+        self.arrays = {}
+        try:
+            self.shm.close()
+        except BufferError:
+            # band arrays are still referenced (e.g. by an error traceback); the block is unmapped when they are deleted
+            logging.warning('Shared band buffer still in use when closed: ' + self.shm.name)
+
+    def unlink(self):
+        '''
+        Frees the block. Can be called from any process attached to it; the memory is released once all processes have closed it.
+
+        Return:
+        NA
+        '''
+        name = self.shm.name
+        try:
+            self.shm.unlink()
+        except FileNotFoundError:
+            logging.warning('Shared band buffer already unlinked: ' + name)
+        _owned.pop(name, None)
+        logging.debug('Shared band buffer unlinked: ' + name)
+
+    def hold(self):
+        '''
+        Adds a user of the block (the creator is the first user)
+
+        Return:
+        NA
+        '''
+        with self.lock:
+            self.users += 1
+
+    def release(self):
+        '''
+        Removes a user of the block. The block is closed, and unlinked if this process owns it, when no users are left.
+
+        Return:
+        NA
+        '''
+        with self.lock:
+            self.users -= 1
+            last = self.users == 0
+        if last:
+            self.close()
+            if self.owner:
+                self.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        if self.owner:
+            self.unlink()
+
+
+# --- Functions ---
+def releaseall():
+    '''
+    Unlinks any blocks created by this process that have not been unlinked (e.g. after an error in a consumer)
+
+    Return:
+    Number of blocks released
+    '''
+    released = 0
+    for name, shm in list(_owned.items()):
+        try:
+            shm.unlink()
+            released += 1
+        except FileNotFoundError:
+            pass
+        try:
+            shm.close()
+        except BufferError:
+            # views are still held in this process; the memory is freed when they are deleted
+            pass
+        _owned.pop(name, None)
+    if released > 0:
+        logging.warning('Released ' + str(released) + ' shared band buffers left after an error')
+    return released
@@ -0,0 +1,224 @@
+"""
+This module contains the local staging cache for the ARD inputs used when calculating burn locations in Scotland
+(config.STAGE_INPUTS = 'on').
+
+Images and cloud masks are copied from the archive (e.g. /neodc) to node local scratch before they are read, and later runs
+on the same node (reruns, threshold experiments, overlapping date windows) read the local copy instead of pulling the file
+across the network again. Each copy is held in its own folder named from a hash of the source path and the source size and
+modification time, so a file that is reprocessed in the archive gets a new copy and the old one is never read again:
+
+    <cache folder>/<path hash>_<size>_<mtime>/<file name>
+
+The cache is bounded in size. The modification time of a copy is updated each time it is used, and before a new file is
+copied the least recently used copies are deleted until the new file fits. Copies used in the last PROTECT seconds are not
+deleted, so a file another process on the node is about to read is not removed under it.
+
+Upcoming files can be prefetched on background threads while the current pair is processed. A file being copied is only
+copied once: requests for it wait for the copy in progress. Copies are written to a temporary name and renamed into place,
+so processes sharing the cache folder never read a partial copy.
+
+"""
+
+# --- Imports ---
+import concurrent.futures
+import hashlib
+import logging
+import os
+import shutil
+import socket
+import threading
+import time
+
+
+# --- Constants ---
+# Seconds after its last use during which a copy is not evicted
+PROTECT = 600
+
+
+# --- Classes ---
+class StageCache:
+    '''
+    Size bounded least recently used cache of input files on local disk, with background prefetch
+    '''
+    def __init__(self, cachedir, maxgb, threads=2):
+        self.cachedir = cachedir
+        self.maxbytes = int(maxgb * 1024 ** 3)
+        self.lock = threading.Lock()
+        self.inflight = {}
+        self.sources = {}
+        self.pool = concurrent.futures.ThreadPoolExecutor(threads, thread_name_prefix='prefetch')
+        self.counts = {'hits': 0, 'copies': 0, 'evicted': 0, 'copiedgb': 0.0}
+        os.makedirs(cachedir, exist_ok=True)
+
+    def entry(self, source):
+        '''
+        Builds the path of the local copy of a source file for its current size and modification time
+
+        Return:
+        Path of the local copy and the size of the source file (bytes)
+
+        Keyword arguments:
+        source -- path of the source file
+        '''
+        stat = os.stat(source)
+        key = hashlib.sha1(os.path.abspath(source).encode()).hexdigest()[:16] + '_' + str(stat.st_size) + '_' + str(stat.st_mtime_ns)
+        return os.path.join(self.cachedir, key, os.path.basename(source)), stat.st_size
+
+    def path(self, source):
+        '''
+        Returns the path of the local copy of a source file, copying it into the cache first if needed (or waiting for a
+        prefetch of it in progress). If the file cannot be copied the source path is returned.
+
+        Return:
+        Path to read the file from
+
+        Keyword arguments:
+        source -- path of the source file
+        '''
+        with self.lock:
+            future = self.inflight.get(source)
+            if future is None:
+                future = concurrent.futures.Future()
+                self.inflight[source] = future
+                owner = True
+            else:
+                owner = False
+
+        if not owner:
+            return future.result()
+
+        try:
+            local = self.stage(source)
+        except OSError:
+            logging.exception('Staging failed, reading from source: ' + source)
+            local = source
+        finally:
+            with self.lock:
+                self.inflight.pop(source, None)
+        future.set_result(local)
+        return local
+
+    def stage(self, source):
+        '''
+        Copies a source file into the cache unless an up to date copy is already there, and marks the copy as used
+
+        Return:
+        Path of the local copy
+
+        Keyword arguments:
+        source -- path of the source file
+        '''
+        local, size = self.entry(source)
+        self.sources[local] = source
+        if os.path.isfile(local):
+            os.utime(local)
+            with self.lock:
+                self.counts['hits'] += 1
+            return local
+
+        self.evict(size)
+        os.makedirs(os.path.dirname(local), exist_ok=True)
+        temppath = local + '.' + socket.gethostname() + '.' + str(os.getpid()) + '.' + str(threading.get_ident()) + '.tmp'
+        start = time.perf_counter()
+        try:
+            shutil.copyfile(source, temppath)
+            os.replace(temppath, local)
+        finally:
+            if os.path.exists(temppath):
+                os.remove(temppath)
+        with self.lock:
+            self.counts['copies'] += 1
+            self.counts['copiedgb'] += size / 1024 ** 3
+        logging.debug('Staged ' + source + ' (' + str(round(size / 1024 ** 2)) + ' MB in ' + str(round(time.perf_counter() - start, 1)) + ' s)')
+        return local
+
+    def source(self, local):
+        '''
+        Gives the source path of a local copy (paths that are not copies in the cache are returned unchanged)
+
+        Return:
+        Path of the source file
+
+        Keyword arguments:
+        local -- path of the local copy
+        '''
+        return self.sources.get(local, local)
+
+    def entries(self):
+        '''
+        Lists the copies in the cache
+
+        Return:
+        List of (last use time, size, path) for each copy
+        '''
+        found = []
+        for folder in os.scandir(self.cachedir):
+            if not folder.is_dir():
+                continue
+            for item in os.scandir(folder.path):
+                if item.name.endswith('.tmp'):
+                    continue
+                try:
+                    stat = item.stat()
+                except FileNotFoundError:
+                    continue
+                found.append((stat.st_mtime, stat.st_size, item.path))
+        return found
+
+    def evict(self, needed):
+        '''
+        Deletes the least recently used copies until the cache has room for a new file
+
+        Return:
+        NA
+
+        Keyword arguments:
+        needed -- size of the new file (bytes)
+        '''
+        found = sorted(self.entries())
+        used = sum(f[1] for f in found)
+        now = time.time()
+        for lastused, size, path in found:
+            if used + needed <= self.maxbytes:
+                break
+            if now - lastused < PROTECT:
+                # everything after this copy has been used more recently still
+                break
+            try:
+                os.remove(path)
+                os.rmdir(os.path.dirname(path))
+            except OSError:
+                continue
+            used -= size
+            with self.lock:
+                self.counts['evicted'] += 1
+            logging.debug('Evicted from staging cache: ' + path)
+        if used + needed > self.maxbytes:
+            logging.warning('Staging cache over its size limit (all copies recently used): ' + str(round((used + needed) / 1024 ** 3, 1)) + ' GB')
+
+    def prefetch(self, sources):
+        '''
+        Starts copying files that will be needed soon on the background threads
+
+        Return:
+        NA
+
+        Keyword arguments:
+        sources -- paths of the source files, in the order they will be needed
+        '''
+        for source in sources:
+            with self.lock:
+                if source in self.inflight:
+                    continue
+            self.pool.submit(self.path, source)
+
+    def close(self):
+        '''
+        Stops the prefetch threads (waiting for copies in progress) and logs the cache use
+
+        Return:
+        Dictionary of cache hits, copies, evictions and GB copied
+        '''
+        self.pool.shutdown(wait=True)
+        logging.debug('Staging cache: ' + str(self.counts))
+        return self.counts
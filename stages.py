@@ -0,0 +1,191 @@
+"""
+This module contains the staged pipeline used when calculating burn locations in Scotland (config.PIPELINE['mode'] set to
+'threads' or 'processes').
+
+The processing of the image pairs is split into stages (read and mask, index and threshold, vectorise, write) connected by
+bounded queues. Each stage has its own number of worker threads. A worker takes an item off its input queue, runs the stage
+function and puts the results on the queue of the next stage, waiting while that queue is full. A slow stage therefore holds
+back the stages before it (backpressure) and the number of pairs held in memory is bounded by the queue sizes. The stages
+overlap, so the CPU works on one pair while the disk reads or writes another, and the throughput is set by the slowest stage
+rather than by the sum of all of them. The time each stage spends working, waiting for input and waiting for space in the
+next queue is counted, so the stage that limits the run can be seen in the log.
+
+With 'processes' the index and threshold stage hands each pair to a process pool (computeshared). The bands are passed in
+shared memory (sharedbands.py) rather than pickled, and only the burn masks come back.
+
+"""
+
+# --- Imports ---
+import logging
+import queue
+import threading
+import time
+
+import config # config.py configuration parameters
+import runmetrics # per stage timing instrumentation
+from sharedbands import SharedBands
+
+
+# --- Constants ---
+# Queue item that tells a stage worker there are no more items
+STOP = None
+
+
+# --- Classes ---
+class Stage:
+    '''
+    One stage of the pipeline: a function run on each item by a number of worker threads. The function returns an iterable of
+    the items to pass on to the next stage (a generator can pass on several items per input item, or none).
+    '''
+    def __init__(self, name, function, workers=1, queuesize=1):
+        self.name = name
+        self.function = function
+        self.workers = workers
+        self.queuesize = queuesize
+        self.counts = {'items': 0, 'busy': 0.0, 'starved': 0.0, 'blocked': 0.0}
+
+
+# --- Functions ---
+def runpipeline(items, stages, initializer=None):
+    '''
+    Runs the items through the stages and waits for all of them to finish. If a stage function raises an error, the items
+    already in the pipeline are drained without being processed and the first error is raised once all workers have stopped.
+
+    Return:
+    Wall time of the run (seconds)
+
+    Keyword arguments:
+    items -- items for the first stage
+    stages -- list of Stage objects, in order
+    initializer -- function called at the start of each worker thread (e.g. to set up the GDAL environment)
+    '''
+    # the input queue of the first stage holds all the items; the queue in front of each later stage is bounded
+    queues = [queue.Queue()] + [queue.Queue(maxsize=s.queuesize) for s in stages[1:]] + [None]
+    for item in items:
+        queues[0].put(item)
+    for i in range(stages[0].workers):
+        queues[0].put(STOP)
+
+    lock = threading.Lock()
+    running = [s.workers for s in stages]
+    failed = []
+
+    def worker(i):
+        if initializer is not None:
+            initializer()
+        stage, inqueue, outqueue = stages[i], queues[i], queues[i + 1]
+        while True:
+            waitstart = time.perf_counter()
+            item = inqueue.get()
+            starved = time.perf_counter() - waitstart
+            if item is STOP:
+                break
+
+            start = time.perf_counter()
+            blocked = 0.0
+            try:
+                # after an error the remaining items are taken off the queues but not processed
+                if len(failed) == 0:
+                    for result in stage.function(item):
+                        if outqueue is not None:
+                            putstart = time.perf_counter()
+                            outqueue.put(result)
+                            blocked += time.perf_counter() - putstart
+                        if len(failed) > 0:
+                            break
+            except Exception as e:
+                logging.exception('Pipeline stage failed: ' + stage.name)
+                with lock:
+                    failed.append(e)
+            finally:
+                with lock:
+                    stage.counts['items'] += 1
+                    stage.counts['busy'] += time.perf_counter() - start - blocked
+                    stage.counts['starved'] += starved
+                    stage.counts['blocked'] += blocked
+
+        # the last worker of a stage to stop tells the workers of the next stage to stop
+        with lock:
+            running[i] -= 1
+            last = running[i] == 0
+        if last and outqueue is not None:
+            for k in range(stages[i + 1].workers):
+                outqueue.put(STOP)
+
+    start = time.perf_counter()
+    threads = []
+    for i, stage in enumerate(stages):
+        for k in range(stage.workers):
+            thread = threading.Thread(target=worker, args=(i,), name=stage.name + '-' + str(k), daemon=True)
+            thread.start()
+            threads.append(thread)
+    for thread in threads:
+        thread.join()
+    walltime = time.perf_counter() - start
+
+    if len(failed) > 0:
+        raise failed[0]
+    return walltime
+
+
+def summarisestages(stages, walltime):
+    '''
+    Builds a table of the time each stage spent working, waiting for input and waiting for space in the next queue.
+    The stage with the highest utilisation is the one limiting the throughput.
+
+    Return:
+    Summary table as a string
+
+    Keyword arguments:
+    stages -- list of Stage objects after a run
+    walltime -- wall time of the run (seconds)
+    '''
+    rows = ['{0:<12}{1:>9}{2:>8}{3:>11}{4:>15}{5:>16}{6:>8}'.format('stage', 'workers', 'items', 'busy (s)', 'no input (s)', 'queue full (s)', 'use %')]
+    for stage in stages:
+        c = stage.counts
+        use = 100 * c['busy'] / (stage.workers * walltime) if walltime > 0 else 0
+        rows.append('{0:<12}{1:>9}{2:>8}{3:>11.1f}{4:>15.1f}{5:>16.1f}{6:>8.1f}'.format(stage.name, stage.workers, c['items'], c['busy'], c['starved'], c['blocked'], use))
+    return '\n'.join(rows)
+
+
+def initcompute(settings):
+    '''
+    Sets up a compute process with the configuration of the parent process (which may differ from config.py)
+
+    Return:
+    NA
+
+    Keyword arguments:
+    settings -- dictionary of config names and values
+    '''
+    for name, value in settings.items():
+        setattr(config, name, value)
+
+
+def computeshared(predescription, postdescription, intermediates):
+    '''
+    Runs the index and threshold stage of a pair in a compute process, on bands held in shared memory
+
+    Return:
+    Burn seed array, burn area array, dictionary of the intermediate products and the stage timings
+
+    Keyword arguments:
+    predescription -- shared memory description of the pre-fire bands
+    postdescription -- shared memory description of the post-fire bands
+    intermediates -- names of the intermediate products to return
+    '''
+    # imported here so that the parent process does not load a second copy of the processing script
+    import operationalcode
+
+    record = runmetrics.newrecord('compute')
+    runmetrics.activate(record)
+    prebuffers = SharedBands.attach(predescription)
+    postbuffers = SharedBands.attach(postdescription)
+    try:
+        burnseed, burnarray, products = operationalcode.computepair(prebuffers.arrays, postbuffers.arrays)
+        products = {name: products[name] for name in intermediates}
+    finally:
+        prebuffers.close()
+        postbuffers.close()
+        runmetrics.activate(None)
+    return burnseed, burnarray, products, record['stages']
@@ -0,0 +1,68 @@
+"""
+Tests that the fast sieve (fastsieve.py) gives the same result as the GDAL sieve it replaces.
+
+Usage:
+python -m pytest -q tests
+
+"""
+
+# --- Imports ---
+import os
+import sys
+
+import numpy as np
+from rasterio.features import sieve
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import fastsieve
+
+
+# --- Functions ---
+def randommasks():
+    '''
+    Generates random binary masks of several sizes and densities (sparse and dense masks have many 1 and 2 pixel clumps)
+    '''
+    rng = np.random.default_rng(2019)
+    for shape in [(3, 3), (5, 7), (64, 64), (97, 131)]:
+        for density in [0.05, 0.3, 0.5, 0.7, 0.95]:
+            yield (rng.random(shape) < density).astype(np.uint8)
+
+
+def gdalsieve(array):
+    '''
+    Sieves an array as threshold_imgs and grow_burn do with the GDAL sieve
+    '''
+    return sieve(array, size=3, connectivity=8)
+
+
+def test_random_masks():
+    for array in randommasks():
+        assert np.array_equal(fastsieve.fastsieve(array), gdalsieve(array))
+
+
+def test_random_masks_in_strips():
+    for array in randommasks():
+        for striprows in [3, 4, 8]:
+            assert np.array_equal(fastsieve.fastsieve(array, threads=4, striprows=striprows), gdalsieve(array))
+
+
+def test_clumps_crossing_strip_edges():
+    array = np.zeros((32, 24), dtype=np.uint8)
+    edge = 8
+    # 2 pixel clumps split by the edge between the first two strips, vertically and diagonally
+    array[edge - 1:edge + 1, 2] = 1
+    array[edge - 1, 5] = 1
+    array[edge, 6] = 1
+    # a 3 pixel clump split by the edge is kept
+    array[edge - 1:edge + 2, 10] = 1
+    # a single pixel on each side of the next edge
+    array[2 * edge - 1, 14] = 1
+    array[2 * edge, 18] = 1
+    # a 2 pixel hole split by the last edge in a burned area
+    array[3 * edge - 3:3 * edge + 3, 12:20] = 1
+    array[3 * edge - 1:3 * edge + 1, 15] = 0
+
+    expected = gdalsieve(array)
+    assert np.array_equal(fastsieve.fastsieve(array, threads=4, striprows=edge), expected)
+    assert np.array_equal(fastsieve.fastsieve(array), expected)
+    assert expected[edge - 1:edge + 2, 10].all() and not expected[edge - 1:edge + 1, 2].any()
@@ -0,0 +1,113 @@
+"""
+Tests of the lease handling of the shared filesystem work queue (workqueue.py).
+
+Usage:
+python -m pytest -q tests
+
+"""
+
+# --- Imports ---
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import workqueue
+
+
+# --- Functions ---
+def plannedqueue(queuedir):
+    '''
+    Creates a queue holding one unit
+    '''
+    workqueue.makequeue(queuedir)
+    chain = [['S2A_20190401_T30VVJ.tif', '/ard', 'T30VVJ', 1.0, '20190401'],
+             ['S2B_20190404_T30VVJ.tif', '/ard', 'T30VVJ', 1.0, '20190404']]
+    return workqueue.planunits(queuedir, [chain])[0]
+
+
+def expire(queuedir, unit):
+    '''
+    Ages the lease of a unit past any timeout
+    '''
+    os.utime(os.path.join(queuedir, 'leased', unit + '.json'), (0, 0))
+
+
+def test_finish(tmp_path):
+    queuedir = str(tmp_path)
+    unit = plannedqueue(queuedir)
+    data = workqueue.claimunit(queuedir)
+
+    assert workqueue.finishunit(queuedir, data, 'done')
+    assert workqueue.queuestatus(queuedir) == {'pending': 0, 'leased': 0, 'done': 1, 'failed': 0}
+    assert workqueue.collectdone(queuedir)[0]['unit'] == unit
+
+
+def test_finish_after_lease_requeued(tmp_path):
+    queuedir = str(tmp_path)
+    unit = plannedqueue(queuedir)
+    data = workqueue.claimunit(queuedir)
+    expire(queuedir, unit)
+    assert workqueue.requeueexpired(queuedir, timeout=60, maxattempts=3) == [unit]
+
+    assert not workqueue.finishunit(queuedir, data, 'done')
+    assert workqueue.queuestatus(queuedir) == {'pending': 1, 'leased': 0, 'done': 0, 'failed': 0}
+
+
+def test_finish_after_lease_claimed_by_another_worker(tmp_path, monkeypatch):
+    queuedir = str(tmp_path)
+    unit = plannedqueue(queuedir)
+    first = workqueue.claimunit(queuedir)
+    expire(queuedir, unit)
+    workqueue.requeueexpired(queuedir, timeout=60, maxattempts=3)
+    monkeypatch.setattr(workqueue, 'workerid', lambda: 'othernode:1')
+    second = workqueue.claimunit(queuedir)
+
+    # the worker whose lease expired neither moves the unit nor touches the new lease
+    assert not workqueue.finishunit(queuedir, first, 'done')
+    leasepath = os.path.join(queuedir, 'leased', unit + '.json')
+    assert workqueue.readjson(leasepath)['worker'] == 'othernode:1'
+    assert workqueue.queuestatus(queuedir) == {'pending': 0, 'leased': 1, 'done': 0, 'failed': 0}
+
+    assert workqueue.finishunit(queuedir, second, 'done')
+    assert workqueue.queuestatus(queuedir) == {'pending': 0, 'leased': 0, 'done': 1, 'failed': 0}
+
+
+def test_heartbeat_stops_when_lease_claimed_by_another_worker(tmp_path, monkeypatch):
+    queuedir = str(tmp_path)
+    unit = plannedqueue(queuedir)
+    first = workqueue.claimunit(queuedir)
+    expire(queuedir, unit)
+    workqueue.requeueexpired(queuedir, timeout=60, maxattempts=3)
+    monkeypatch.setattr(workqueue, 'workerid', lambda: 'othernode:1')
+    workqueue.claimunit(queuedir)
+    leasepath = os.path.join(queuedir, 'leased', unit + '.json')
+    expire(queuedir, unit)
+
+    stop, lost = threading.Event(), threading.Event()
+    beat = threading.Thread(target=workqueue.heartbeat, args=(leasepath, first, 0.01, stop, lost))
+    beat.start()
+    beat.join(timeout=5)
+    stop.set()
+
+    assert not beat.is_alive()
+    assert lost.is_set()
+    assert os.stat(leasepath).st_mtime == 0
+    with pytest.raises(workqueue.LeaseLost):
+        workqueue.checklease(lost, unit)
+
+
+def test_heartbeat_reports_requeued_lease(tmp_path):
+    queuedir = str(tmp_path)
+    unit = plannedqueue(queuedir)
+    data = workqueue.claimunit(queuedir)
+    expire(queuedir, unit)
+    workqueue.requeueexpired(queuedir, timeout=60, maxattempts=3)
+    stop, beat, lost = workqueue.startheartbeat(queuedir, data, 0.01)
+
+    assert lost.wait(timeout=5)
+    workqueue.stopheartbeat(stop, beat)
+    with pytest.raises(workqueue.LeaseLost):
+        workqueue.checklease(lost, unit)
@@ -0,0 +1,487 @@
+"""
+This module contains a work queue held on a shared filesystem (e.g. the group workspace), used to spread the processing of
+granule chains over any number of worker processes on any number of nodes without a scheduler or service.
+
+Each work unit is a JSON file holding the date sorted chain of images for one granule. A unit moves between the queue folders
+by atomic renames:
+
+    pending/  units waiting for a worker
+    leased/   units claimed by a worker. The worker touches the file (heartbeat) while it works on the unit
+    done/     units completed
+    failed/   units that raised an error, or whose lease expired more than the allowed number of times
+
+A worker claims a unit by renaming it from pending/ to leased/. Only one rename can succeed, so two workers can never hold
+the same unit. A lease whose heartbeat is older than the lease timeout (the worker was killed or its node went down) is
+renamed back to pending/ by whichever worker notices it first.
+
+A lease records the worker that claimed it and when. A worker whose lease expired may still be running, and by then another
+worker may have claimed the unit again under the same path, so the heartbeat and finishunit check that the lease is still
+their own before touching or moving it. When the heartbeat finds the lease gone or claimed again it sets a lost event, and the
+worker stops processing the unit at the next pair (checklease) and leaves it to the new owner.
+
+"""
+
+# --- Imports ---
+import contextlib
+import datetime
+import json
+import logging
+import os
+import socket
+import threading
+import time
+
+
+# --- Constants ---
+FOLDERS = ['pending', 'leased', 'done', 'failed']
+
+# Seconds after which a lock file is taken to have been left by a process that was killed
+LOCK_TIMEOUT = 300
+
+
+# --- Classes ---
+class LeaseLost(Exception):
+    '''
+    Raised by checklease when the lease of the unit a worker is processing has been lost (requeued, or claimed by another worker)
+    '''
+
+
+# --- Functions ---
+def makequeue(queuedir):
+    '''
+    Creates the queue folders if they do not exist
+
+    Return:
+    NA
+
+    Keyword arguments:
+    queuedir -- queue folder on the shared filesystem
+    '''
+    for folder in FOLDERS:
+        os.makedirs(os.path.join(queuedir, folder), exist_ok=True)
+
+
+def workerid():
+    '''
+    Identifies the calling worker process (host name and process ID)
+
+    Return:
+    Worker ID string
+    '''
+    return socket.gethostname() + ':' + str(os.getpid())
+
+
+def writejson(path, data):
+    '''
+    Writes a JSON file atomically (written to a temporary file in the same folder and then renamed over the target)
+
+    Return:
+    NA
+
+    Keyword arguments:
+    path -- path of the JSON file
+    data -- data to be written
+    '''
+    temppath = path + '.' + socket.gethostname() + '.' + str(os.getpid()) + '.tmp'
+    with open(temppath, 'w') as outfile:
+        json.dump(data, outfile)
+        outfile.flush()
+        os.fsync(outfile.fileno())
+    os.replace(temppath, path)
+
+
+def readjson(path):
+    '''
+    Reads a JSON file
+
+    Return:
+    The data held in the file
+
+    Keyword arguments:
+    path -- path of the JSON file
+    '''
+    with open(path) as infile:
+        return json.load(infile)
+
+
+@contextlib.contextmanager
+def filelock(path, timeout=LOCK_TIMEOUT):
+    '''
+    Holds a lock file on the shared filesystem while a file is read and replaced. The lock file is created exclusively, so only
+    one process on any node can hold it. A lock file older than timeout is taken to have been left by a process that was killed
+    and is removed.
+
+    Return:
+    Context manager
+
+    Keyword arguments:
+    path -- path of the lock file
+    timeout -- seconds after which a lock file is taken to be stale
+    '''
+    owner = socket.gethostname() + '.' + str(os.getpid()) + '.' + str(threading.get_ident())
+    while True:
+        try:
+            lockfile = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                age = time.time() - os.stat(path).st_mtime
+            except FileNotFoundError:
+                continue
+            if age > timeout:
+                # renamed first, so only one process removes it
+                try:
+                    os.rename(path, path + '.' + owner + '.stale')
+                    os.remove(path + '.' + owner + '.stale')
+                    logging.warning('Stale lock file removed: ' + path)
+                except FileNotFoundError:
+                    pass
+                continue
+            time.sleep(0.1)
+            continue
+        os.write(lockfile, owner.encode())
+        os.close(lockfile)
+        break
+    try:
+        yield
+    finally:
+        # the lock may have been taken over as stale while it was held
+        try:
+            with open(path) as infile:
+                held = infile.read() == owner
+        except FileNotFoundError:
+            held = False
+        if held:
+            os.remove(path)
+        else:
+            logging.warning('Lock file was taken over while held: ' + path)
+
+
+def unitid(chain):
+    '''
+    Builds the ID of a work unit from its chain of images (granule, first date and last date)
+
+    Return:
+    Unit ID string
+
+    Keyword arguments:
+    chain -- date sorted list of images ([imagename, imagepath, granule, size, date]) for one granule
+    '''
+    return chain[0][2] + '_' + chain[0][4] + '_' + chain[-1][4]
+
+
+def listunits(queuedir, folder):
+    '''
+    Lists the unit IDs in one of the queue folders
+
+    Return:
+    Sorted list of unit IDs
+
+    Keyword arguments:
+    queuedir -- queue folder
+    folder -- 'pending', 'leased', 'done' or 'failed'
+    '''
+    return sorted(f[:-5] for f in os.listdir(os.path.join(queuedir, folder)) if f.endswith('.json'))
+
+
+def queuedimages(queuedir, folders=('pending', 'leased')):
+    '''
+    Lists the names of the images held in units in the given queue folders
+
+    Return:
+    Set of image names
+
+    Keyword arguments:
+    queuedir -- queue folder
+    folders -- queue folders to look in
+    '''
+    images = set()
+    for folder in folders:
+        for unit in listunits(queuedir, folder):
+            try:
+                images.update(image[0] for image in readjson(os.path.join(queuedir, folder, unit + '.json'))['chain'])
+            except (OSError, ValueError):
+                # the unit moved while being read
+                continue
+    return images
+
+
+def planunits(queuedir, chains):
+    '''
+    Writes a work unit to the pending folder for each granule chain. Chains already in the queue are not written again.
+
+    Return:
+    List of unit IDs written
+
+    Keyword arguments:
+    queuedir -- queue folder
+    chains -- list of date sorted image chains, one per granule
+    '''
+    makequeue(queuedir)
+    existing = set()
+    for folder in FOLDERS:
+        existing.update(listunits(queuedir, folder))
+
+    written = []
+    for chain in chains:
+        unit = unitid(chain)
+        if unit in existing:
+            logging.debug('Unit already queued: ' + unit)
+            continue
+        data = {'unit': unit, 'granule': chain[0][2], 'chain': chain, 'attempts': 0,
+                'planned': datetime.datetime.now().isoformat(timespec='seconds')}
+        writejson(os.path.join(queuedir, 'pending', unit + '.json'), data)
+        written.append(unit)
+    logging.debug('Units planned: ' + str(written))
+    return written
+
+
+def claimunit(queuedir):
+    '''
+    Claims the first pending unit that no other worker has claimed, by renaming it into the leased folder
+
+    Return:
+    The unit data (or None if no unit could be claimed)
+
+    Keyword arguments:
+    queuedir -- queue folder
+    '''
+    for unit in listunits(queuedir, 'pending'):
+        leasepath = os.path.join(queuedir, 'leased', unit + '.json')
+        try:
+            os.rename(os.path.join(queuedir, 'pending', unit + '.json'), leasepath)
+        except FileNotFoundError:
+            # another worker got there first
+            continue
+
+        # renaming keeps the planning time as the modification time, so refresh it before another worker sees an expired lease
+        os.utime(leasepath)
+        data = readjson(leasepath)
+        data['worker'] = workerid()
+        data['claimed'] = datetime.datetime.now().isoformat(timespec='seconds')
+        writejson(leasepath, data)
+        logging.debug('Unit claimed: ' + unit)
+        return data
+    return None
+
+
+def ownlease(leasepath, data):
+    '''
+    Checks whether a lease file is still held by the worker and claim in the unit data
+
+    Return:
+    True if the lease is the one claimed, False if it has gone or has been claimed again by another worker
+
+    Keyword arguments:
+    leasepath -- path of the lease file
+    data -- unit data returned by claimunit
+    '''
+    try:
+        lease = readjson(leasepath)
+    except (FileNotFoundError, ValueError):
+        return False
+    return lease.get('worker') == data['worker'] and lease.get('claimed') == data['claimed']
+
+
+def heartbeat(leasepath, data, interval, stop, lost=None):
+    '''
+    Touches the lease file every interval seconds until the stop event is set, or until the lease is found to be lost: held by
+    another claim, or missing at two heartbeats in a row (requeued)
+
+    Return:
+    NA
+
+    Keyword arguments:
+    leasepath -- path of the leased unit file
+    data -- unit data returned by claimunit
+    interval -- seconds between heartbeats
+    stop -- threading.Event used to stop the heartbeat
+    lost -- threading.Event set when the lease is lost (optional)
+    '''
+    missing = 0
+    while not stop.wait(interval):
+        if not os.path.exists(leasepath):
+            # renamed for a moment by another worker checking a claim of its own, or requeued if it stays missing
+            missing += 1
+            if missing < 2:
+                continue
+        elif ownlease(leasepath, data):
+            missing = 0
+            try:
+                os.utime(leasepath)
+            except FileNotFoundError:
+                pass
+            continue
+        logging.warning('Lease lost: ' + leasepath)
+        if lost is not None:
+            lost.set()
+        return
+
+
+def startheartbeat(queuedir, data, interval):
+    '''
+    Starts a background thread that keeps the lease of a unit alive
+
+    Return:
+    The stop event, the heartbeat thread and the event set if the lease is lost
+
+    Keyword arguments:
+    queuedir -- queue folder
+    data -- unit data returned by claimunit
+    interval -- seconds between heartbeats
+    '''
+    stop, lost = threading.Event(), threading.Event()
+    beat = threading.Thread(target=heartbeat, args=(os.path.join(queuedir, 'leased', data['unit'] + '.json'), data, interval, stop, lost),
+                            name='lease-heartbeat', daemon=True)
+    beat.start()
+    return stop, beat, lost
+
+
+def checklease(lost, unit):
+    '''
+    Stops the processing of a unit whose lease has been lost, so the worker does not write the same outputs as the new owner
+
+    Return:
+    NA
+
+    Keyword arguments:
+    lost -- the lost event from startheartbeat (None when not processing a unit from the queue)
+    unit -- unit ID, for the error message
+    '''
+    if lost is not None and lost.is_set():
+        raise LeaseLost('Lease lost, stopped processing unit ' + unit)
+
+
+def stopheartbeat(stop, beat):
+    '''
+    Stops a heartbeat thread
+
+    Return:
+    NA
+
+    Keyword arguments:
+    stop -- the stop event
+    beat -- the heartbeat thread
+    '''
+    stop.set()
+    beat.join()
+
+
+def finishunit(queuedir, data, folder, error=None):
+    '''
+    Moves a leased unit to the done or failed folder. The lease is first renamed to a name private to the worker, so it cannot
+    be requeued or claimed while it is moved, and is put back untouched if it turns out to belong to another claim.
+
+    Return:
+    True if the unit was moved, False if the lease had already been lost (requeued, or claimed again by another worker)
+
+    Keyword arguments:
+    queuedir -- queue folder
+    data -- unit data returned by claimunit
+    folder -- 'done' or 'failed'
+    error -- error message for failed units
+    '''
+    leasepath = os.path.join(queuedir, 'leased', data['unit'] + '.json')
+    if not ownlease(leasepath, data):
+        logging.warning('Lease lost before the unit finished: ' + data['unit'])
+        return False
+
+    finishpath = leasepath + '.' + socket.gethostname() + '.' + str(os.getpid()) + '.finish'
+    try:
+        os.rename(leasepath, finishpath)
+    except FileNotFoundError:
+        logging.warning('Lease lost before the unit finished: ' + data['unit'])
+        return False
+    if not ownlease(finishpath, data):
+        # requeued and claimed again between the check and the rename
+        os.rename(finishpath, leasepath)
+        logging.warning('Lease lost before the unit finished: ' + data['unit'])
+        return False
+
+    data['finished'] = datetime.datetime.now().isoformat(timespec='seconds')
+    if error is not None:
+        data['error'] = error
+    writejson(finishpath, data)
+    os.rename(finishpath, os.path.join(queuedir, folder, data['unit'] + '.json'))
+    logging.debug('Unit ' + folder + ': ' + data['unit'])
+    return True
+
+
+def requeueexpired(queuedir, timeout, maxattempts):
+    '''
+    Returns leased units whose heartbeat is older than the timeout to the pending folder, or to the failed folder if they have
+    already been attempted maxattempts times
+
+    Return:
+    List of unit IDs requeued
+
+    Keyword arguments:
+    queuedir -- queue folder
+    timeout -- seconds without a heartbeat before a lease expires
+    maxattempts -- maximum number of attempts at a unit
+    '''
+    requeued = []
+    now = time.time()
+    for unit in listunits(queuedir, 'leased'):
+        leasepath = os.path.join(queuedir, 'leased', unit + '.json')
+        try:
+            if now - os.stat(leasepath).st_mtime < timeout:
+                continue
+            # take the expired lease over by renaming it, so only one worker requeues it
+            expiredpath = leasepath + '.' + socket.gethostname() + '.' + str(os.getpid()) + '.expired'
+            os.rename(leasepath, expiredpath)
+        except FileNotFoundError:
+            continue
+
+        data = readjson(expiredpath)
+        data['attempts'] = data.get('attempts', 0) + 1
+        folder = 'pending' if data['attempts'] < maxattempts else 'failed'
+        if folder == 'failed':
+            data['error'] = 'lease expired ' + str(data['attempts']) + ' times'
+        writejson(expiredpath, data)
+        os.rename(expiredpath, os.path.join(queuedir, folder, unit + '.json'))
+        logging.warning('Expired lease of ' + str(data.get('worker')) + ' moved to ' + folder + ': ' + unit)
+        requeued.append(unit)
+    return requeued
+
+
+def collectdone(queuedir):
+    '''
+    Reads the completed units
+
+    Return:
+    List of unit data
+
+    Keyword arguments:
+    queuedir -- queue folder
+    '''
+    return [readjson(os.path.join(queuedir, 'done', unit + '.json')) for unit in listunits(queuedir, 'done')]
+
+
+def removedone(queuedir, units):
+    '''
+    Removes completed units from the done folder once they have been recorded
+
+    Return:
+    NA
+
+    Keyword arguments:
+    queuedir -- queue folder
+    units -- list of unit data returned by collectdone
+    '''
+    for data in units:
+        path = os.path.join(queuedir, 'done', data['unit'] + '.json')
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def queuestatus(queuedir):
+    '''
+    Counts the units in each queue folder
+
+    Return:
+    Dictionary of folder name to number of units
+
+    Keyword arguments:
+    queuedir -- queue folder
+    '''
+    return {folder: len(listunits(queuedir, folder)) for folder in FOLDERS}